@@ -0,0 +1,75 @@
+"""
+Import-time budget of cocoplus.
+
+Imports cocoplus in fresh interpreters and fails if the median import time
+exceeds the budget, or if a heavy optional dependency is loaded at import.
+
+    python benchmarks/import_time.py --budget 0.5
+
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+## Dependencies that must only be imported on first use
+LAZY_MODULES = ['cv2', 'matplotlib', 'shapely', 'tqdm']
+
+_PROBE = """
+import sys, time, json
+sys.path.insert(0, {root!r})
+tic = time.perf_counter()
+import {module}
+toc = time.perf_counter()
+print(json.dumps({{'seconds': toc - tic,
+                  'loaded': sorted({{m.split('.')[0] for m in sys.modules}})}}))
+"""
+
+
+def measure(module='cocoplus', repeat=5):
+    """
+    :return (dict): median import time in seconds and the eagerly imported
+        lazy modules
+    """
+
+    times, loaded = [], set()
+    for _ in range(repeat):
+        out = subprocess.check_output(
+            [sys.executable, '-c', _PROBE.format(root=ROOT, module=module)])
+        result = json.loads(out)
+        times.append(result['seconds'])
+        loaded.update(m for m in result['loaded'] if m in LAZY_MODULES)
+    times.sort()
+    return {'module': module,
+            'seconds': times[len(times) // 2],
+            'eager_modules': sorted(loaded)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--module', default='cocoplus')
+    parser.add_argument('--budget', type=float, default=0.5,
+                        help='maximum median import time in seconds')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    result = measure(args.module, args.repeat)
+    print(json.dumps(result, indent=2))
+
+    ok = True
+    if result['seconds'] > args.budget:
+        print('FAIL: import of {} took {:.3f}s, budget is {:.3f}s'.format(
+            args.module, result['seconds'], args.budget))
+        ok = False
+    if result['eager_modules']:
+        print('FAIL: {} imported at import time'.format(result['eager_modules']))
+        ok = False
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
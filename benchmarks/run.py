@@ -0,0 +1,358 @@
+"""
+Benchmark suite of the cocoplus hot paths on synthetic datasets.
+
+Every case is timed over a few repeats (best time kept) and run once more
+under tracemalloc for its peak memory. Results are written to a JSON file
+and optionally compared against a baseline results file.
+
+    python benchmarks/run.py --out results.json
+    python benchmarks/run.py --baseline results.json --tolerance 0.2
+
+"""
+
+import os
+import io
+import sys
+import gc
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import contextlib
+from collections import OrderedDict
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cocoplus
+from cocoplus.coco import COCO_PLUS
+from cocoplus.coco_eval import COCOeval_plus
+from cocoplus.utils import coco_utils
+from synthetic import make_dataset, make_detections
+import import_time
+
+_DEFAULTS = {'num_cats': 20, 'seg': 'polygon', 'pc_points': 0, 'seed': 0}
+SCALES = {'small': dict(_DEFAULTS, num_imgs=500, anns_per_img=8,
+                        num_samples=200, eval_imgs=200),
+          'medium': dict(_DEFAULTS, num_imgs=5000, anns_per_img=10,
+                         num_samples=1000, eval_imgs=1000),
+          'large': dict(_DEFAULTS, num_imgs=50000, anns_per_img=10,
+                        num_samples=5000, eval_imgs=5000)}
+
+
+def _quiet():
+    """
+    Silence the prints of pycocotools.
+    """
+
+    return contextlib.redirect_stdout(io.StringIO())
+
+
+def _fromDict(dataset):
+    coco = COCO_PLUS(logging_level='ERROR')
+    coco.dataset = dataset
+    with _quiet():
+        coco.createIndex()
+    return coco
+
+
+class Context(object):
+    """
+    Datasets and files shared by the benchmark cases.
+    """
+
+    def __init__(self, config, work_dir):
+        self.config = config
+        self.work_dir = work_dir
+        self.dataset = make_dataset(num_imgs=config['num_imgs'],
+                                    anns_per_img=config['anns_per_img'],
+                                    num_cats=config['num_cats'],
+                                    seg=config['seg'],
+                                    pc_points=config['pc_points'],
+                                    seed=config['seed'])
+        self.ann_file = os.path.join(work_dir, 'annotations.json')
+        with open(self.ann_file, 'w') as f:
+            json.dump(self.dataset, f)
+        self.num_anns = len(self.dataset['annotations'])
+
+        eval_imgs = {img['id'] for img in
+                     self.dataset['images'][:config['eval_imgs']]}
+        self.eval_dataset = dict(self.dataset,
+                                 images=self.dataset['images'][:config['eval_imgs']],
+                                 annotations=[a for a in self.dataset['annotations']
+                                              if a['image_id'] in eval_imgs])
+        self.detections = make_detections(self.eval_dataset, seed=config['seed'])
+
+
+##------------------------------------------------------------------------------
+## Benchmark cases: setup(ctx) returns the state given to run(state), and the
+## number of processed items. Only run is timed.
+
+def _setupLoad(ctx):
+    return ctx.ann_file, ctx.num_anns
+
+def _runLoad(ann_file):
+    with _quiet():
+        COCO_PLUS(ann_file, logging_level='ERROR')
+
+
+def _setupCreateIndex(ctx):
+    return _fromDict(ctx.dataset), ctx.num_anns
+
+def _runCreateIndex(coco):
+    with _quiet():
+        coco.createIndex()
+
+
+def _setupAddSample(ctx, write_img=False):
+    out_dir = tempfile.mkdtemp(dir=ctx.work_dir)
+    coco = COCO_PLUS(logging_level='ERROR')
+    coco.create_new_dataset(out_dir, 'bench')
+    cat_ids = [coco.addCategory(cat['name'], cat['supercategory'])
+               for cat in ctx.dataset['categories']]
+    rng = np.random.RandomState(ctx.config['seed'])
+    img = rng.randint(0, 255, (240, 320, 3)).astype(np.uint8)
+    samples = []
+    for i in range(ctx.config['num_samples']):
+        anns = [coco.createAnn([10 + j, 20, 30, 40], cat_ids[j % len(cat_ids)])
+                for j in range(ctx.config['anns_per_img'])]
+        samples.append((img, anns))
+    return (coco, samples, write_img), len(samples)
+
+def _runAddSample(state):
+    coco, samples, write_img = state
+    for img, anns in samples:
+        coco.addSample(img, anns, write_img=write_img)
+
+
+def _setupSave(ctx):
+    coco = _fromDict(ctx.dataset)
+    return (coco, os.path.join(ctx.work_dir, 'saved.json')), ctx.num_anns
+
+def _runSave(state):
+    coco, ann_file = state
+    coco.saveAnnsToDisk(ann_file)
+
+
+def _setupPoly2rle(ctx):
+    coco = COCO_PLUS(logging_level='ERROR')
+    # No polygons to convert if the dataset has RLE segmentations
+    polys = [ann['segmentation'] for ann in ctx.eval_dataset['annotations']
+             if isinstance(ann['segmentation'], list)]
+    return (coco, polys), len(polys)
+
+def _runPoly2rle(state):
+    coco, polys = state
+    for poly in polys:
+        coco.poly2rle(poly, 480, 640)
+
+
+def _setupBoxes(ctx):
+    boxes = np.array([ann['bbox'] for ann in ctx.dataset['annotations']],
+                     dtype=np.float64)
+    return boxes, len(boxes)
+
+def _runBoxes(boxes):
+    xyxy = coco_utils.xywh_to_xyxy(boxes)
+    xyxy = coco_utils.clip_boxes_to_image(xyxy, 480, 640)
+    coco_utils.xyxy_to_xywh(xyxy)
+
+
+def _setupDraw(ctx):
+    img = np.zeros((480, 640, 3), dtype=np.uint8)
+    anns = ctx.eval_dataset['annotations']
+    boxes = [[a['bbox'] for a in anns[i:i + 10]]
+             for i in range(0, min(len(anns), 2000), 10)]
+    return (img, boxes), len(boxes)
+
+def _runDraw(state):
+    img, boxes = state
+    for img_boxes in boxes:
+        coco_utils.draw_xywh_bbox(img.copy(), img_boxes, lineWidth=2)
+
+
+def _setupEval(ctx, steps=()):
+    coco = _fromDict(ctx.eval_dataset)
+    with _quiet():
+        dets = coco.loadRes(list(ctx.detections))
+        coco_eval = COCOeval_plus(coco, dets, 'bbox')
+        for step in steps:
+            getattr(coco_eval, step)()
+    return coco_eval, len(ctx.eval_dataset['images'])
+
+def _runEvaluate(coco_eval):
+    with _quiet():
+        coco_eval.evaluate()
+
+def _runAccumulate(coco_eval):
+    with _quiet():
+        coco_eval.accumulate()
+
+def _runSummarize(coco_eval):
+    with _quiet():
+        coco_eval.summarize()
+
+
+CASES = OrderedDict([
+    ('load', (_setupLoad, _runLoad, 'annotations')),
+    ('createIndex', (_setupCreateIndex, _runCreateIndex, 'annotations')),
+    ('addSample', (_setupAddSample, _runAddSample, 'samples')),
+    ('addSample_write', (lambda ctx: _setupAddSample(ctx, write_img=True),
+                         _runAddSample, 'samples')),
+    ('saveAnnsToDisk', (_setupSave, _runSave, 'annotations')),
+    ('poly2rle', (_setupPoly2rle, _runPoly2rle, 'polygons')),
+    ('box_ops', (_setupBoxes, _runBoxes, 'boxes')),
+    ('draw_xywh_bbox', (_setupDraw, _runDraw, 'images')),
+    ('eval_evaluate', (_setupEval, _runEvaluate, 'images')),
+    ('eval_accumulate', (lambda ctx: _setupEval(ctx, ['evaluate']),
+                         _runAccumulate, 'images')),
+    ('eval_summarize', (lambda ctx: _setupEval(ctx, ['evaluate', 'accumulate']),
+                        _runSummarize, 'images')),
+])
+
+
+##------------------------------------------------------------------------------
+def run_case(ctx, name, repeat=3):
+    """
+    :return (dict): best time, throughput and peak traced memory of a case
+    """
+
+    setup, run, unit = CASES[name]
+    best = float('inf')
+    for _ in range(repeat):
+        state, items = setup(ctx)
+        gc.collect()
+        tic = time.perf_counter()
+        run(state)
+        best = min(best, time.perf_counter() - tic)
+        del state
+
+    state, items = setup(ctx)
+    gc.collect()
+    tracemalloc.start()
+    run(state)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return {'seconds': best,
+            'items': items,
+            'unit': unit,
+            'throughput': items / best if best > 0 else float('inf'),
+            'peak_bytes': peak}
+
+
+def run_suite(config, cases=None, repeat=3):
+    """
+    Run the benchmark cases on a synthetic dataset.
+    :param config (dict): dataset sizes, see SCALES
+    :param cases (list): names of the cases to run, all if None
+    :return (dict): results with the environment and config
+    """
+
+    # The import time is measured in a subprocess, not on the dataset
+    names = [name for name in cases or CASES if name != 'import']
+    results = OrderedDict()
+    work_dir = tempfile.mkdtemp(prefix='cocoplus_bench_')
+    try:
+        ctx = Context(config, work_dir) if names else None
+        for name in names:
+            results[name] = run_case(ctx, name, repeat)
+            print('{:<18} {:>10.4f}s {:>14.1f} {}/s {:>10.1f} MB'.format(
+                name, results[name]['seconds'], results[name]['throughput'],
+                results[name]['unit'], results[name]['peak_bytes'] / 2**20))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if cases is None or 'import' in cases:
+        imp = import_time.measure('cocoplus', repeat=max(repeat, 3))
+        results['import'] = {'seconds': imp['seconds'], 'items': 1,
+                             'unit': 'imports',
+                             'throughput': 1. / imp['seconds'],
+                             'peak_bytes': 0}
+
+    return {'meta': {'python': platform.python_version(),
+                     'numpy': np.__version__,
+                     'platform': platform.platform(),
+                     'cocoplus': os.path.dirname(cocoplus.__file__),
+                     'date': time.strftime('%Y-%m-%d %H:%M:%S')},
+            'config': config,
+            'results': results}
+
+
+def compare(results, baseline, tolerance=0.2):
+    """
+    Compare results against a baseline.
+    :param tolerance (float): allowed relative slowdown
+    :return (list): names of the regressed cases
+    """
+
+    if results['config'] != baseline['config']:
+        print('WARNING: benchmark configs differ, comparison may be meaningless')
+
+    regressions = []
+    for name, res in results['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        ratio = res['seconds'] / base['seconds'] if base['seconds'] else 1.
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = 'REGRESSION'
+            regressions.append(name)
+        elif ratio < 1 - tolerance:
+            flag = 'improved'
+        print('{:<18} {:>10.4f}s vs {:>10.4f}s  x{:.2f} {}'.format(
+            name, res['seconds'], base['seconds'], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small')
+    parser.add_argument('--num-imgs', type=int)
+    parser.add_argument('--anns-per-img', type=int)
+    parser.add_argument('--num-cats', type=int)
+    parser.add_argument('--seg', choices=['polygon', 'rle'],
+                        help='segmentation of the annotations')
+    parser.add_argument('--pc-points', type=int)
+    parser.add_argument('--seed', type=int)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--cases', nargs='+', choices=list(CASES) + ['import'])
+    parser.add_argument('--out', default='benchmark_results.json',
+                        help='results file')
+    parser.add_argument('--baseline', help='results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed relative slowdown before flagging')
+    args = parser.parse_args()
+
+    config = dict(SCALES[args.scale])
+    for key in ['num_cats', 'seg', 'pc_points', 'seed']:
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+    if args.num_imgs:
+        config['num_imgs'] = args.num_imgs
+    if args.anns_per_img:
+        config['anns_per_img'] = args.anns_per_img
+
+    results = run_suite(config, args.cases, args.repeat)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print('Results written to {}'.format(args.out))
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print('Regressions: {}'.format(', '.join(regressions)))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+"""
+Reproducible synthetic COCO_PLUS datasets for benchmarking.
+
+"""
+
+import json
+
+import numpy as np
+from pycocotools import mask
+
+
+def make_dataset(num_imgs=1000, anns_per_img=10, num_cats=20, seg=None,
+                 pc_points=0, img_size=(480, 640), seed=0):
+    """
+    Generate a synthetic dataset dict. The same arguments always give the
+    same dataset.
+
+    :param num_imgs (int): number of images
+    :param anns_per_img (int): mean number of annotations per image, the
+        actual numbers are Poisson distributed
+    :param num_cats (int): number of categories
+    :param seg (str): segmentation of the annotations, None for boxes only,
+        'polygon' or 'rle'
+    :param pc_points (int): points per pointcloud, 0 for no pointclouds
+    :param img_size (tuple): (height, width) of the images
+    :param seed (int): random seed
+    :return (dict): the dataset in COCO_PLUS format
+    """
+
+    assert seg in [None, 'polygon', 'rle'], "Segmentation type not supported."
+    rng = np.random.RandomState(seed)
+    height, width = img_size
+
+    categories = [{'id': i + 1, 'name': 'cat_{}'.format(i + 1),
+                   'supercategory': 'super_{}'.format(i % 5)}
+                  for i in range(num_cats)]
+    images = [{'id': i + 1, 'width': width, 'height': height,
+               'file_name': '{:08d}.jpg'.format(i + 1), 'license': 0,
+               'flickr_url': '', 'coco_url': '', 'date_captured': '',
+               'other': None}
+              for i in range(num_imgs)]
+
+    counts = rng.poisson(anns_per_img, num_imgs)
+    num_anns = int(counts.sum())
+    img_ids = np.repeat(np.arange(1, num_imgs + 1), counts)
+    cat_ids = rng.randint(1, num_cats + 1, num_anns)
+    wh = rng.uniform(4, 0.5 * min(height, width), (num_anns, 2)).round(2)
+    xy = (rng.uniform(0, 1, (num_anns, 2)) *
+          ([width, height] - wh)).round(2)
+    boxes = np.hstack((xy, wh))
+    distances = rng.uniform(1, 80, num_anns).round(2)
+
+    annotations = []
+    for k in range(num_anns):
+        x, y, w, h = boxes[k].tolist()
+        if seg == 'polygon':
+            # Octagon inscribed in the box
+            t = np.arange(8) * np.pi / 4
+            poly = np.stack((x + w / 2 * (1 + np.cos(t)),
+                             y + h / 2 * (1 + np.sin(t))), axis=1)
+            segmentation = [poly.round(2).ravel().tolist()]
+        elif seg == 'rle':
+            rle = mask.frPyObjects([[x, y, x + w, y, x + w, y + h, x, y + h]],
+                                   height, width)[0]
+            segmentation = {'size': rle['size'],
+                            'counts': rle['counts'].decode('ascii')}
+        else:
+            segmentation = []
+        annotations.append({'id': k + 1,
+                            'image_id': int(img_ids[k]),
+                            'category_id': int(cat_ids[k]),
+                            'segmentation': segmentation,
+                            'area': float(w * h),
+                            'bbox': [x, y, w, h],
+                            'iscrowd': 0,
+                            'distance': float(distances[k])})
+
+    pointclouds = []
+    if pc_points:
+        for i in range(num_imgs):
+            points = rng.uniform(-50, 50, (pc_points, 3)).round(3)
+            pointclouds.append({'id': i + 1, 'img_id': i + 1,
+                                'points': points.tolist()})
+
+    return {'info': {'description': 'synthetic', 'version': '1.0'},
+            'licenses': [{'id': 0, 'name': '', 'url': ''}],
+            'categories': categories,
+            'images': images,
+            'annotations': annotations,
+            'pointclouds': pointclouds}
+
+
+def make_detections(dataset, recall=0.9, false_positives=0.2, jitter=0.1,
+                    seed=0):
+    """
+    Generate synthetic detections for a dataset: a fraction of the ground
+    truth boxes, jittered, plus random false positives.
+
+    :return (list): detections in the COCO results format
+    """
+
+    rng = np.random.RandomState(seed)
+    anns = dataset['annotations']
+    keep = np.flatnonzero(rng.uniform(0, 1, len(anns)) < recall)
+    boxes = np.array([anns[k]['bbox'] for k in keep],
+                     dtype=np.float64).reshape(-1, 4)
+    boxes[:, :2] += rng.normal(0, jitter, (len(keep), 2)) * boxes[:, 2:]
+    boxes[:, 2:] *= np.exp(rng.normal(0, jitter, (len(keep), 2)))
+    dets = [{'image_id': anns[k]['image_id'],
+             'category_id': anns[k]['category_id'],
+             'bbox': box,
+             'score': float(score)}
+            for k, box, score in zip(keep.tolist(), boxes.round(2).tolist(),
+                                     rng.uniform(0.3, 1, len(keep)))]
+
+    num_fp = int(false_positives * len(anns))
+    img_ids = rng.choice([img['id'] for img in dataset['images']], num_fp)
+    cat_ids = rng.choice([cat['id'] for cat in dataset['categories']], num_fp)
+    boxes = rng.uniform(0, 200, (num_fp, 4)).round(2)
+    dets.extend({'image_id': int(i), 'category_id': int(c),
+                 'bbox': box, 'score': float(s)}
+                for i, c, box, s in zip(img_ids, cat_ids, boxes.tolist(),
+                                        rng.uniform(0, 0.6, num_fp)))
+    return dets
+
+
+def write_dataset(path, **kwargs):
+    """
+    Generate a synthetic dataset and save it as an annotation file.
+    :param kwargs: make_dataset arguments
+    :return (dict): the dataset
+    """
+
+    dataset = make_dataset(**kwargs)
+    with open(path, 'w') as f:
+        json.dump(dataset, f)
+    return dataset
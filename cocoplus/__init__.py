@@ -1 +1,2 @@
-from .coco import COCO_PLUS
\ No newline at end of file
+from .coco import COCO_PLUS
+from .sqlite_backend import COCO_PLUS_SQL
\ No newline at end of file
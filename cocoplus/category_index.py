@@ -0,0 +1,165 @@
+"""
+Category index of a COCO_PLUS dataset: deduplicated image ID arrays per
+category, supercategory maps and cached multi-category queries.
+
+"""
+
+from collections import OrderedDict
+
+import numpy as np
+
+
+class CategoryIndex(object):
+    """
+    Query index over the categories of a dataset.
+
+    Image ID arrays are sorted, deduplicated and read-only. They are built on
+    first use and cached, as are the results of the most recent intersect()
+    and union() queries. The dataset invalidates a category when the set of
+    images containing it changes, which bumps its version so that the cached
+    queries using it are recomputed.
+    """
+
+    def __init__(self, coco, max_queries=1024):
+        """
+        :param coco (COCO_PLUS): the indexed dataset
+        :param max_queries (int): number of query results kept, the least
+            recently used are evicted
+        """
+
+        self.coco = coco
+        self.max_queries = max_queries
+        self.reset()
+
+    ##-------------------------------------------------------------------------
+    def reset(self):
+        """
+        Drop all the cached arrays and maps.
+        """
+
+        self._imgs = {}
+        self._versions = {}
+        self._queries = OrderedDict()
+        self._supercats = None
+
+    ##-------------------------------------------------------------------------
+    def invalidate(self, cat_id):
+        """
+        Mark the images of a category as changed.
+        """
+
+        self._imgs.pop(cat_id, None)
+        self._versions[cat_id] = self._versions.get(cat_id, 0) + 1
+
+    def invalidateCats(self):
+        """
+        Mark the categories themselves (names, supercategories) as changed.
+        """
+
+        self._supercats = None
+
+    ##-------------------------------------------------------------------------
+    def imgIds(self, cat_id):
+        """
+        :return (nparray): sorted IDs of the images with the category
+        """
+
+        ids = self._imgs.get(cat_id)
+        if ids is None:
+            counts = getattr(self.coco.catToImgs, 'counts', None)
+            if counts is not None:
+                cat_counts = counts.get(cat_id, {})
+                ids = np.sort(np.fromiter(cat_counts, dtype=np.int64,
+                                          count=len(cat_counts)))
+            else:
+                ids = np.unique(np.asarray(self.coco.catToImgs.get(cat_id, []),
+                                           dtype=np.int64))
+            ids.setflags(write=False)
+            self._imgs[cat_id] = ids
+        return ids
+
+    def numImgs(self, cat_id):
+        """
+        :return (int): number of images with the category
+        """
+
+        return len(self.imgIds(cat_id))
+
+    ##-------------------------------------------------------------------------
+    def _query(self, op, cat_ids):
+        cat_ids = tuple(sorted(set(cat_ids)))
+        versions = tuple(self._versions.get(c, 0) for c in cat_ids)
+        key = (op, cat_ids)
+        cached = self._queries.get(key)
+        if cached is not None and cached[0] == versions:
+            self._queries.move_to_end(key)
+            return cached[1]
+
+        arrays = sorted((self.imgIds(c) for c in cat_ids), key=len)
+        if not arrays:
+            ids = np.zeros(0, dtype=np.int64)
+        elif op == 'and':
+            ids = arrays[0]
+            for other in arrays[1:]:
+                ids = np.intersect1d(ids, other, assume_unique=True)
+        else:
+            ids = np.unique(np.concatenate(arrays))
+        if ids.flags.writeable:
+            ids.setflags(write=False)
+        self._queries[key] = (versions, ids)
+        self._queries.move_to_end(key)
+        while len(self._queries) > self.max_queries:
+            self._queries.popitem(last=False)
+        return ids
+
+    def intersect(self, cat_ids):
+        """
+        :return (nparray): sorted IDs of the images with all the categories
+        """
+
+        return self._query('and', cat_ids)
+
+    def union(self, cat_ids):
+        """
+        :return (nparray): sorted IDs of the images with any of the categories
+        """
+
+        return self._query('or', cat_ids)
+
+    ##-------------------------------------------------------------------------
+    def supercategories(self):
+        """
+        :return (dict): supercategory -> sorted list of category IDs
+        """
+
+        if self._supercats is None:
+            supercats = {}
+            for cat in self.coco.cats.values():
+                supercats.setdefault(cat.get('supercategory'), []).append(cat['id'])
+            self._supercats = {k: sorted(v) for k, v in supercats.items()}
+        return self._supercats
+
+    def catIdsByName(self, names):
+        """
+        :return (list): IDs of the categories with the given names, unknown
+            names are skipped
+        """
+
+        name_to_id = self.coco.catNameToId
+        return [name_to_id[n] for n in names if n in name_to_id]
+
+    def catIdsBySupercategory(self, supercats):
+        """
+        :return (list): sorted IDs of the categories of the supercategories
+        """
+
+        index = self.supercategories()
+        return sorted(c for s in supercats for c in index.get(s, []))
+
+    def imgIdsBySupercategory(self, supercat):
+        """
+        :return (nparray): sorted IDs of the images with any category of a
+            supercategory
+        """
+
+        return self.union(self.supercategories().get(supercat, []))
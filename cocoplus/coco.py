@@ -3,23 +3,65 @@ An enhanced interface for the Microsoft COCO dataset.
 
 """
 
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 import json
-import cv2
-import types
 import datetime
 import time
 import pprint
-from tqdm import tqdm
-from pycocotools.coco import COCO
+import itertools
+import concurrent.futures as futures
+from pycocotools.coco import COCO, _isArrayLike
 from pycocotools import mask
-from collections import defaultdict
-from matplotlib.patches import Polygon
-from matplotlib.collections import PatchCollection
-from cocoplus.utils import log
-from cocoplus.utils.coco_utils import show_class_name_plt
+from collections import defaultdict, Counter
+from cocoplus.utils import log, metrics
+from cocoplus.utils.lazy import lazy_import
+from cocoplus.utils.coco_utils import show_class_name_plt, draw_xywh_bbox, get_image_size
+from cocoplus.utils.image_cache import ImageCache
+from cocoplus.loader import SampleIterator
+from cocoplus.storage import ImageShards, shard_index_path, SHARD_SIZE
+from cocoplus.dedup import HashIndex, build_hash_index, dhash, dhash_file
+from cocoplus.shared_index import export_shared_index
+from cocoplus.validate import validate_dataset
+from cocoplus.export import export_dataset
+from cocoplus.category_index import CategoryIndex
+from cocoplus.sampler import Sampler
+
+## Image I/O and visualization dependencies are imported on first use
+cv2 = lazy_import('cv2', 'opencv-python')
+plt = lazy_import('matplotlib.pyplot', 'matplotlib')
+patches = lazy_import('matplotlib.patches', 'matplotlib')
+mpl_collections = lazy_import('matplotlib.collections', 'matplotlib')
+
+## Shared by all the datasets, each instance filters with its own level
+_logger = log.getLogger(__name__, console_level='DEBUG')
+
+def _popFields(obj, fields):
+    for field in fields:
+        obj.pop(field, None)
+
+
+class _CatToImgs(defaultdict):
+    """
+    catToImgs index with lazy compaction. Removing annotations only updates
+    the per-category image counts and marks the category dirty, its image
+    list is rebuilt from the counts on the next access.
+    """
+
+    def __init__(self, counts, items=()):
+        super(_CatToImgs, self).__init__(list, items)
+        self.counts = counts
+        self.dirty = set()
+
+    def __getitem__(self, cat_id):
+        if cat_id in self.dirty:
+            self.dirty.discard(cat_id)
+            self[cat_id] = list(self.counts[cat_id].elements())
+        return super(_CatToImgs, self).__getitem__(cat_id)
+
+    def get(self, cat_id, default=None):
+        return self[cat_id] if cat_id in self else default
+
 
 class COCO_PLUS(COCO):
 
@@ -32,30 +74,53 @@ class COCO_PLUS(COCO):
 
     def __init__(self, 
                  annotation_file=None, 
-                 logging_level="INFO"):
+                 logging_level="INFO",
+                 imgs_dir=None,
+                 img_cache_size=0):
         """
         :param annotation_file (str): an existing coco annotation file
         :param logging_level (str): set the logging level (DEBUG, INFO, WARN, ERROR, CRITICAL)
+        :param imgs_dir (str): directory of the dataset images
+        :param img_cache_size (int): size in bytes of the decoded image cache,
+            0 to disable it
         """
 
-        self.logger = log.getLogger(__name__, console_level=logging_level)
+        # The module logger is shared, the level is scoped to this instance
+        self.logger = log.LevelAdapter(_logger, logging_level)
         self.annotation_file = annotation_file
+        self.imgs_dir = imgs_dir
+        self.img_cache = ImageCache(img_cache_size) if img_cache_size else None
+        self.img_shards = None
+        self.dup_index, self.dup_policy, self.duplicates = None, None, []
         self.pointclouds, self.imgToPc = dict(), dict()
-        self.imgToAnns, self.catToImgs = defaultdict(list), defaultdict(list)
+        self.imgToAnns = defaultdict(list)
+        self.catToImgs = _CatToImgs(defaultdict(Counter))
+        self._pos = dict()
         self.dataset, self.anns, self.cats, self.imgs = dict(), dict(), dict(), dict()
+        self.catIndex = CategoryIndex(self)
+        # Number of changes since the dataset was loaded or saved
+        self.revision = 0
 
         if not annotation_file == None:
             self.logger.info('loading COCO annotations into memory...')
             tic = time.time()
-            dataset = json.load(open(annotation_file, 'r'))
+            with metrics.span('coco.loadJson'):
+                dataset = json.load(open(annotation_file, 'r'))
             assert type(dataset)==dict, \
                 'annotation file format {} not supported'.format(type(dataset))
             
-            self.logger.info('Done (t={:0.2f}s)'.format(time.time()- tic))
+            self.logger.info('Done (t=%0.2fs)', time.time() - tic)
             self.dataset = dataset
             self.createIndex()
+            self.revision = 0
+
+            ## Use the packed image shards if the dataset has them
+            index_path = shard_index_path(annotation_file)
+            if os.path.exists(index_path):
+                self.img_shards = ImageShards(index_path)
     
     ##-------------------------------------------------------------------------
+    @metrics.timed('coco.createIndex')
     def createIndex(self):
         """
         Create index for the annotations
@@ -75,9 +140,19 @@ class COCO_PLUS(COCO):
             for cat in self.dataset['categories']:
                 catNameToId[cat['name']] = cat['id']
 
+        # Image counts of every category, to update catToImgs incrementally
+        catImgCounts = defaultdict(Counter)
+        for ann in self.anns.values():
+            catImgCounts[ann['category_id']][ann['image_id']] += 1
+
         self.catNameToId = catNameToId
         self.pointclouds = pointclouds
         self.imgToPc = imgToPc
+        self.catToImgs = _CatToImgs(catImgCounts, self.catToImgs)
+        self._pos = dict()
+        self.catIndex.reset()
+        self.revision += 1
+        metrics.count('annotations_indexed', len(self.anns))
         self.logger.info('index created.')
 
     ##-------------------------------------------------------------------------
@@ -92,7 +167,9 @@ class COCO_PLUS(COCO):
                            date_created="",
                            license_url="",
                            license_id=0,
-                           license_name=""
+                           license_name="",
+                           storage="files",
+                           shard_size=SHARD_SIZE
                            ):
         """
         Create a new COCO-style dataset
@@ -107,12 +184,15 @@ class COCO_PLUS(COCO):
         :param license_url (str):
         :param license_id (int):
         :param license_name (str):
+        :param storage (str): 'files' to write one file per image, 'shards'
+            to pack the images in large shard files
+        :param shard_size (int): maximum size of a shard file in bytes
         """
 
         self.dataset_dir = os.path.abspath(dataset_dir)
-        self.logger.info('Creating empty COCO dataset in {}'.format(self.dataset_dir))
-        assert self.annotation_file is None, \
-            "COCO dataset is already initialized with the annotation file: {}".format(self.annotation_file)
+        self.logger.info('Creating empty COCO dataset in %s', self.dataset_dir)
+        self._checkNewDataset()
+        assert storage in ['files', 'shards'], "Storage not supported."
         
         ## Create the dataset directory
         self.imgs_dir = os.path.join(dataset_dir, split)
@@ -122,8 +202,13 @@ class COCO_PLUS(COCO):
 
         self.annotation_file = os.path.join(anns_dir, 
                                             "instances_{}.json".format(split))        
+        if storage == 'shards':
+            self.img_shards = ImageShards(shard_index_path(self.annotation_file),
+                                          shards_dir=self.imgs_dir,
+                                          shard_size=shard_size)
         ## Create class members
         self.catNameToId = {}
+        self.catIndex.reset()
         self.pointclouds = {}
         self.imgToPc = {}
         self.dataset = {'annotations':[], 'images':[], 'categories':[], 'pointclouds':[]}
@@ -141,6 +226,16 @@ class COCO_PLUS(COCO):
 
 
     ##-------------------------------------------------------------------------
+    def _checkNewDataset(self):
+        """
+        Check that no dataset is loaded before creating a new one.
+        """
+
+        assert self.annotation_file is None, \
+            "COCO dataset is already initialized with the annotation file: {}".format(self.annotation_file)
+
+    ##-------------------------------------------------------------------------
+    @metrics.timed('coco.addSample')
     def addSample(self,
                   img, 
                   anns, 
@@ -148,23 +243,180 @@ class COCO_PLUS(COCO):
                   img_id=None,
                   img_format='BGR', 
                   write_img=True,
-                  other=None):
+                  other=None,
+                  img_ext='.jpg',
+                  jpeg_quality=None,
+                  png_compression=None,
+                  max_size=None,
+                  img_size=None):
         """
         Add a new sample (image + annotations [+ pointcloud]) to the dataset.
 
-        :param img (nparray)
+        :param img (nparray or str): the image, or the path of an existing
+            image file. Existing files are registered without being decoded,
+            they are copied to the image directory (or shards) only if they
+            are not already in it, and must be in it if write_img is False.
         :param anns (list of dict)
         :param pointcloud (list): list of the points in the pointcloud
         :param img_id (int): image ID 
         :param img_format (str): 'BGR' or 'RGB'
-        :param write_img (bool): save the image to the image directory
+        :param write_img (bool): save the image to the image directory, or to
+            the image shards if the dataset uses them
         :param other (dict): any additional information to be stored in img_info
+        :param img_ext (str): image file format, e.g. '.jpg', '.png', '.webp'
+        :param jpeg_quality (int): JPEG/WebP quality (0-100), OpenCV default if None
+        :param png_compression (int): PNG compression level (0-9), OpenCV
+            default if None
+        :param max_size (int): downscale the image so that its longest side
+            is at most max_size pixels. The annotations are scaled accordingly.
+        :param img_size (tuple): (height, width) of an image given by path,
+            read from the file header if None
+        :return (str): path of the image file (nominal when using shards), or
+            None if the sample was skipped as a near-duplicate
         """
 
-        # Sanity check
         assert img_format in ['BGR','RGB'], "Image format not supported."
+        img_id, img, img_path = self._addSampleInfo(img, anns,
+                                                    pointcloud=pointcloud,
+                                                    img_id=img_id,
+                                                    write_img=write_img,
+                                                    other=other,
+                                                    img_ext=img_ext,
+                                                    max_size=max_size,
+                                                    img_size=img_size)
+        if img_id is None:
+            return None
+        if write_img:
+            data = self._encodeImg(img, img_path, img_format, img_ext,
+                                   jpeg_quality, png_compression)
+            self._storeImg(img_id, data, img_path)
+        
+        return img_path
+
+    ##-------------------------------------------------------------------------
+    @metrics.timed('coco.addSamples')
+    def addSamples(self,
+                   samples,
+                   num_threads=8,
+                   img_format='BGR',
+                   write_img=True,
+                   img_ext='.jpg',
+                   jpeg_quality=None,
+                   png_compression=None,
+                   max_size=None):
+        """
+        Add many samples, encoding and writing the images on a thread pool.
+        Samples are indexed in order on the calling thread.
+
+        :param samples (iterable of dict): keyword arguments of addSample for
+            each sample, i.e. 'img', 'anns' and optionally 'pointcloud',
+            'img_id', 'other' and 'img_size'
+        :param num_threads (int): number of encoding threads
+        :param img_format, write_img, img_ext, jpeg_quality, png_compression,
+            max_size: same as addSample, applied to all the samples
+        :return (list): paths of the image files, None for the samples
+            skipped as near-duplicates
+        """
+
+        assert img_format in ['BGR','RGB'], "Image format not supported."
+
+        def _encode(item):
+            img_id, img, img_path = item
+            return img_id, self._encodeImg(img, img_path, img_format, img_ext,
+                                           jpeg_quality, png_compression), img_path
+
+        def _encodeAndStore(item):
+            self._storeImg(*_encode(item))
+
+        img_paths = []
+        chunk = 16 * num_threads
+        samples = iter(samples)
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+            while True:
+                items = [self._addSampleInfo(write_img=write_img,
+                                             img_ext=img_ext,
+                                             max_size=max_size,
+                                             **sample)
+                         for sample in itertools.islice(samples, chunk)]
+                if not items:
+                    break
+                img_paths.extend(img_path for _, _, img_path in items)
+                items = [item for item in items if item[0] is not None]
+                if not write_img:
+                    continue
+
+                if self.img_shards is not None:
+                    # Shards are appended sequentially, in order
+                    for encoded in pool.map(_encode, items):
+                        self._storeImg(*encoded)
+                else:
+                    list(pool.map(_encodeAndStore, items))
+
+        return img_paths
+
+    ##-------------------------------------------------------------------------
+    def addImageFiles(self, img_paths, anns=None, num_threads=16, **kwargs):
+        """
+        Register existing image files as new samples. The image sizes are read
+        from the file headers on a thread pool, the images are not decoded.
+
+        :param img_paths (list of str): image file paths
+        :param anns (list of list of dict): annotations for each image, no
+            annotations if None
+        :param num_threads (int): number of threads reading the file headers
+        :param kwargs: other addSample arguments, applied to all the images
+        :return (list): IDs of the new images, None for the images skipped
+            as near-duplicates
+        """
+
+        if anns is None:
+            anns = [[] for _ in img_paths]
+        assert len(anns) == len(img_paths), \
+            "Annotations must be provided for every image."
+
+        with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+            sizes = list(pool.map(get_image_size, img_paths))
+
+        img_ids = []
+        for img_path, img_anns, size in zip(img_paths, anns, sizes):
+            img_id = self._getNewImgId()
+            if self.addSample(img_path, img_anns, img_id=img_id, img_size=size,
+                              **kwargs) is None:
+                img_id = None
+            img_ids.append(img_id)
+
+        return img_ids
+
+    ##-------------------------------------------------------------------------
+    def _addSampleInfo(self,
+                       img,
+                       anns,
+                       pointcloud=None,
+                       img_id=None,
+                       write_img=True,
+                       other=None,
+                       img_ext='.jpg',
+                       max_size=None,
+                       img_size=None):
+        """
+        Add the image info, annotations and pointcloud of a new sample to the
+        dataset and index, without writing the image.
+        :return (tuple): (img_id, image array or source path, image path), all
+            None if the sample is skipped as a near-duplicate
+        """
+
+        # Sanity check
         assert isinstance(anns, (list,)), "Annotations must be provided in a list."
-        assert isinstance(img, np.ndarray), "Image must be a numpy array."
+        assert isinstance(img, (np.ndarray, str)), \
+            "Image must be a numpy array or a file path."
+
+        if self.dup_index is not None:
+            img_hash = dhash_file(img) if isinstance(img, str) else dhash(img)
+            matches = self.dup_index.query(img_hash)
+            if matches and self.dup_policy == 'skip':
+                self.logger.debug('Skipping near-duplicate of image %s',
+                                  matches[0][0])
+                return None, None, None
 
         if img_id is None:
             img_id = self._getNewImgId()
@@ -172,15 +424,54 @@ class COCO_PLUS(COCO):
             assert isinstance(img_id, int), "Image ID must be an integer."
             assert img_id not in self.imgs, "Image ID {} already exists.".format(img_id)
 
+        if isinstance(img, str) and max_size is not None:
+            # Resizing needs the decoded image
+            img_path, img = img, cv2.imread(img, cv2.IMREAD_COLOR)
+            if img is None:
+                raise IOError("Could not read image {}".format(img_path))
+
+        if isinstance(img, str):
+            heigth, width = img_size if img_size else get_image_size(img)
+            # file_name is relative to imgs_dir, files outside of it are
+            # copied in under a new name
+            rel_path = os.path.relpath(os.path.abspath(img), self.imgs_dir) \
+                if self.imgs_dir is not None else None
+            inside = rel_path is not None and rel_path != os.pardir and \
+                not rel_path.startswith(os.pardir + os.sep)
+            assert write_img or inside, \
+                "Image {} is not in the image directory, it must be written " \
+                "(write_img=True).".format(img)
+            if inside and self.img_shards is None:
+                # Register the file where it is
+                filename = rel_path
+            else:
+                filename = self.imId2name(img_id, os.path.splitext(img)[1])
+        else:
+            heigth, width = img.shape[:2]
+            if max_size is not None and max(heigth, width) > max_size:
+                scale = max_size / float(max(heigth, width))
+                img = cv2.resize(img, None, fx=scale, fy=scale,
+                                 interpolation=cv2.INTER_AREA)
+                heigth, width = img.shape[:2]
+                self._scaleAnns(anns, scale)
+            filename = self.imId2name(img_id, img_ext)
+
         # Create the image info
-        heigth, width, _ = img.shape
         img_info = self._createImageInfo(height=heigth, 
                                          width=width, 
                                          img_id=img_id,
-                                         other=other)
+                                         other=other,
+                                         filename=filename)
         # Update the dataset and index
-        self.dataset['images'].append(img_info)
-        self.imgs[img_id] = img_info
+        self._insertImg(img_info)
+
+        if self.dup_index is not None:
+            for dup_id, dist in matches:
+                self.duplicates.append((img_id, dup_id, dist))
+            if matches:
+                self.logger.warning('Image %s is a near-duplicate of image %s',
+                                    img_id, matches[0][0])
+            self.dup_index.add(img_id, img_hash)
         
         ## Add the new annotations to dataset
         for ann in anns:
@@ -192,10 +483,7 @@ class COCO_PLUS(COCO):
                 ann['id'] = self._getNewAnnId()
 
             # Update the dataset and index
-            self.dataset['annotations'].append(ann)
-            self.anns[ann['id']] = ann
-            self.catToImgs[ann['category_id']].append(ann['image_id'])
-            self.imgToAnns[img_id].append(ann)
+            self._insertAnn(ann)
 
         ## Add the pointcloud to the dataset if applicable
         if pointcloud is not None:
@@ -206,22 +494,439 @@ class COCO_PLUS(COCO):
                   'img_id': img_id,
                   'points': pointcloud}
 
-            self.dataset['pointclouds'].append(pc)
-            self.pointclouds[pc_id] = pc
-            self.imgToPc[img_id] = pc
+            self._insertPc(pc)
         
             if self.imgs[img_id]['id'] != pc['img_id']:
                 raise Exception("Image ID not matching the corresponding pointcloud")
 
-        img_path = os.path.join(self.imgs_dir, img_info['file_name'])
-        
-        if write_img:
-            ## Write the image to disk        
-            if img_format == 'RGB':
-                img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
-            cv2.imwrite(img_path, img)
+        if self.imgs_dir is not None:
+            img_path = os.path.join(self.imgs_dir, img_info['file_name'])
+        else:
+            img_path = img_info['file_name']
+
+        metrics.count('samples_added')
+        return img_id, img, img_path
+
+    ##-------------------------------------------------------------------------
+    def _insertImg(self, img_info):
+        """
+        Add an image info to the dataset and index.
+        """
+
+        self._appendToList('images', img_info)
+        self.imgs[img_info['id']] = img_info
+
+    ##-------------------------------------------------------------------------
+    def _insertAnn(self, ann):
+        """
+        Add an annotation to the dataset and index.
+        """
+
+        self._appendToList('annotations', ann)
+        self.anns[ann['id']] = ann
+        self._addCatImg(ann['category_id'], ann['image_id'])
+        self.imgToAnns[ann['image_id']].append(ann)
+        metrics.count('annotations_indexed')
+
+    ##-------------------------------------------------------------------------
+    def _addCatImg(self, cat_id, img_id):
+        """
+        Count one more annotation of a category in an image.
+        """
+
+        cat_counts = self.catToImgs.counts[cat_id]
+        self.catToImgs[cat_id].append(img_id)
+        cat_counts[img_id] += 1
+        if cat_counts[img_id] == 1:
+            self.catIndex.invalidate(cat_id)
+
+    def _removeCatImg(self, cat_id, img_id):
+        """
+        Count one less annotation of a category in an image. catToImgs is
+        compacted lazily.
+        """
+
+        counts = self.catToImgs.counts[cat_id]
+        counts[img_id] -= 1
+        if counts[img_id] <= 0:
+            del counts[img_id]
+            self.catIndex.invalidate(cat_id)
+        self.catToImgs.dirty.add(cat_id)
+
+    def _removeImgAnn(self, img_id, ann_id):
+        img_anns = self.imgToAnns.get(img_id, [])
+        for i, img_ann in enumerate(img_anns):
+            if img_ann['id'] == ann_id:
+                del img_anns[i]
+                break
+
+    ##-------------------------------------------------------------------------
+    def _insertPc(self, pc):
+        """
+        Add a pointcloud to the dataset and index.
+        """
+
+        self._appendToList('pointclouds', pc)
+        self.pointclouds[pc['id']] = pc
+        self.imgToPc[pc['img_id']] = pc
+
+    ##-------------------------------------------------------------------------
+    def _insertCat(self, cat):
+        """
+        Add a category to the dataset and index.
+        """
+
+        self._appendToList('categories', cat)
+        self.catNameToId[cat['name']] = cat['id']
+        self.cats[cat['id']] = cat
+        self.catIndex.invalidateCats()
+
+    ##-------------------------------------------------------------------------
+    def _deleteImg(self, img_info):
+        """
+        Remove an image info from the dataset and index.
+        """
+
+        self._removeFromList('images', img_info['id'])
+        del self.imgs[img_info['id']]
+        self.imgToAnns.pop(img_info['id'], None)
+
+    ##-------------------------------------------------------------------------
+    def _deleteAnn(self, ann):
+        """
+        Remove an annotation from the dataset and index.
+        """
+
+        ann_id, img_id, cat_id = ann['id'], ann['image_id'], ann['category_id']
+        self._removeFromList('annotations', ann_id)
+        del self.anns[ann_id]
+        self._removeImgAnn(img_id, ann_id)
+        self._removeCatImg(cat_id, img_id)
+
+    ##-------------------------------------------------------------------------
+    def _deletePc(self, pc):
+        """
+        Remove a pointcloud from the dataset and index.
+        """
+
+        self._removeFromList('pointclouds', pc['id'])
+        del self.pointclouds[pc['id']]
+        self.imgToPc.pop(pc['img_id'], None)
+
+    ##-------------------------------------------------------------------------
+    def _deleteCat(self, cat):
+        """
+        Remove a category from the dataset and index.
+        """
+
+        self._removeFromList('categories', cat['id'])
+        del self.cats[cat['id']]
+        self.catNameToId.pop(cat['name'], None)
+        self.catToImgs.pop(cat['id'], None)
+        self.catToImgs.counts.pop(cat['id'], None)
+        self.catToImgs.dirty.discard(cat['id'])
+        self.catIndex.invalidate(cat['id'])
+        self.catIndex.invalidateCats()
+
+    ##-------------------------------------------------------------------------
+    def _updateAnn(self, ann, fields, removed=()):
+        """
+        Update the fields of an annotation in place, and the index if
+        needed. The annotation keeps its position in the dataset.
+        :param removed (list): names of the fields to delete
+        """
+
+        img_id, cat_id = ann['image_id'], ann['category_id']
+        ann.update(fields)
+        _popFields(ann, removed)
+        self.revision += 1
+        if ann['image_id'] != img_id:
+            self._removeImgAnn(img_id, ann['id'])
+            self.imgToAnns[ann['image_id']].append(ann)
+        if (ann['image_id'], ann['category_id']) != (img_id, cat_id):
+            self._removeCatImg(cat_id, img_id)
+            self._addCatImg(ann['category_id'], ann['image_id'])
+
+    ##-------------------------------------------------------------------------
+    def _updateImg(self, img_info, fields, removed=()):
+        img_info.update(fields)
+        _popFields(img_info, removed)
+        self.revision += 1
+
+    def _updatePc(self, pc, fields):
+        pc.update(fields)
+        self.revision += 1
+
+    def _updateCat(self, cat, fields, removed=()):
+        self.catNameToId.pop(cat['name'], None)
+        cat.update(fields)
+        _popFields(cat, removed)
+        self.revision += 1
+        self.catNameToId[cat['name']] = cat['id']
+        self.catIndex.invalidateCats()
+
+    ##-------------------------------------------------------------------------
+    def _sourceSignature(self):
+        """
+        Identifies the saved state of the dataset, to key the caches derived
+        from it without reading the annotations.
+        :return (list): path, size and modification time of the annotation
+            file, None if the dataset has changes not saved to it
+        """
+
+        if self.revision or self.annotation_file is None or \
+                not os.path.exists(self.annotation_file):
+            return None
+        stat = os.stat(self.annotation_file)
+        return [os.path.abspath(self.annotation_file), stat.st_size, stat.st_mtime_ns]
+
+    ##-------------------------------------------------------------------------
+    def _iterObjects(self, table):
+        """
+        Iterate over the objects of a dataset table, e.g. 'annotations'.
+        """
+
+        return iter(self.dataset.get(table, []))
+
+    ##-------------------------------------------------------------------------
+    def _appendToList(self, name, obj):
+        """
+        Append an object to a dataset list, keeping its position map in sync.
+        """
+
+        objs = self.dataset[name]
+        if name in self._pos:
+            self._pos[name][obj['id']] = len(objs)
+        objs.append(obj)
+        self.revision += 1
+
+    ##-------------------------------------------------------------------------
+    def _removeFromList(self, name, obj_id):
+        """
+        Remove an object from a dataset list in O(1), by moving the last
+        object in its place. The id -> position map of the list is built on
+        the first removal.
+        """
+
+        objs = self.dataset[name]
+        if name not in self._pos:
+            self._pos[name] = {obj['id']: i for i, obj in enumerate(objs)}
+        pos = self._pos[name]
+
+        i = pos.pop(obj_id)
+        last = objs.pop()
+        if i < len(objs):
+            objs[i] = last
+            pos[last['id']] = i
+        self.revision += 1
+
+    ##-------------------------------------------------------------------------
+    def enableDuplicateIndex(self, radius=4, policy='report', num_workers=4):
+        """
+        Maintain a perceptual hash index of the images to detect near-duplicate
+        samples as they are added. The images already in the dataset are
+        hashed on a process pool, and their near-duplicates reported.
+
+        :param radius (int): maximum Hamming distance between the 64-bit
+            hashes of near-duplicate images
+        :param policy (str): 'report' to add near-duplicates and record them
+            in self.duplicates, 'skip' to not add them
+        :param num_workers (int): number of processes hashing existing images
+        :return (list): (img_id, duplicate_of, distance) tuples of the
+            near-duplicates found so far
+        """
+
+        assert policy in ['report', 'skip'], "Policy not supported."
+        self.dup_policy = policy
+        if self.imgs:
+            self.dup_index = build_hash_index(self, radius=radius,
+                                              num_workers=num_workers)
+            self.duplicates = [(img_id, dup_id, dist) for dup_id, img_id, dist
+                               in self.dup_index.duplicates()]
+        else:
+            self.dup_index = HashIndex(radius=radius)
+            self.duplicates = []
+
+        return self.duplicates
+
+    ##-------------------------------------------------------------------------
+    @metrics.timed('coco.encodeImg')
+    def _encodeImg(self, img, img_path, img_format='BGR', img_ext='.jpg',
+                   jpeg_quality=None, png_compression=None):
+        """
+        Encode an image for storage.
+        :param img (nparray or str): the image, or the path of an image file
+        :param img_path (str): destination path of the image
+        :return (bytes): the encoded image, None if the image file is
+            already at its destination
+        """
+
+        assert img_format in ['BGR','RGB'], "Image format not supported."
+
+        if isinstance(img, str):
+            if self.img_shards is None and \
+                    os.path.abspath(img) == os.path.abspath(img_path):
+                return None
+            with open(img, 'rb') as f:
+                return f.read()
+
+        params = []
+        ext = img_ext.lower()
+        if jpeg_quality is not None and ext in ('.jpg', '.jpeg'):
+            params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+        elif jpeg_quality is not None and ext == '.webp':
+            params = [cv2.IMWRITE_WEBP_QUALITY, int(jpeg_quality)]
+        elif png_compression is not None and ext == '.png':
+            params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+
+        if img_format == 'RGB':
+            img = cv2.cvtColor(img, cv2.COLOR_RGB2BGR)
+        ok, buf = cv2.imencode(img_ext, img, params)
+        if not ok:
+            raise IOError("Could not encode image as {}".format(img_ext))
+        metrics.count('images_encoded')
+        return buf.tobytes()
+
+    ##-------------------------------------------------------------------------
+    def _storeImg(self, img_id, data, img_path):
+        """
+        Write an encoded image to the image shards or to its file.
+        """
+
+        if data is None:
+            return
+        metrics.count('bytes_written', len(data))
+        if self.img_shards is not None:
+            self.img_shards.write(img_id, data)
+        else:
+            with open(img_path, 'wb') as f:
+                f.write(data)
+
+    ##-------------------------------------------------------------------------
+    @staticmethod
+    def _scaleAnns(anns, scale):
+        """
+        Scale the boxes, areas and polygon segmentations of annotations in place.
+        """
+
+        for ann in anns:
+            ann['bbox'] = [float(format(elem * scale, '.2f')) for elem in ann['bbox']]
+            ann['area'] = np.float32(ann['area'] * scale * scale).tolist()
+            seg = ann.get('segmentation')
+            if isinstance(seg, list):
+                ann['segmentation'] = [[elem * scale for elem in poly]
+                                       for poly in seg]
+            elif seg:
+                raise AssertionError("RLE segmentations cannot be rescaled.")
+
+    ##-------------------------------------------------------------------------
+    def loadImg(self, img_id, imgs_dir=None, resize=None, img_format='BGR',
+                preview=False):
+        """
+        Read and decode the image of a sample. If the image cache is enabled
+        the returned image is shared with the cache and is read-only.
+
+        :param img_id (int): image ID
+        :param imgs_dir (str): image directory, defaults to self.imgs_dir
+        :param resize: resize the image on decode, either a scale factor
+            (float) or a (width, height) tuple
+        :param img_format (str): 'BGR' or 'RGB'
+        :param preview (bool): for display only, the image may be the
+            downscaled preview of the image cache (see ImageCache max_dim)
+        :return (nparray): the decoded image
+        """
+
+        assert img_format in ['BGR','RGB'], "Image format not supported."
+        if self.img_cache is not None:
+            key = (img_id, tuple(resize) if isinstance(resize, (list, tuple))
+                   else resize, img_format)
+            img = self.img_cache.get(key, preview)
+            if img is None:
+                img = self.img_cache.put(
+                    key, self._decodeImg(img_id, imgs_dir, resize, img_format),
+                    preview)
+            return img
+
+        return self._decodeImg(img_id, imgs_dir, resize, img_format)
+
+    ##-------------------------------------------------------------------------
+    def _decodeImg(self, img_id, imgs_dir, resize, img_format):
+        """
+        Read and decode an image, bypassing the image cache.
+        """
+
+        # JPEG can be decoded directly at 1/2, 1/4 and 1/8 of the resolution
+        reduced = {0.5: cv2.IMREAD_REDUCED_COLOR_2,
+                   0.25: cv2.IMREAD_REDUCED_COLOR_4,
+                   0.125: cv2.IMREAD_REDUCED_COLOR_8}
+        if isinstance(resize, float) and resize in reduced:
+            flags = reduced[resize]
+            resize = None
+        else:
+            flags = cv2.IMREAD_COLOR
+
+        if self.img_shards is not None and img_id in self.img_shards:
+            img = self.img_shards.read(img_id, flags)
+            img_path = self.img_shards.index_path
+        else:
+            if imgs_dir is None:
+                imgs_dir = self.imgs_dir
+            assert imgs_dir is not None, "Image directory is not set."
+            img_path = os.path.join(imgs_dir, self.imgs[img_id]['file_name'])
+            img = cv2.imread(img_path, flags)
         
-        return img_path
+        if img is None:
+            raise IOError("Could not read image {} from {}".format(img_id, img_path))
+
+        if isinstance(resize, float):
+            img = cv2.resize(img, None, fx=resize, fy=resize,
+                             interpolation=cv2.INTER_AREA)
+        elif resize is not None:
+            img = cv2.resize(img, tuple(resize), interpolation=cv2.INTER_AREA)
+
+        if img_format == 'RGB':
+            img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+        return img
+
+    ##-------------------------------------------------------------------------
+    def iterSamples(self,
+                    img_ids=None,
+                    imgs_dir=None,
+                    num_threads=4,
+                    prefetch=16,
+                    ordered=True,
+                    resize=None,
+                    img_format='BGR',
+                    shard_id=0,
+                    num_shards=1):
+        """
+        Iterate over the dataset samples, decoding the images on a thread pool.
+        Yields (image, annotations, pointcloud) tuples, where pointcloud is
+        None for images without one.
+
+        :param img_ids (list): image IDs to iterate over, all images if None
+        :param imgs_dir (str): image directory, defaults to self.imgs_dir
+        :param num_threads (int): number of decoding threads
+        :param prefetch (int): maximum number of images decoded ahead
+        :param ordered (bool): keep the order of img_ids
+        :param resize: resize on decode, a scale factor or a (width, height) tuple
+        :param img_format (str): 'BGR' or 'RGB'
+        :param shard_id (int): index of this shard (e.g. the worker rank)
+        :param num_shards (int): total number of shards
+        :return (SampleIterator)
+        """
+
+        return SampleIterator(self,
+                              img_ids=img_ids,
+                              imgs_dir=imgs_dir,
+                              num_threads=num_threads,
+                              prefetch=prefetch,
+                              ordered=ordered,
+                              resize=resize,
+                              img_format=img_format,
+                              shard_id=shard_id,
+                              num_shards=num_shards)
 
     ##-------------------------------------------------------------------------
     def _createImageInfo(self, 
@@ -233,6 +938,7 @@ class COCO_PLUS(COCO):
                          coco_url='', 
                          date_captured=None,
                          other=None,
+                         filename=None,
                          ):
         """
         Generate image info in COCO format
@@ -244,15 +950,14 @@ class COCO_PLUS(COCO):
         :param coco_url (str)
         :param date_captured (str)
         :param other (dict)
+        :param filename (str): defaults to the name generated from img_id
         """
 
         if date_captured is None:
             date_captured = datetime.datetime.utcnow().isoformat(' ')
 
-        if img_id is not None:
+        if filename is None and img_id is not None:
             filename = self.imId2name(img_id)
-        else:
-            filename = None
 
         img_info={"id" : img_id,
                   "width" : width,
@@ -295,9 +1000,7 @@ class COCO_PLUS(COCO):
             coco_cat = {'id':cat_id, 'name':category, 'supercategory':supercat}
 
             # Add the category to the dataset
-            self.dataset['categories'].append(coco_cat)
-            self.catNameToId[category] = cat_id
-            self.cats[cat_id] = coco_cat
+            self._insertCat(coco_cat)
 
         return cat_id
     
@@ -310,13 +1013,317 @@ class COCO_PLUS(COCO):
          format.
          """
         self.dataset['categories'] = categories
+        self._pos.pop('categories', None)
+        self.revision += 1
 
         for cat in categories:
             self.catNameToId[cat['name']] = cat['id']
             self.cats[cat['id']] = cat
+        self.catIndex.invalidateCats()
+
+
+    ##-------------------------------------------------------------------------
+    def getImgIds(self, imgIds=[], catIds=[]):
+        """
+        Get img ids that satisfy given filter conditions, using the cached
+        image ID arrays of catIndex.
+        :param imgIds (int array) : get imgs for given ids
+        :param catIds (int array) : get imgs with all given cats
+        :return: ids (int array)  : sorted integer array of img ids
+        """
+
+        imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+
+        if len(catIds) == 0:
+            return list(self.imgs) if len(imgIds) == 0 else list(set(imgIds))
+        ids = self.catIndex.intersect(catIds)
+        if len(imgIds):
+            ids = ids[np.isin(ids, np.asarray(list(imgIds), dtype=np.int64))]
+        return ids.tolist()
+
+
+    ##-------------------------------------------------------------------------
+    def addAnns(self, anns):
+        """
+        Add annotations to existing samples.
+        :param anns (list of dict): annotations with their image_id set. New
+            IDs are generated for annotations without one.
+        :return (list): IDs of the annotations
+        """
+
+        for ann in anns:
+            assert ann['category_id'] in self.cats, \
+                "Category '{}' does not exist in dataset.".format(ann['category_id'])
+            assert ann['image_id'] in self.imgs, \
+                "Image ID {} does not exist.".format(ann['image_id'])
+            if ann.get('id') is None:
+                ann['id'] = self._getNewAnnId()
+            else:
+                assert ann['id'] not in self.anns, \
+                    "Annotation ID {} already exists.".format(ann['id'])
+            self._insertAnn(ann)
+
+        return [ann['id'] for ann in anns]
+
+    ##-------------------------------------------------------------------------
+    def updateAnn(self, ann_id, remove_fields=(), **fields):
+        """
+        Update the fields of an annotation, e.g. its bbox or category_id.
+        :param ann_id (int): annotation ID
+        :param remove_fields (list): names of fields to delete, e.g. ['distance']
+        :param fields: new field values
+        :return (dict): the updated annotation
+        """
+
+        ann = self.anns[ann_id]
+        assert fields.get('id', ann_id) == ann_id, "Annotation ID cannot change."
+        assert not set(remove_fields) & {'id', 'image_id', 'category_id', 'bbox'}, \
+            "Required annotation fields cannot be removed."
+        if 'category_id' in fields:
+            assert fields['category_id'] in self.cats, \
+                "Category '{}' does not exist in dataset.".format(fields['category_id'])
+        if 'image_id' in fields:
+            assert fields['image_id'] in self.imgs, \
+                "Image ID {} does not exist.".format(fields['image_id'])
+
+        self._updateAnn(ann, fields, remove_fields)
+        return self.anns[ann_id]
+
+    ##-------------------------------------------------------------------------
+    def relabelAnns(self, ann_ids, cat_id):
+        """
+        Change the category of many annotations.
+        :param ann_ids (list): annotation IDs
+        :param cat_id (int): new category ID
+        """
+
+        assert cat_id in self.cats, \
+            "Category '{}' does not exist in dataset.".format(cat_id)
+        fields = {'category_id': cat_id}
+        for ann_id in ann_ids:
+            self._updateAnn(self.anns[ann_id], fields)
+
+    ##-------------------------------------------------------------------------
+    def removeAnns(self, ann_ids):
+        """
+        Remove annotations from the dataset.
+        :param ann_ids (list): annotation IDs, duplicates are ignored
+        """
+
+        for ann_id in dict.fromkeys(ann_ids):
+            self._deleteAnn(self.anns[ann_id])
+
+    ##-------------------------------------------------------------------------
+    def updateImg(self, img_id, remove_fields=(), **fields):
+        """
+        Update the fields of an image info, e.g. its file_name or other.
+        :param img_id (int): image ID
+        :param remove_fields (list): names of fields to delete
+        :param fields: new field values
+        :return (dict): the updated image info
+        """
+
+        assert fields.get('id', img_id) == img_id, "Image ID cannot change."
+        assert not set(remove_fields) & {'id', 'file_name', 'height', 'width'}, \
+            "Required image fields cannot be removed."
+        self._updateImg(self.imgs[img_id], fields, remove_fields)
+        if 'file_name' in fields and self.img_cache is not None:
+            self.img_cache.discard(img_id)
+        return self.imgs[img_id]
+
+    ##-------------------------------------------------------------------------
+    def addImgs(self, img_infos):
+        """
+        Add the infos of images already in the image directory or shards,
+        e.g. when applying a patch. Nothing is written.
+        :param img_infos (list of dict): image infos with their ID
+        :return (list): IDs of the images
+        """
+
+        for img_info in img_infos:
+            assert isinstance(img_info.get('id'), int), "Image ID must be an integer."
+            assert img_info['id'] not in self.imgs, \
+                "Image ID {} already exists.".format(img_info['id'])
+            assert all(key in img_info for key in ['file_name', 'height', 'width']), \
+                "Image info of {} is incomplete.".format(img_info['id'])
+            self._insertImg(img_info)
+
+        return [img_info['id'] for img_info in img_infos]
+
+    ##-------------------------------------------------------------------------
+    def removeImgs(self, img_ids):
+        """
+        Remove images from the dataset, with their annotations and pointclouds.
+        The image files are not deleted.
+        :param img_ids (list): image IDs
+        """
+
+        for img_id in img_ids:
+            img_info = self.imgs[img_id]
+            for ann in list(self.imgToAnns.get(img_id, [])):
+                self._deleteAnn(ann)
+            if img_id in self.imgToPc:
+                self._deletePc(self.imgToPc[img_id])
+            self._deleteImg(img_info)
+            if self.img_cache is not None:
+                self.img_cache.discard(img_id)
+
+    ##-------------------------------------------------------------------------
+    def updatePointcloud(self, img_id, points, pc_id=None):
+        """
+        Replace the points of the pointcloud of an image, adding a pointcloud
+        if the image has none.
+        :param img_id (int): image ID
+        :param points (list): list of the points in the pointcloud
+        :param pc_id (int): ID of an added pointcloud, generated if None
+        """
+
+        assert isinstance(points, (list,)), "Pointcloud must be a list of points."
+        if img_id in self.imgToPc:
+            self._updatePc(self.imgToPc[img_id], {'points': points})
+        else:
+            assert img_id in self.imgs, "Image ID {} does not exist.".format(img_id)
+            if pc_id is None:
+                pc_id = self._getNewPclId()
+            else:
+                assert pc_id not in self.pointclouds, \
+                    "Pointcloud ID {} already exists.".format(pc_id)
+            self._insertPc({'id': pc_id,
+                            'img_id': img_id,
+                            'points': points})
+
+    ##-------------------------------------------------------------------------
+    def removePointclouds(self, img_ids):
+        """
+        Remove the pointclouds of images.
+        :param img_ids (list): image IDs, duplicates are ignored
+        """
+
+        for img_id in dict.fromkeys(img_ids):
+            self._deletePc(self.imgToPc[img_id])
+
+    ##-------------------------------------------------------------------------
+    def updateCategory(self, cat_id, remove_fields=(), **fields):
+        """
+        Update the fields of a category, e.g. its name or supercategory.
+        :param cat_id (int): category ID
+        :param remove_fields (list): names of fields to delete
+        :param fields: new field values
+        :return (dict): the updated category
+        """
+
+        cat = self.cats[cat_id]
+        assert fields.get('id', cat_id) == cat_id, "Category ID cannot change."
+        assert not set(remove_fields) & {'id', 'name'}, \
+            "Required category fields cannot be removed."
+        if fields.get('name', cat['name']) != cat['name']:
+            assert fields['name'] not in self.catNameToId, \
+                "Category '{}' already exists.".format(fields['name'])
+
+        self._updateCat(cat, fields, remove_fields)
+        return self.cats[cat_id]
+
+    ##-------------------------------------------------------------------------
+    def removeCategory(self, cat_id, new_cat_id=None):
+        """
+        Remove a category from the dataset. Its annotations are relabeled to
+        new_cat_id if given, and removed otherwise.
+        :param cat_id (int): category ID
+        :param new_cat_id (int): category of the annotations of cat_id
+        """
+
+        cat = self.cats[cat_id]
+        ann_ids = self.getAnnIds(imgIds=self.catIndex.imgIds(cat_id).tolist(),
+                                 catIds=[cat_id])
+        if new_cat_id is None:
+            self.removeAnns(ann_ids)
+        else:
+            self.relabelAnns(ann_ids, new_cat_id)
+        self._deleteCat(cat)
 
 
     ##-------------------------------------------------------------------------
+    def validate(self, num_workers=1, fix=False, max_ids=None):
+        """
+        Check the integrity of the dataset, see cocoplus.validate.validate_dataset.
+
+        :param num_workers (int): number of processes checking the annotations
+        :param fix (bool): clip the boxes to their image and remove the
+            invalid annotations and orphan pointclouds
+        :param max_ids (int): maximum number of offending IDs listed per check
+        :return (dict): report with the count and offending IDs of every check
+        """
+
+        report = validate_dataset(self, num_workers=num_workers, fix=fix,
+                                  max_ids=max_ids)
+        if not report['valid']:
+            self.logger.warning('Dataset validation failed: %s',
+                {k: c['count'] for k, c in report['checks'].items() if c['count']})
+        return report
+
+    ##-------------------------------------------------------------------------
+    def export(self, out_dir, fmt='yolo', img_ids=None, num_workers=4,
+               shard_size=1000):
+        """
+        Export the annotations to another format, see
+        cocoplus.export.export_dataset.
+
+        :param out_dir (str): output directory
+        :param fmt (str): 'yolo', 'voc' or 'jsonl'
+        :param img_ids (list): images to export, all images if None
+        :param num_workers (int): number of writing processes
+        :param shard_size (int): number of images per shard
+        :return (dict): number of exported images, annotations and shards
+        """
+
+        stats = export_dataset(self, out_dir, fmt=fmt, img_ids=img_ids,
+                               num_workers=num_workers, shard_size=shard_size)
+        self.logger.info('Exported %d images to %s (%s)', stats['images'],
+                         out_dir, fmt)
+        return stats
+
+    ##-------------------------------------------------------------------------
+    def createSampler(self, strategy='class_balanced', **kwargs):
+        """
+        Create an image sampler for training, see cocoplus.sampler.Sampler.
+
+        :param strategy (str): 'uniform', 'repeat_factor', 'class_balanced'
+            or 'distance'
+        :param kwargs: Sampler arguments (num_samples, seed, shard_id,
+            num_shards, repeat_thresh, distance_bins, cache_file, rebuild)
+        :return (Sampler): iterable over the image IDs of an epoch
+        """
+
+        return Sampler(self, strategy=strategy, **kwargs)
+
+    ##-------------------------------------------------------------------------
+    def _annArrays(self):
+        """
+        :return (tuple): image IDs, category IDs and distances (NaN if
+            missing) of all the annotations, as arrays
+        """
+
+        anns = list(self.anns.values())
+        return (np.fromiter((a['image_id'] for a in anns), np.int64, len(anns)),
+                np.fromiter((a['category_id'] for a in anns), np.int64, len(anns)),
+                np.array([a.get('distance', np.nan) for a in anns], np.float64))
+
+    ##-------------------------------------------------------------------------
+    def exportSharedIndex(self, path):
+        """
+        Export the dataset indexes to memory-mapped arrays, for data loading
+        workers to share without copying them. Open the export in the workers
+        with cocoplus.shared_index.SharedIndex(path).
+
+        :param path (str): output directory, e.g. under /dev/shm
+        :return (SharedIndex): read-only index with the lookup API of COCO_PLUS
+        """
+
+        return export_shared_index(self, path)
+
+    ##-------------------------------------------------------------------------
+    @metrics.timed('coco.saveAnnsToDisk')
     def saveAnnsToDisk(self, ann_file=None):
         """
         Save the annotations to disk
@@ -327,6 +1334,13 @@ class COCO_PLUS(COCO):
 
         with open(ann_file, 'w') as fp:
             json.dump(self.dataset, fp)
+            metrics.count('bytes_written', fp.tell())
+        if self.annotation_file is not None and \
+                os.path.abspath(ann_file) == os.path.abspath(self.annotation_file):
+            self.revision = 0
+
+        if self.img_shards is not None:
+            self.img_shards.flush(shard_index_path(ann_file))
 
 
     ##-------------------------------------------------------------------------
@@ -441,17 +1455,18 @@ class COCO_PLUS(COCO):
         return rle
 
     ##-------------------------------------------------------------------------
-    def imId2name(self, im_id):
+    def imId2name(self, im_id, ext='.jpg'):
         """
         Returns the COCO image name given its ID
         :im_id (int): image ID
+        :ext (str): file extension
         :return (str): image name
         """
         
         if isinstance(im_id, int):
-            name = str(im_id).zfill(self.STR_ID_LEN) + '.jpg'
+            name = str(im_id).zfill(self.STR_ID_LEN) + ext
         elif isinstance(im_id, str):
-            name = im_id + '.jpg'
+            name = im_id + ext
         else:
             raise AssertionError('Image ID should be of type string or int')
         return name
@@ -461,20 +1476,28 @@ class COCO_PLUS(COCO):
         """
         Display an image and its annotations
 
-        :param img (numpy array): The background image
+        :param img (numpy array or int): The background image, or an image ID
+            to read it through the image cache
         :param ann (list): A list of annotations. If empty, only the image
             is displayed.
-        :param BGR (binary): True for BGR, False for RGB
+        :param BGR (binary): True for BGR, False for RGB. Ignored if img is
+            an image ID.
         """
 
         plt.cla()
-        if BGR:
+        extent = None
+        if isinstance(img, (int, np.integer)):
+            img_info = self.imgs[int(img)]
+            img = self.loadImg(int(img), img_format='RGB', preview=True)
+            # Previews may be downscaled, keep the axes in image pixels
+            extent = (-0.5, img_info['width'] - 0.5, img_info['height'] - 0.5, -0.5)
+        elif BGR:
             img = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
         
         if ax is None:
             _, ax = plt.subplots(1, 1, figsize=(9, 9))
 
-        ax.imshow(img); 
+        ax.imshow(img, extent=extent); 
         plt.axis('off')
 
         if anns is not None:
@@ -483,6 +1506,31 @@ class COCO_PLUS(COCO):
         return ax
 
 
+    ##-------------------------------------------------------------------------
+    def renderImg(self, img_id, anns=None, color=(0,255,0), lineWidth=2,
+                  img_format='BGR', show_names=True):
+        """
+        Draw the bounding boxes of a sample on a copy of its image.
+
+        :param img_id (int): image ID, the image is read through the image cache
+        :param anns (list): annotations to draw, defaults to all the
+            annotations of the image
+        :param color (tuple): box color
+        :param lineWidth (int): box line width
+        :param img_format (str): 'BGR' or 'RGB'
+        :param show_names (bool): write the category names over the boxes
+        :return (nparray): the rendered image
+        """
+
+        if anns is None:
+            anns = self.imgToAnns.get(img_id, [])
+        img = self.loadImg(img_id, img_format=img_format).copy()
+        bboxes = [ann['bbox'] for ann in anns]
+        names = [self.cats[ann['category_id']]['name'] for ann in anns] \
+            if show_names else None
+        return draw_xywh_bbox(img, bboxes, color=color, lineWidth=lineWidth,
+                              format=img_format, names=names)
+
     ##-------------------------------------------------------------------------
     def showAnns(self, anns, bbox_only=False, ax=None):
         """
@@ -517,7 +1565,7 @@ class COCO_PLUS(COCO):
                     [bbox_x, bbox_y, bbox_w, bbox_h] = ann['bbox']
                     poly = [[bbox_x, bbox_y], [bbox_x, bbox_y+bbox_h], [bbox_x+bbox_w, bbox_y+bbox_h], [bbox_x+bbox_w, bbox_y]]
                     np_poly = np.array(poly).reshape((4,2))
-                    polygons.append(Polygon(np_poly))
+                    polygons.append(patches.Polygon(np_poly))
                     color.append(c)
 
                     cat_id = ann['category_id']
@@ -534,7 +1582,7 @@ class COCO_PLUS(COCO):
                         # polygon
                         for seg in ann['segmentation']:
                             poly = np.array(seg).reshape((int(len(seg)/2), 2))
-                            polygons.append(Polygon(poly))
+                            polygons.append(patches.Polygon(poly))
                             color.append(c)
                     else:
                         # mask
@@ -566,9 +1614,9 @@ class COCO_PLUS(COCO):
                     plt.plot(x[v>0], y[v>0],'o',markersize=8, markerfacecolor=c, markeredgecolor='k',markeredgewidth=2)
                     plt.plot(x[v>1], y[v>1],'o',markersize=8, markerfacecolor=c, markeredgecolor=c, markeredgewidth=2)
 
-            p = PatchCollection(polygons, facecolor=color, linewidths=0, alpha=0)
+            p = mpl_collections.PatchCollection(polygons, facecolor=color, linewidths=0, alpha=0)
             ax.add_collection(p)
-            p = PatchCollection(polygons, facecolor='none', edgecolors=color, linewidths=2)
+            p = mpl_collections.PatchCollection(polygons, facecolor='none', edgecolors=color, linewidths=2)
             ax.add_collection(p)
         
         elif datasetType == 'captions':
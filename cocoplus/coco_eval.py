@@ -1,8 +1,27 @@
 import numpy as np
 from pycocotools.cocoeval import COCOeval
+from cocoplus.utils import metrics
+from cocoplus.error_analysis import analyze_errors
+from cocoplus.utils.coco_utils import DISTANCE_BINS
 
 class COCOeval_plus(COCOeval):
-    
+
+    @metrics.timed('eval.evaluate')
+    def evaluate(self):
+        '''
+        Run per image evaluation, see COCOeval.evaluate
+        '''
+        super(COCOeval_plus, self).evaluate()
+        metrics.count('images_evaluated', len(self.params.imgIds))
+
+    @metrics.timed('eval.accumulate')
+    def accumulate(self, p=None):
+        '''
+        Accumulate per image evaluation results, see COCOeval.accumulate
+        '''
+        super(COCOeval_plus, self).accumulate(p)
+
+    @metrics.timed('eval.summarize')
     def summarize(self):
         '''
         Compute and display summary metrics for evaluation results.
@@ -84,6 +103,17 @@ class COCOeval_plus(COCOeval):
             summarize = _summarizeKps
         self.stats = summarize()
 
+    def analyzeErrors(self, iouThr=0.5, bgThr=0.1, distanceBins=DISTANCE_BINS,
+                      numWorst=20):
+        '''
+        Classify the false positives and missed objects at an IoU threshold,
+        see cocoplus.error_analysis.analyze_errors
+        :return: dict with the error counts, their breakdowns by category,
+                 area and distance, and the worst images
+        '''
+        return analyze_errors(self, iou_thr=iouThr, bg_thr=bgThr,
+                              distance_bins=distanceBins, num_worst=numWorst)
+
     def __str__(self):
         self.summarize()
 
@@ -0,0 +1,210 @@
+"""
+Near-duplicate image detection with perceptual hashes.
+
+"""
+
+import os
+import itertools
+import concurrent.futures as futures
+from array import array
+from collections import defaultdict
+from functools import partial
+
+import numpy as np
+
+from cocoplus.utils.lazy import lazy_import
+
+cv2 = lazy_import('cv2', 'opencv-python')
+
+
+def dhash(img, hash_size=8):
+    """
+    Difference hash of an image: the sign of the horizontal gradients of a
+    (hash_size+1 x hash_size) grayscale thumbnail, packed in an integer.
+    Near-identical images have hashes within a small Hamming distance.
+
+    :param img (nparray): BGR or grayscale image
+    :param hash_size (int): the hash has hash_size**2 bits
+    :return (int): the hash
+    """
+
+    if img.ndim == 3:
+        img = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(img, (hash_size + 1, hash_size),
+                       interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).ravel()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+##------------------------------------------------------------------------------
+def dhash_file(img_path, hash_size=8):
+    """
+    Difference hash of an image file. JPEGs are decoded at 1/8 resolution,
+    which is plenty for the hash thumbnail.
+    """
+
+    img = cv2.imread(img_path, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if img is None or min(img.shape) <= hash_size:
+        img = cv2.imread(img_path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        raise IOError("Could not read image {}".format(img_path))
+    return dhash(img, hash_size)
+
+
+##------------------------------------------------------------------------------
+def _dhash_buffer(buf, hash_size=8):
+    img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_GRAYSCALE)
+    return dhash(img, hash_size)
+
+
+# Number of set bits of every byte value
+_POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def _popcount(x):
+    """
+    Number of set bits of each element of a uint64 array.
+    """
+    return _POPCOUNT8[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+class HashIndex(object):
+    """
+    Multi-index hashing over perceptual hashes for Hamming-radius queries.
+
+    The hashes are split in radius+1 disjoint chunks, each indexed in its own
+    hash table. By the pigeonhole principle, two hashes within the radius
+    share at least one identical chunk, so a query only verifies the entries
+    colliding with one of its chunks instead of scanning the whole index.
+    """
+
+    def __init__(self, radius=4, num_bits=64):
+        """
+        :param radius (int): maximum Hamming distance of a near-duplicate
+        :param num_bits (int): number of bits of the hashes
+        """
+
+        assert 0 <= radius < num_bits, "radius must be in [0, num_bits)."
+        self.radius = radius
+        self.num_bits = num_bits
+
+        num_chunks = radius + 1
+        bounds = np.linspace(0, num_bits, num_chunks + 1).astype(int)
+        self._chunks = [(int(lo), (1 << int(hi - lo)) - 1)
+                        for lo, hi in zip(bounds[:-1], bounds[1:])]
+        self._tables = [defaultdict(list) for _ in self._chunks]
+        self._keys = []
+        self._hashes = array('Q')
+
+    def __len__(self):
+        return len(self._keys)
+
+    ##-------------------------------------------------------------------------
+    def add(self, key, h):
+        """
+        Add a hash to the index.
+        :param key: identifier returned by queries, e.g. the image ID
+        :param h (int): the hash
+        """
+
+        pos = len(self._keys)
+        self._keys.append(key)
+        self._hashes.append(h)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table[(h >> shift) & mask].append(pos)
+
+    ##-------------------------------------------------------------------------
+    def query(self, h, radius=None):
+        """
+        Find the indexed hashes within a Hamming radius.
+        :param h (int): the query hash
+        :param radius (int): defaults to the index radius, cannot exceed it
+        :return (list): (key, distance) tuples sorted by distance
+        """
+
+        if radius is None:
+            radius = self.radius
+        assert radius <= self.radius, \
+            "radius cannot exceed the index radius {}".format(self.radius)
+
+        candidates = set()
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            candidates.update(table.get((h >> shift) & mask, ()))
+        if not candidates:
+            return []
+
+        # Verify the candidates in one vectorized pass
+        pos = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+        hashes = np.frombuffer(self._hashes, dtype=np.uint64)[pos]
+        dists = _popcount(hashes ^ np.uint64(h))
+        keep = np.flatnonzero(dists <= radius)
+        keep = keep[np.argsort(dists[keep], kind='stable')]
+        return [(self._keys[pos[i]], int(dists[i])) for i in keep]
+
+    ##-------------------------------------------------------------------------
+    def duplicates(self):
+        """
+        Find all the pairs of near-duplicate entries in the index.
+        :return (list): (key1, key2, distance) tuples, key1 added before key2
+        """
+
+        pairs = []
+        for pos, h in enumerate(self._hashes):
+            candidates = set()
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                candidates.update(p for p in table[(h >> shift) & mask]
+                                  if p < pos)
+            if not candidates:
+                continue
+            others = np.array(sorted(candidates), dtype=np.int64)
+            dists = _popcount(np.frombuffer(self._hashes, dtype=np.uint64)[others]
+                              ^ np.uint64(h))
+            for other, dist in zip(others, dists):
+                if dist <= self.radius:
+                    pairs.append((self._keys[other], self._keys[pos], int(dist)))
+        return pairs
+
+
+##------------------------------------------------------------------------------
+def build_hash_index(coco, img_ids=None, imgs_dir=None, radius=4, hash_size=8,
+                     num_workers=4, chunksize=64):
+    """
+    Hash the images of a dataset on a process pool and index them.
+
+    :param coco (COCO_PLUS): the dataset
+    :param img_ids (list): images to hash, all images if None
+    :param imgs_dir (str): image directory, defaults to coco.imgs_dir
+    :param radius (int): Hamming radius of the index
+    :param hash_size (int): the hashes have hash_size**2 bits
+    :param num_workers (int): number of hashing processes
+    :param chunksize (int): number of images sent to a process at once
+    :return (HashIndex): the index, keyed by image ID
+    """
+
+    if img_ids is None:
+        img_ids = list(coco.imgs.keys())
+    if imgs_dir is None:
+        imgs_dir = coco.imgs_dir
+
+    if coco.img_shards is not None:
+        # Encoded bytes are read from the memory-mapped shards here and
+        # decoded in the workers
+        hash_fn = partial(_dhash_buffer, hash_size=hash_size)
+        inputs = (bytes(coco.img_shards.get(i)) for i in img_ids)
+    else:
+        hash_fn = partial(dhash_file, hash_size=hash_size)
+        inputs = (os.path.join(imgs_dir, coco.imgs[i]['file_name'])
+                  for i in img_ids)
+
+    index = HashIndex(radius=radius, num_bits=hash_size ** 2)
+    ids = iter(img_ids)
+    with futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+        # Submit bounded batches so that the inputs are not all in memory
+        while True:
+            batch = list(itertools.islice(inputs, chunksize * num_workers * 4))
+            if not batch:
+                break
+            for h in pool.map(hash_fn, batch, chunksize=chunksize):
+                index.add(next(ids), h)
+
+    return index
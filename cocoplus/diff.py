@@ -0,0 +1,260 @@
+"""
+Structural diff and patch between two revisions of a COCO_PLUS dataset.
+
+A patch lists, for categories, images, annotations and pointclouds, the
+objects added, the ids removed and the changed fields of the modified
+objects (fields removed in the new revision are set to None). Ids in
+'removed' and 'modified' refer to the old revision, pointclouds are
+identified by their img_id.
+
+"""
+
+import numpy as np
+from pycocotools import mask
+
+from cocoplus.utils.stream import TABLES as _TABLES, load_tables
+
+# Annotation fields compared as arrays, the other fields are compared as
+# Python objects
+_ANN_COLUMNS = ['image_id', 'category_id', 'area', 'iscrowd', 'distance']
+_ANN_FIELDS = frozenset(_ANN_COLUMNS + ['bbox'])
+
+
+def _annColumns(anns):
+    # Missing and None values are NaN, presence is compared with the keys
+    cols = {key: np.array([np.nan if ann.get(key) is None else ann[key]
+                           for ann in anns], dtype=np.float64)
+            for key in _ANN_COLUMNS}
+    cols['bbox'] = np.array([ann['bbox'] for ann in anns],
+                            dtype=np.float64).reshape(-1, 4)
+    return cols
+
+
+def _changes(old, new):
+    """
+    Fields of new that differ from old. Removed fields map to None.
+    """
+
+    changes = {k: v for k, v in new.items() if old.get(k) != v}
+    changes.update({k: None for k in old if k not in new})
+    return changes
+
+
+def _diffById(old_objs, new_objs, key='id', prefilter=None, fields=()):
+    """
+    Diff two lists of objects aligned by id.
+    :param prefilter (function): optional vectorized comparison of the common
+        objects, returning a mask of the pairs differing in `fields`
+    :param fields (set): fields fully compared by the prefilter, only the
+        other fields of the remaining pairs are compared in Python
+    """
+
+    old_ids = np.array([o[key] for o in old_objs], dtype=np.int64)
+    new_ids = np.array([o[key] for o in new_objs], dtype=np.int64)
+    common, old_pos, new_pos = np.intersect1d(old_ids, new_ids,
+                                              assume_unique=True,
+                                              return_indices=True)
+
+    removed = np.setdiff1d(old_ids, common, assume_unique=True).tolist()
+    added_mask = np.ones(len(new_ids), dtype=bool)
+    added_mask[new_pos] = False
+    added = [new_objs[i] for i in np.flatnonzero(added_mask)]
+
+    differ = np.zeros(len(common), dtype=bool)
+    if prefilter is not None and len(common):
+        differ = prefilter(old_pos, new_pos)
+
+    modified = []
+    for i, j, known in zip(old_pos.tolist(), new_pos.tolist(), differ.tolist()):
+        old, new = old_objs[i], new_objs[j]
+        if not known and old.keys() == new.keys() and \
+                all(old[k] == new[k] for k in old if k not in fields):
+            continue
+        changes = _changes(old, new)
+        if changes:
+            modified.append({key: old[key], 'changes': changes})
+
+    return {'added': added, 'removed': removed, 'modified': modified}
+
+
+##------------------------------------------------------------------------------
+def _matchByIoU(old_anns, new_anns, img_map, iou_thr):
+    """
+    Match the annotations of matched images by box IoU, greedily in the order
+    of decreasing IoU.
+    :return (list): (old_index, new_index) pairs
+    """
+
+    old_by_img, new_by_img = {}, {}
+    for i, ann in enumerate(old_anns):
+        old_by_img.setdefault(ann['image_id'], []).append(i)
+    for j, ann in enumerate(new_anns):
+        new_by_img.setdefault(ann['image_id'], []).append(j)
+
+    pairs = []
+    for new_img, new_idx in new_by_img.items():
+        old_idx = old_by_img.get(img_map.get(new_img), [])
+        if not old_idx:
+            continue
+        ious = mask.iou(np.array([new_anns[j]['bbox'] for j in new_idx], np.float64),
+                        np.array([old_anns[i]['bbox'] for i in old_idx], np.float64),
+                        np.zeros(len(old_idx), np.uint8))
+        ious = np.asarray(ious).reshape(len(new_idx), len(old_idx))
+        order = np.argsort(-ious, axis=None)
+        used_new, used_old = set(), set()
+        for flat in order:
+            r, c = divmod(int(flat), len(old_idx))
+            if ious[r, c] < iou_thr:
+                break
+            if r in used_new or c in used_old:
+                continue
+            used_new.add(r)
+            used_old.add(c)
+            pairs.append((old_idx[c], new_idx[r]))
+    return pairs
+
+
+##------------------------------------------------------------------------------
+def diff_datasets(old, new, match='id', iou_thr=0.5):
+    """
+    Compute the patch turning the old revision of a dataset into the new one.
+
+    :param old: COCO_PLUS instance, dataset dict or annotation file
+    :param new: COCO_PLUS instance, dataset dict or annotation file
+    :param match (str): 'id' to align objects by id, 'iou' to align images by
+        file_name and annotations by box IoU when ids differ between revisions
+    :param iou_thr (float): minimum IoU of matched boxes for match='iou'
+    :return (dict): the patch
+    """
+
+    assert match in ['id', 'iou'], "Match mode not supported."
+    old, new = load_tables(old), load_tables(new)
+    old_anns = old.get('annotations', [])
+    new_anns = new.get('annotations', [])
+
+    patch = {'categories': _diffById(old.get('categories', []),
+                                     new.get('categories', []))}
+
+    if match == 'id':
+        old_cols, new_cols = _annColumns(old_anns), _annColumns(new_anns)
+
+        def _annPrefilter(old_pos, new_pos):
+            differ = np.any(old_cols['bbox'][old_pos] != new_cols['bbox'][new_pos],
+                            axis=1)
+            for key in _ANN_COLUMNS:
+                a, b = old_cols[key][old_pos], new_cols[key][new_pos]
+                differ |= (a != b) & ~(np.isnan(a) & np.isnan(b))
+            return differ
+
+        patch['images'] = _diffById(old.get('images', []), new.get('images', []))
+        patch['annotations'] = _diffById(old_anns, new_anns,
+                                         prefilter=_annPrefilter,
+                                         fields=_ANN_FIELDS)
+        patch['pointclouds'] = _diffById(old.get('pointclouds', []),
+                                         new.get('pointclouds', []),
+                                         key='img_id')
+        return patch
+
+    ## Align the images by file name, then express the new revision with the
+    ## old ids so that the id-based diff applies
+    old_names = {img['file_name']: img['id'] for img in old.get('images', [])}
+    img_map = {img['id']: old_names[img['file_name']]
+               for img in new.get('images', []) if img['file_name'] in old_names}
+    pairs = _matchByIoU(old_anns, new_anns, img_map, iou_thr)
+    ann_map = {new_anns[j]['id']: old_anns[i]['id'] for i, j in pairs}
+
+    # Unmatched new objects get ids that cannot collide with the old ones
+    next_img = max([img['id'] for img in old.get('images', [])] + [-1]) + 1
+    next_ann = max([ann['id'] for ann in old_anns] + [-1]) + 1
+    for img in new.get('images', []):
+        if img['id'] not in img_map:
+            img_map[img['id']] = next_img
+            next_img += 1
+    for ann in new_anns:
+        if ann['id'] not in ann_map:
+            ann_map[ann['id']] = next_ann
+            next_ann += 1
+
+    images = [dict(img, id=img_map[img['id']]) for img in new.get('images', [])]
+    anns = [dict(ann, id=ann_map[ann['id']], image_id=img_map[ann['image_id']])
+            for ann in new_anns]
+    pcs = [dict(pc, img_id=img_map[pc['img_id']])
+           for pc in new.get('pointclouds', [])]
+    return diff_datasets(old, {'categories': new.get('categories', []),
+                               'images': images,
+                               'annotations': anns,
+                               'pointclouds': pcs}, match='id')
+
+
+##------------------------------------------------------------------------------
+def _split(changes):
+    """
+    Split the changes of a patch into updated fields and removed field names.
+    """
+
+    return ({k: v for k, v in changes.items() if v is not None},
+            [k for k, v in changes.items() if v is None])
+
+
+def apply_patch(coco, patch):
+    """
+    Apply a patch to a COCO_PLUS dataset, through its public update API.
+
+    :param coco (COCO_PLUS): the old revision of the dataset
+    :param patch (dict): patch computed by diff_datasets
+    """
+
+    cats, imgs = patch['categories'], patch['images']
+    anns, pcs = patch['annotations'], patch['pointclouds']
+
+    ## Categories renamed or removed first get temporary names, so that
+    ## names can be swapped or reused by the added categories
+    renamed = [mod for mod in cats['modified'] if 'name' in mod['changes']]
+    for cat_id in [mod['id'] for mod in renamed] + cats['removed']:
+        coco.updateCategory(cat_id, name='__patch_{}__'.format(cat_id))
+    for mod in cats['modified']:
+        fields, removed = _split(mod['changes'])
+        coco.updateCategory(mod['id'], remove_fields=removed, **fields)
+    for cat in cats['added']:
+        assert cat['name'] not in coco.catNameToId, \
+            "Category '{}' already exists.".format(cat['name'])
+        fields, _ = _split(cat)
+        cat_id = coco.addCategory(fields.pop('name'), fields.pop('supercategory', None),
+                                  new_cat_id=fields.pop('id'))
+        coco.updateCategory(cat_id, remove_fields=[] if 'supercategory' in cat
+                            else ['supercategory'], **fields)
+
+    coco.addImgs([dict(img) for img in imgs['added']])
+    for mod in imgs['modified']:
+        fields, removed = _split(mod['changes'])
+        coco.updateImg(mod['id'], remove_fields=removed, **fields)
+
+    coco.removeAnns(anns['removed'])
+    for mod in anns['modified']:
+        fields, removed = _split(mod['changes'])
+        coco.updateAnn(mod['id'], remove_fields=removed, **fields)
+    coco.addAnns([dict(ann) for ann in anns['added']])
+
+    coco.removePointclouds(pcs['removed'])
+    for mod in pcs['modified']:
+        pc = dict(coco.imgToPc[mod['img_id']], **mod['changes'])
+        if pc['id'] != coco.imgToPc[mod['img_id']]['id']:
+            coco.removePointclouds([mod['img_id']])
+        coco.updatePointcloud(mod['img_id'], pc['points'], pc_id=pc['id'])
+    for pc in pcs['added']:
+        coco.updatePointcloud(pc['img_id'], pc['points'], pc_id=pc['id'])
+
+    coco.removeImgs(imgs['removed'])
+    for cat_id in cats['removed']:
+        coco.removeCategory(cat_id)
+
+
+##------------------------------------------------------------------------------
+def patch_summary(patch):
+    """
+    :return (dict): number of added, removed and modified objects per table
+    """
+
+    return {table: {op: len(patch[table][op])
+                    for op in ['added', 'removed', 'modified']}
+            for table in _TABLES}
@@ -0,0 +1,250 @@
+"""
+Error analysis of COCOeval_plus results.
+
+The per-image results of COCOeval.evaluate() are flattened into arrays of
+detections and ground truth objects, then every detection is classified at
+a given IoU threshold as a true positive or one of the false positive types
+below, and every ground truth object as matched or missed:
+
+  'duplicate':      overlaps (IoU >= thr) a ground truth of its class already
+                    matched by a higher-scoring detection
+  'classification': overlaps (IoU >= thr) a ground truth of another class
+  'localization':   overlaps (bg_thr <= IoU < thr) a ground truth of its class
+  'background':     overlaps no ground truth (IoU < bg_thr)
+
+Box IoUs are used for the confusion passes, also for segm evaluations.
+
+"""
+
+import itertools
+
+import numpy as np
+
+from cocoplus.utils.coco_utils import DISTANCE_BINS
+
+DET_TYPES = ['tp', 'duplicate', 'classification', 'localization', 'background']
+TP, DUPLICATE, CLASSIFICATION, LOCALIZATION, BACKGROUND = range(len(DET_TYPES))
+
+
+def _concat(arrays, dtype):
+    arrays = list(arrays)
+    if not arrays:
+        return np.zeros(0, dtype=dtype)
+    return np.concatenate(arrays).astype(dtype, copy=False)
+
+
+def _pairIoU(a, b):
+    """
+    IoU of the pairs of [x y w h] boxes a[i], b[i].
+    """
+
+    x1 = np.maximum(a[:, 0], b[:, 0])
+    y1 = np.maximum(a[:, 1], b[:, 1])
+    x2 = np.minimum(a[:, 0] + a[:, 2], b[:, 0] + b[:, 2])
+    y2 = np.minimum(a[:, 1] + a[:, 3], b[:, 1] + b[:, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    union = a[:, 2] * a[:, 3] + b[:, 2] * b[:, 3] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-12), 0.)
+
+
+##------------------------------------------------------------------------------
+def flatten_eval_imgs(coco_eval, iou_thr=0.5):
+    """
+    Flatten the per-image results of the 'all' area range into arrays.
+
+    :param coco_eval (COCOeval_plus): evaluation after evaluate()
+    :param iou_thr (float): one of params.iouThrs
+    :return (tuple): dicts of detection and ground truth arrays, ignored
+        objects excluded
+    """
+
+    p = coco_eval.params
+    assert coco_eval.evalImgs, "Please run evaluate() first."
+    assert p.useCats, "Error analysis requires useCats."
+    t = np.flatnonzero(np.isclose(p.iouThrs, iou_thr))
+    assert len(t), "iou_thr must be one of params.iouThrs."
+    t = int(t[0])
+
+    # evalImgs is ordered by category, area range, then image
+    num_imgs, num_areas = len(p.imgIds), len(p.areaRng)
+    evals = [e for k in range(len(p.catIds))
+             for e in coco_eval.evalImgs[k * num_areas * num_imgs:
+                                         k * num_areas * num_imgs + num_imgs]
+             if e is not None]
+
+    num_dts = np.array([len(e['dtIds']) for e in evals], dtype=np.int64)
+    num_gts = np.array([len(e['gtIds']) for e in evals], dtype=np.int64)
+    eval_imgs = np.array([e['image_id'] for e in evals], dtype=np.int64)
+    eval_cats = np.array([e['category_id'] for e in evals], dtype=np.int64)
+
+    dts = {'id': np.fromiter(itertools.chain.from_iterable(e['dtIds'] for e in evals),
+                             dtype=np.int64, count=int(num_dts.sum())),
+           'image_id': np.repeat(eval_imgs, num_dts),
+           'category_id': np.repeat(eval_cats, num_dts),
+           'score': _concat((e['dtScores'] for e in evals), np.float64),
+           'match': _concat((e['dtMatches'][t] for e in evals), np.int64)}
+    dt_ignore = _concat((e['dtIgnore'][t] for e in evals), bool)
+
+    gts = {'id': np.fromiter(itertools.chain.from_iterable(e['gtIds'] for e in evals),
+                             dtype=np.int64, count=int(num_gts.sum())),
+           'image_id': np.repeat(eval_imgs, num_gts),
+           'category_id': np.repeat(eval_cats, num_gts),
+           'match': _concat((e['gtMatches'][t] for e in evals), np.int64)}
+    gt_ignore = _concat((e['gtIgnore'] for e in evals), bool)
+
+    dts = {k: v[~dt_ignore] for k, v in dts.items()}
+    gts = {k: v[~gt_ignore] for k, v in gts.items()}
+
+    dt_anns, gt_anns = coco_eval.cocoDt.anns, coco_eval.cocoGt.anns
+    dts['bbox'] = np.array([dt_anns[i]['bbox'] for i in dts['id'].tolist()],
+                           dtype=np.float64).reshape(-1, 4)
+    dts['area'] = dts['bbox'][:, 2] * dts['bbox'][:, 3]
+    gt_list = [gt_anns[i] for i in gts['id'].tolist()]
+    gts['bbox'] = np.array([g['bbox'] for g in gt_list],
+                           dtype=np.float64).reshape(-1, 4)
+    gts['area'] = np.array([g['area'] for g in gt_list], dtype=np.float64)
+    gts['distance'] = np.array([g.get('distance', np.nan) for g in gt_list],
+                               dtype=np.float64)
+    return dts, gts
+
+
+##------------------------------------------------------------------------------
+def classify_detections(dts, gts, iou_thr=0.5, bg_thr=0.1):
+    """
+    Classify the detections into the DET_TYPES codes.
+    :return (nparray): error type code of every detection
+    """
+
+    types = np.full(len(dts['id']), TP, dtype=np.int8)
+    fp = np.flatnonzero(dts['match'] == 0)
+    types[fp] = BACKGROUND
+    if not len(fp) or not len(gts['id']):
+        return types
+
+    # All (false positive, ground truth) pairs of the same image
+    g_order = np.argsort(gts['image_id'], kind='stable')
+    g_imgs = gts['image_id'][g_order]
+    fp_imgs = dts['image_id'][fp]
+    start = np.searchsorted(g_imgs, fp_imgs, side='left')
+    counts = np.searchsorted(g_imgs, fp_imgs, side='right') - start
+    pair_fp = np.repeat(np.arange(len(fp)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    pair_gt = g_order[np.repeat(start, counts) + offsets]
+
+    ious = _pairIoU(dts['bbox'][fp[pair_fp]], gts['bbox'][pair_gt])
+    same = dts['category_id'][fp[pair_fp]] == gts['category_id'][pair_gt]
+    best_same = np.zeros(len(fp))
+    best_other = np.zeros(len(fp))
+    np.maximum.at(best_same, pair_fp[same], ious[same])
+    np.maximum.at(best_other, pair_fp[~same], ious[~same])
+
+    fp_types = np.full(len(fp), BACKGROUND, dtype=np.int8)
+    fp_types[best_same >= bg_thr] = LOCALIZATION
+    fp_types[best_other >= iou_thr] = CLASSIFICATION
+    fp_types[best_same >= iou_thr] = DUPLICATE
+    types[fp] = fp_types
+    return types
+
+
+def _breakdown(keys, labels, dt_keys, dt_types, gt_keys, missed):
+    """
+    Count the detection types and missed ground truths for each key.
+    """
+
+    n = len(keys)
+    dt_counts = np.bincount(dt_keys * len(DET_TYPES) + dt_types,
+                            minlength=n * len(DET_TYPES)).reshape(n, -1)
+    num_gt = np.bincount(gt_keys, minlength=n)
+    num_missed = np.bincount(gt_keys[missed], minlength=n)
+
+    out = {}
+    for i, label in enumerate(labels):
+        row = {name: int(c) for name, c in zip(DET_TYPES, dt_counts[i])}
+        row['num_gt'] = int(num_gt[i])
+        row['missed'] = int(num_missed[i])
+        row['recall'] = float((num_gt[i] - num_missed[i]) / num_gt[i]) \
+            if num_gt[i] else None
+        out[label] = row
+    return out
+
+
+##------------------------------------------------------------------------------
+def analyze_errors(coco_eval, iou_thr=0.5, bg_thr=0.1,
+                   distance_bins=DISTANCE_BINS, num_worst=20):
+    """
+    Classify the detections and missed objects of an evaluation, with
+    breakdowns by category, area range and distance.
+
+    :param coco_eval (COCOeval_plus): evaluation after evaluate()
+    :param iou_thr (float): IoU threshold of true positives, one of
+        params.iouThrs
+    :param bg_thr (float): minimum IoU of localization errors
+    :param distance_bins (tuple): edges of the ground truth distance bins
+    :param num_worst (int): number of worst images listed
+    :return (dict): per-object arrays ('detections', 'ground_truths'), total
+        counts ('summary'), breakdowns ('by_category', 'by_area',
+        'by_distance') and the images with the most errors ('worst_images')
+    """
+
+    p = coco_eval.params
+    dts, gts = flatten_eval_imgs(coco_eval, iou_thr)
+    dts['type'] = classify_detections(dts, gts, iou_thr, bg_thr)
+    gts['missed'] = gts['match'] == 0
+    dt_types, missed = dts['type'].astype(np.int64), gts['missed']
+
+    everything = _breakdown([0], ['all'], np.zeros(len(dt_types), np.int64),
+                            dt_types, np.zeros(len(missed), np.int64), missed)
+
+    cat_ids = np.asarray(p.catIds, dtype=np.int64)
+    cat_names = [coco_eval.cocoGt.cats[c]['name'] for c in p.catIds]
+    by_category = _breakdown(cat_ids, cat_names,
+                             np.searchsorted(cat_ids, dts['category_id']), dt_types,
+                             np.searchsorted(cat_ids, gts['category_id']), missed)
+
+    # Area ranges after 'all' are consecutive, e.g. small, medium, large
+    edges = np.array([r[0] for r in p.areaRng[1:]] + [p.areaRng[-1][1]])
+    area_labels = list(p.areaRngLbl[1:])
+    dt_area = np.clip(np.digitize(dts['area'], edges) - 1, 0, len(area_labels) - 1)
+    gt_area = np.clip(np.digitize(gts['area'], edges) - 1, 0, len(area_labels) - 1)
+    by_area = _breakdown(area_labels, area_labels, dt_area, dt_types, gt_area,
+                         missed)
+
+    # Distances are only known for ground truths, true positives take the
+    # distance of their match
+    edges = np.asarray(distance_bins, dtype=np.float64)
+    dist_labels = ['{:g}-{:g}'.format(a, b) for a, b in zip(edges[:-1], edges[1:])]
+    known = ~np.isnan(gts['distance'])
+    gt_bin = np.digitize(gts['distance'], edges) - 1
+    known &= (gt_bin >= 0) & (gt_bin < len(dist_labels))
+    tp = dt_types == TP
+    id_order = np.argsort(gts['id'])
+    tp_gt = id_order[np.searchsorted(gts['id'][id_order], dts['match'][tp])]
+    tp_gt = tp_gt[known[tp_gt]]
+    by_distance = _breakdown(dist_labels, dist_labels, gt_bin[tp_gt],
+                             np.full(len(tp_gt), TP, np.int64),
+                             gt_bin[known], missed[known])
+    for row in by_distance.values():
+        for name in DET_TYPES[1:]:
+            del row[name]
+
+    # Images with the most false positives and missed objects
+    img_ids = np.asarray(p.imgIds, dtype=np.int64)
+    dt_img = np.searchsorted(img_ids, dts['image_id'])
+    gt_img = np.searchsorted(img_ids, gts['image_id'])
+    num_tp = np.bincount(dt_img[tp], minlength=len(img_ids))
+    num_fp = np.bincount(dt_img[~tp], minlength=len(img_ids))
+    num_fn = np.bincount(gt_img[missed], minlength=len(img_ids))
+    errors = num_fp + num_fn
+    worst = np.argsort(-errors, kind='stable')[:num_worst]
+    worst_images = [{'image_id': int(img_ids[i]), 'tp': int(num_tp[i]),
+                     'fp': int(num_fp[i]), 'fn': int(num_fn[i])}
+                    for i in worst if errors[i] > 0]
+
+    return {'iou_thr': iou_thr,
+            'detections': dts,
+            'ground_truths': gts,
+            'summary': everything['all'],
+            'by_category': by_category,
+            'by_area': by_area,
+            'by_distance': by_distance,
+            'worst_images': worst_images}
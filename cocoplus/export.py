@@ -0,0 +1,264 @@
+"""
+Streaming export of COCO_PLUS datasets to other annotation formats.
+
+Images are split into shards of consecutive images, and every shard is
+converted and written by a worker process. Only a bounded number of shards
+is in flight at once, so memory use does not grow with the dataset size.
+Annotation files are streamed, only the objects are kept in memory, not
+the whole file.
+
+Supported formats:
+  'yolo':  one labels/<image>.txt file per image with normalized
+           "class xc yc w h" lines, and classes.txt with the category names
+  'voc':   one Annotations/<image>.xml Pascal VOC file per image
+  'jsonl': one JSON line per image with its info, annotations and a
+           reference to its pointcloud, one part-<shard>.jsonl file per shard
+
+"""
+
+import os
+import re
+import json
+import itertools
+import concurrent.futures as futures
+from collections import defaultdict
+from xml.sax.saxutils import escape
+
+import numpy as np
+
+from cocoplus.utils.coco_utils import xywh_to_xyxy, xywh_to_yolo
+from cocoplus.utils.stream import iter_tables
+
+FORMATS = ['yolo', 'voc', 'jsonl']
+
+_VOC_OBJECT = """  <object>
+    <name>{name}</name>
+    <pose>Unspecified</pose>
+    <truncated>0</truncated>
+    <difficult>{difficult}</difficult>{extra}
+    <bndbox>
+      <xmin>{0}</xmin>
+      <ymin>{1}</ymin>
+      <xmax>{2}</xmax>
+      <ymax>{3}</ymax>
+    </bndbox>
+  </object>
+"""
+
+
+def _pcRef(pc):
+    return None if pc is None else {'id': pc['id'], 'num_points': len(pc['points'])}
+
+
+def _tables(dataset):
+    """
+    Access to the images and the annotations of every image of a COCO_PLUS
+    instance, a dataset dict or an annotation file.
+    :return (tuple): images iterable, annotations of an image ID, pointcloud
+        reference of an image ID, and categories sorted by ID
+    """
+
+    if isinstance(dataset, (str, dict)):
+        # A single pass grouping the annotations by image, the pointclouds
+        # are only kept as references
+        images, cats = [], []
+        img_anns, pc_refs = defaultdict(list), {}
+        for table, obj in iter_tables(dataset):
+            if table == 'images':
+                images.append(obj)
+            elif table == 'annotations':
+                img_anns[obj['image_id']].append(obj)
+            elif table == 'pointclouds':
+                pc_refs[obj['img_id']] = _pcRef(obj)
+            else:
+                cats.append(obj)
+        cats.sort(key=lambda c: c['id'])
+        return images, lambda img_id: img_anns.get(img_id, []), pc_refs.get, cats
+
+    # COCO_PLUS and COCO_PLUS_SQL: images are streamed, their annotations
+    # read through the index
+    cats = sorted(dataset.cats.values(), key=lambda c: c['id'])
+    return (dataset._iterObjects('images'),
+            lambda img_id: dataset.imgToAnns.get(img_id, []),
+            lambda img_id: _pcRef(dataset.imgToPc.get(img_id)), cats)
+
+
+def _labelPath(out_dir, img, ext, made_dirs):
+    # file_name is relative to the image root: drive, root and '..' parts
+    # are dropped so that the labels cannot be written outside out_dir
+    parts = [part for part in re.split(r'[\\/]+',
+                                       os.path.splitdrive(img['file_name'])[1])
+             if part not in ('', os.curdir, os.pardir)]
+    name = os.path.join(*parts) if parts else str(img['id'])
+    path = os.path.join(out_dir, os.path.splitext(name)[0] + ext)
+    assert os.path.abspath(path).startswith(os.path.join(os.path.abspath(out_dir), '')), \
+        "Label path {} is outside {}.".format(path, out_dir)
+    dirname = os.path.dirname(path)
+    if dirname not in made_dirs:
+        os.makedirs(dirname, exist_ok=True)
+        made_dirs.add(dirname)
+    return path
+
+
+def _shardBoxes(images, anns):
+    """
+    Boxes of a shard as one array, with the image size of every box.
+    :return (tuple): boxes, heights, widths and per-image box offsets
+    """
+
+    counts = [len(img_anns) for img_anns in anns]
+    offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+    boxes = np.array([ann['bbox'] for img_anns in anns for ann in img_anns],
+                     dtype=np.float64).reshape(-1, 4)
+    heights = np.repeat([img['height'] for img in images], counts)
+    widths = np.repeat([img['width'] for img in images], counts)
+    return boxes, heights, widths, offsets
+
+
+##------------------------------------------------------------------------------
+def _writeYolo(out_dir, images, anns, cat_index):
+    boxes, heights, widths, offsets = _shardBoxes(images, anns)
+    boxes = xywh_to_yolo(boxes, heights, widths).tolist()
+    classes = [cat_index[ann['category_id']]
+               for img_anns in anns for ann in img_anns]
+
+    made_dirs = set()
+    for i, img in enumerate(images):
+        lines = ['%d %.6f %.6f %.6f %.6f\n' % (classes[k], *boxes[k])
+                 for k in range(offsets[i], offsets[i+1])]
+        path = _labelPath(out_dir, img, '.txt', made_dirs)
+        with open(path, 'w') as f:
+            f.write(''.join(lines))
+    return len(images)
+
+
+##------------------------------------------------------------------------------
+def _writeVoc(out_dir, images, anns, cat_names):
+    boxes, _, _, offsets = _shardBoxes(images, anns)
+    # VOC boxes are 1-based with inclusive corners
+    boxes = np.rint(xywh_to_xyxy(boxes) + 1).astype(np.int64)
+
+    made_dirs = set()
+    for i, (img, img_anns) in enumerate(zip(images, anns)):
+        objects = []
+        for ann, box in zip(img_anns, boxes[offsets[i]:offsets[i+1]].tolist()):
+            extra = ''
+            if ann.get('distance') is not None:
+                extra = '\n    <distance>{}</distance>'.format(ann['distance'])
+            objects.append(_VOC_OBJECT.format(
+                *box,
+                name=escape(cat_names[ann['category_id']]),
+                difficult=int(bool(ann.get('iscrowd', 0))),
+                extra=extra))
+
+        xml = ('<annotation>\n'
+               '  <filename>{}</filename>\n'
+               '  <size>\n'
+               '    <width>{}</width>\n'
+               '    <height>{}</height>\n'
+               '    <depth>3</depth>\n'
+               '  </size>\n'
+               '  <segmented>0</segmented>\n'
+               '{}</annotation>\n').format(escape(os.path.basename(img['file_name'])),
+                                           img['width'], img['height'],
+                                           ''.join(objects))
+        path = _labelPath(out_dir, img, '.xml', made_dirs)
+        with open(path, 'w') as f:
+            f.write(xml)
+    return len(images)
+
+
+##------------------------------------------------------------------------------
+def _writeJsonl(path, images, anns, pcs):
+    with open(path, 'w') as f:
+        for img, img_anns, pc in zip(images, anns, pcs):
+            f.write(json.dumps({'image': img,
+                                'annotations': img_anns,
+                                'pointcloud': pc}) + '\n')
+    return len(images)
+
+
+##------------------------------------------------------------------------------
+def _exportShard(fmt, out_dir, shard, images, anns, pcs, cats):
+    """
+    Convert and write one shard of images.
+    :param anns (list): list of annotations of every image
+    :param pcs (list): pointcloud reference of every image, or None
+    :param cats (list): categories of the dataset, sorted by ID
+    :return (int): number of exported images
+    """
+
+    if fmt == 'yolo':
+        cat_index = {cat['id']: i for i, cat in enumerate(cats)}
+        return _writeYolo(os.path.join(out_dir, 'labels'), images, anns,
+                          cat_index)
+    if fmt == 'voc':
+        cat_names = {cat['id']: cat['name'] for cat in cats}
+        return _writeVoc(os.path.join(out_dir, 'Annotations'), images, anns,
+                         cat_names)
+    path = os.path.join(out_dir, 'part-{:05d}.jsonl'.format(shard))
+    return _writeJsonl(path, images, anns, pcs)
+
+
+##------------------------------------------------------------------------------
+def export_dataset(dataset, out_dir, fmt='yolo', img_ids=None, num_workers=4,
+                   shard_size=1000, max_pending=None):
+    """
+    Export a dataset to the YOLO, Pascal VOC or per-image JSON Lines format.
+
+    :param dataset: COCO_PLUS instance, dataset dict or annotation file
+    :param out_dir (str): output directory
+    :param fmt (str): 'yolo', 'voc' or 'jsonl'
+    :param img_ids (list): images to export, all images if None
+    :param num_workers (int): number of writing processes, shards are written
+        in the calling process if num_workers <= 1
+    :param shard_size (int): number of images per shard
+    :param max_pending (int): maximum number of shards in flight, defaults
+        to 2 * num_workers
+    :return (dict): number of exported images, annotations and shards
+    """
+
+    assert fmt in FORMATS, "Export format must be one of {}.".format(FORMATS)
+    os.makedirs(out_dir, exist_ok=True)
+    images, get_anns, get_pc, cats = _tables(dataset)
+    if img_ids is not None:
+        keep = set(img_ids)
+        images = (img for img in images if img['id'] in keep)
+    images = iter(images)
+
+    if fmt == 'yolo':
+        with open(os.path.join(out_dir, 'classes.txt'), 'w') as f:
+            f.write(''.join(cat['name'] + '\n' for cat in cats))
+
+    num_anns = 0
+
+    def _shards():
+        nonlocal num_anns
+        for shard in itertools.count():
+            shard_imgs = list(itertools.islice(images, shard_size))
+            if not shard_imgs:
+                return
+            shard_anns = [get_anns(img['id']) for img in shard_imgs]
+            shard_pcs = [get_pc(img['id']) for img in shard_imgs]
+            num_anns += sum(len(anns) for anns in shard_anns)
+            yield (fmt, out_dir, shard, shard_imgs, shard_anns, shard_pcs, cats)
+
+    num_imgs, num_shards = 0, 0
+    if num_workers <= 1:
+        for args in _shards():
+            num_imgs += _exportShard(*args)
+            num_shards += 1
+    else:
+        max_pending = max_pending or 2 * num_workers
+        with futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            pending = set()
+            for args in _shards():
+                if len(pending) >= max_pending:
+                    done, pending = futures.wait(
+                        pending, return_when=futures.FIRST_COMPLETED)
+                    num_imgs += sum(f.result() for f in done)
+                pending.add(pool.submit(_exportShard, *args))
+                num_shards += 1
+            num_imgs += sum(f.result() for f in futures.as_completed(pending))
+
+    return {'images': num_imgs, 'annotations': num_anns, 'shards': num_shards}
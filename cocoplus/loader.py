@@ -0,0 +1,130 @@
+"""
+Multi-threaded, prefetching sample iterator for COCO_PLUS datasets.
+
+"""
+
+import collections
+import concurrent.futures as futures
+
+
+class SampleIterator(object):
+    """
+    Iterate over the (image, annotations, pointcloud) samples of a COCO_PLUS
+    dataset while decoding the images on a pool of threads.
+
+    OpenCV releases the GIL while reading and decoding, so a thread pool is
+    enough to overlap disk I/O and decode across cores. At most `prefetch`
+    images are in flight at any time, which bounds the memory used by the
+    iterator regardless of the dataset size.
+    """
+
+    def __init__(self,
+                 coco,
+                 img_ids=None,
+                 imgs_dir=None,
+                 num_threads=4,
+                 prefetch=16,
+                 ordered=True,
+                 resize=None,
+                 img_format='BGR',
+                 shard_id=0,
+                 num_shards=1):
+        """
+        :param coco (COCO_PLUS): the dataset to iterate over
+        :param img_ids (list): image IDs to iterate over, all images if None
+        :param imgs_dir (str): image directory, defaults to coco.imgs_dir
+        :param num_threads (int): number of decoding threads
+        :param prefetch (int): maximum number of images decoded ahead
+        :param ordered (bool): yield samples in the order of img_ids. If False,
+            samples are yielded as soon as they are decoded.
+        :param resize: resize the images on decode, either a scale factor
+            (float) or a (width, height) tuple
+        :param img_format (str): 'BGR' or 'RGB'
+        :param shard_id (int): index of this shard (e.g. the worker rank)
+        :param num_shards (int): total number of shards (e.g. the world size)
+        """
+
+        assert num_threads > 0, "num_threads must be positive."
+        assert prefetch > 0, "prefetch must be positive."
+        assert num_shards > 0, "num_shards must be positive."
+        assert 0 <= shard_id < num_shards, \
+            "shard_id must be in [0, {})".format(num_shards)
+
+        if img_ids is None:
+            img_ids = list(coco.imgs.keys())
+
+        self.coco = coco
+        self.img_ids = list(img_ids)[shard_id::num_shards]
+        self.imgs_dir = imgs_dir
+        self.num_threads = num_threads
+        self.prefetch = prefetch
+        self.ordered = ordered
+        self.resize = resize
+        self.img_format = img_format
+
+    def __len__(self):
+        return len(self.img_ids)
+
+    def __iter__(self):
+        if self.ordered:
+            return self._iterOrdered()
+        return self._iterUnordered()
+
+    ##-------------------------------------------------------------------------
+    def _load(self, img_id):
+        """
+        Decode an image, runs on the worker threads.
+        """
+        img = self.coco.loadImg(img_id,
+                                imgs_dir=self.imgs_dir,
+                                resize=self.resize,
+                                img_format=self.img_format)
+        return img_id, img
+
+    ##-------------------------------------------------------------------------
+    def _sample(self, img_id, img):
+        """
+        Assemble the (image, annotations, pointcloud) tuple for an image.
+        """
+        anns = self.coco.imgToAnns.get(img_id, [])
+        pc = self.coco.imgToPc.get(img_id, None)
+        return img, anns, pc
+
+    ##-------------------------------------------------------------------------
+    def _iterOrdered(self):
+        pending = collections.deque()
+        ids = iter(self.img_ids)
+
+        with futures.ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            try:
+                for img_id in ids:
+                    pending.append(pool.submit(self._load, img_id))
+                    if len(pending) >= self.prefetch:
+                        yield self._sample(*pending.popleft().result())
+
+                while pending:
+                    yield self._sample(*pending.popleft().result())
+            finally:
+                for fut in pending:
+                    fut.cancel()
+
+    ##-------------------------------------------------------------------------
+    def _iterUnordered(self):
+        pending = set()
+        ids = iter(self.img_ids)
+
+        with futures.ThreadPoolExecutor(max_workers=self.num_threads) as pool:
+            try:
+                for img_id in ids:
+                    pending.add(pool.submit(self._load, img_id))
+                    if len(pending) >= self.prefetch:
+                        done, pending = futures.wait(
+                            pending, return_when=futures.FIRST_COMPLETED)
+                        for fut in done:
+                            yield self._sample(*fut.result())
+
+                for fut in futures.as_completed(pending):
+                    yield self._sample(*fut.result())
+            finally:
+                for fut in pending:
+                    fut.cancel()
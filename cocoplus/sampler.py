@@ -0,0 +1,277 @@
+"""
+Image samplers for training on COCO_PLUS datasets.
+
+The per-image category and distance-bin histograms are computed once with
+vectorized passes over the annotation arrays, and can be persisted next to
+the annotation file. The sampling strategies are:
+
+  'uniform':        every image once per epoch, shuffled
+  'repeat_factor':  images repeated by the rarest category they contain,
+                    r = max(1, sqrt(thresh / f)) with f the fraction of images
+                    containing the category (LVIS repeat factor sampling)
+  'class_balanced': pick a category uniformly, then one of its images
+  'distance':       pick a distance bin uniformly, then one of the images
+                    with objects in it
+
+Epochs are deterministic functions of (seed, epoch), and are split across
+num_shards workers like iterSamples, so that all workers agree on them.
+
+"""
+
+import os
+import json
+
+import numpy as np
+
+from cocoplus.utils import metrics
+from cocoplus.utils.coco_utils import DISTANCE_BINS
+
+STRATEGIES = ['uniform', 'repeat_factor', 'class_balanced', 'distance']
+_ARRAYS = ['img_ids', 'cat_ids', 'pair_img', 'pair_cat', 'pair_count',
+           'cat_ptr', 'dist_hist']
+
+
+def sampler_cache_path(annotation_file):
+    """
+    Returns the path of the sampler cache belonging to an annotation file
+    :param annotation_file (str): e.g. annotations/instances_val.json
+    :return (str): e.g. annotations/instances_val.sampler.npz
+    """
+
+    return os.path.splitext(annotation_file)[0] + '.sampler.npz'
+
+
+##------------------------------------------------------------------------------
+def build_histograms(coco, distance_bins=DISTANCE_BINS):
+    """
+    Compute the per-image category and distance-bin histograms.
+
+    The category histogram is sparse: (pair_img, pair_cat, pair_count) rows
+    sorted by category then image, with cat_ptr the start of every category.
+    The distance histogram is a dense (num_imgs, num_bins) array.
+
+    :param coco (COCO_PLUS): the dataset
+    :param distance_bins (tuple): edges of the distance bins
+    :return (dict): the histogram arrays, indexes refer to img_ids and cat_ids
+    """
+
+    img_ids = np.unique(np.fromiter(coco.imgs, dtype=np.int64, count=len(coco.imgs)))
+    ann_imgs, ann_cats, ann_dists = coco._annArrays()
+    cat_ids = np.union1d(np.fromiter(coco.cats, dtype=np.int64,
+                                     count=len(coco.cats)), ann_cats)
+    num_imgs, num_cats = len(img_ids), len(cat_ids)
+
+    # Annotations of missing images are ignored
+    img_idx = np.searchsorted(img_ids, ann_imgs)
+    valid = img_idx < num_imgs
+    valid[valid] = img_ids[img_idx[valid]] == ann_imgs[valid]
+    img_idx, ann_dists = img_idx[valid], ann_dists[valid]
+    cat_idx = np.searchsorted(cat_ids, ann_cats[valid])
+
+    pairs, pair_count = np.unique(cat_idx * num_imgs + img_idx, return_counts=True)
+    pair_cat, pair_img = np.divmod(pairs, max(num_imgs, 1))
+
+    edges = np.asarray(distance_bins, dtype=np.float64)
+    num_bins = len(edges) - 1
+    bins = np.digitize(ann_dists, edges) - 1
+    known = (bins >= 0) & (bins < num_bins) & ~np.isnan(ann_dists)
+    dist_hist = np.bincount(img_idx[known] * num_bins + bins[known],
+                            minlength=num_imgs * num_bins)
+
+    return {'img_ids': img_ids,
+            'cat_ids': cat_ids,
+            'pair_img': pair_img.astype(np.int32),
+            'pair_cat': pair_cat.astype(np.int32),
+            'pair_count': pair_count.astype(np.int32),
+            'cat_ptr': np.searchsorted(pair_cat, np.arange(num_cats + 1)),
+            'dist_hist': dist_hist.reshape(num_imgs, num_bins).astype(np.int32)}
+
+
+def _signature(coco, distance_bins):
+    """
+    Identifies the dataset a histogram cache was built from, without reading
+    the annotations: the state of the annotation file or database, see
+    COCO_PLUS._sourceSignature. None if the dataset has unsaved changes.
+    """
+
+    source = coco._sourceSignature()
+    if source is None:
+        return None
+    return json.dumps({'source': source,
+                       'distance_bins': [float(b) for b in distance_bins]})
+
+
+##------------------------------------------------------------------------------
+class Sampler(object):
+    """
+    Sample the image IDs of a dataset with one of the STRATEGIES.
+
+    Iterating over the sampler yields the image IDs of the current epoch for
+    this shard, set it with setEpoch() before every epoch.
+    """
+
+    def __init__(self,
+                 coco,
+                 strategy='class_balanced',
+                 num_samples=None,
+                 seed=0,
+                 shard_id=0,
+                 num_shards=1,
+                 repeat_thresh=0.001,
+                 distance_bins=DISTANCE_BINS,
+                 cache_file=None,
+                 rebuild=False):
+        """
+        :param coco (COCO_PLUS): the dataset
+        :param strategy (str): one of STRATEGIES
+        :param num_samples (int): images per epoch of the 'class_balanced' and
+            'distance' strategies, the number of images if None
+        :param seed (int): random seed, shared by all the shards
+        :param shard_id (int): index of this shard (e.g. the worker rank)
+        :param num_shards (int): total number of shards (e.g. the world size)
+        :param repeat_thresh (float): category frequency below which images
+            are repeated by the 'repeat_factor' strategy
+        :param distance_bins (tuple): edges of the distance bins
+        :param cache_file (str): histogram cache, loaded if it matches the
+            dataset and written otherwise, e.g. sampler_cache_path(ann_file).
+            Not used while the dataset has changes not saved to its
+            annotation file.
+        :param rebuild (bool): ignore an existing cache file
+        """
+
+        assert strategy in STRATEGIES, \
+            "Strategy must be one of {}.".format(STRATEGIES)
+        assert num_shards > 0, "num_shards must be positive."
+        assert 0 <= shard_id < num_shards, \
+            "shard_id must be in [0, {})".format(num_shards)
+
+        self.coco = coco
+        self.strategy = strategy
+        self.seed = seed
+        self.shard_id = shard_id
+        self.num_shards = num_shards
+        self.repeat_thresh = repeat_thresh
+        self.distance_bins = tuple(distance_bins)
+        self.epoch = 0
+        self._epoch_ids = None
+
+        with metrics.span('sampler.setup'):
+            self._setHistograms(self._loadHistograms(cache_file, rebuild))
+        self.num_samples = len(self.img_ids) if num_samples is None else num_samples
+
+    def __len__(self):
+        return len(self._currentIds())
+
+    def __iter__(self):
+        return iter(self._currentIds().tolist())
+
+    def _currentIds(self):
+        if self._epoch_ids is None or self._epoch_ids[0] != self.epoch:
+            self._epoch_ids = (self.epoch, self.epochIds(self.epoch))
+        return self._epoch_ids[1]
+
+    ##-------------------------------------------------------------------------
+    def _loadHistograms(self, cache_file, rebuild):
+        """
+        Load the histograms from the cache file, or build them and write it.
+        """
+
+        signature = _signature(self.coco, self.distance_bins)
+        if signature is None and cache_file is not None:
+            self.coco.logger.info('dataset has unsaved changes, sampler cache %s '
+                                  'not used', cache_file)
+            cache_file = None
+        if cache_file is not None and not rebuild and os.path.exists(cache_file):
+            with np.load(cache_file) as cache:
+                if str(cache['signature']) == signature:
+                    return {name: cache[name] for name in _ARRAYS}
+            self.coco.logger.info('sampler cache %s is stale, rebuilding', cache_file)
+
+        hists = build_histograms(self.coco, self.distance_bins)
+        if cache_file is not None:
+            tmp_path = cache_file + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, signature=np.array(signature), **hists)
+            os.replace(tmp_path, cache_file)
+        return hists
+
+    def _setHistograms(self, hists):
+        for name in _ARRAYS:
+            setattr(self, name, hists[name])
+
+        # Images of every distance bin, as for the categories
+        imgs, bins = np.nonzero(self.dist_hist)
+        order = np.argsort(bins, kind='stable')
+        self.bin_img = imgs[order]
+        self.bin_ptr = np.searchsorted(bins[order],
+                                       np.arange(self.dist_hist.shape[1] + 1))
+
+    ##-------------------------------------------------------------------------
+    def catFrequencies(self):
+        """
+        :return (nparray): fraction of the images containing each of cat_ids
+        """
+
+        return np.diff(self.cat_ptr) / max(len(self.img_ids), 1)
+
+    def repeatFactors(self):
+        """
+        :return (nparray): repeat factor of each of img_ids
+        """
+
+        freqs = self.catFrequencies()
+        cat_factors = np.maximum(1., np.sqrt(self.repeat_thresh /
+                                             np.maximum(freqs, 1e-12)))
+        factors = np.ones(len(self.img_ids))
+        np.maximum.at(factors, self.pair_img, cat_factors[self.pair_cat])
+        return factors
+
+    ##-------------------------------------------------------------------------
+    @staticmethod
+    def _twoLevel(rng, ptr, members, num_samples):
+        """
+        Pick a group uniformly among the non-empty ones, then a member of it.
+        """
+
+        sizes = np.diff(ptr)
+        groups = np.flatnonzero(sizes)
+        if not len(groups):
+            return np.zeros(0, dtype=np.int64)
+        picked = groups[rng.randint(0, len(groups), num_samples)]
+        offsets = (rng.random_sample(num_samples) * sizes[picked]).astype(np.int64)
+        return members[ptr[picked] + offsets]
+
+    def _epochIndexes(self, epoch):
+        rng = np.random.RandomState([self.seed, epoch])
+        num_imgs = len(self.img_ids)
+        if self.strategy == 'uniform':
+            return rng.permutation(num_imgs)
+        if self.strategy == 'repeat_factor':
+            factors = self.repeatFactors()
+            reps = np.floor(factors).astype(np.int64)
+            reps += rng.random_sample(num_imgs) < factors - reps
+            return rng.permutation(np.repeat(np.arange(num_imgs), reps))
+        if self.strategy == 'class_balanced':
+            return self._twoLevel(rng, self.cat_ptr, self.pair_img, self.num_samples)
+        return self._twoLevel(rng, self.bin_ptr, self.bin_img, self.num_samples)
+
+    def epochIds(self, epoch=0):
+        """
+        Image IDs of an epoch for this shard. The epoch is padded by wrapping
+        around so that all shards get the same number of images.
+        :param epoch (int): epoch number
+        :return (nparray): image IDs
+        """
+
+        idx = self._epochIndexes(epoch)
+        if self.num_shards > 1 and len(idx):
+            total = -(-len(idx) // self.num_shards) * self.num_shards
+            idx = np.resize(idx, total)[self.shard_id::self.num_shards]
+        return self.img_ids[idx]
+
+    def setEpoch(self, epoch):
+        """
+        Set the epoch yielded by the iterator.
+        """
+
+        self.epoch = epoch
@@ -0,0 +1,324 @@
+"""
+Read-only, memory-mapped export of the COCO_PLUS indexes for multi-process
+data loading.
+
+Python dicts and lists of a loaded dataset are copied page by page into every
+forked worker that reads them, since reading an object updates its reference
+count. The shared index stores the same information as flat NumPy arrays and
+JSON blobs in memory-mapped files, which the workers read without touching
+any shared Python object. Place it on a RAM-backed filesystem (e.g. /dev/shm)
+to keep it fully in shared memory.
+
+"""
+
+import os
+import json
+from collections.abc import Mapping
+
+import numpy as np
+
+INDEX_VERSION = 1
+
+
+def _writeBlobs(path, name, objs):
+    """
+    Serialize objects as concatenated JSON blobs.
+    :return (nparray): blob offsets, with len(objs)+1 elements
+    """
+
+    offsets = np.zeros(len(objs) + 1, dtype=np.int64)
+    with open(os.path.join(path, name + '.blob'), 'wb') as f:
+        for i, obj in enumerate(objs):
+            data = json.dumps(obj, separators=(',', ':')).encode('utf-8')
+            f.write(data)
+            offsets[i + 1] = offsets[i] + len(data)
+    return offsets
+
+
+class _BlobMapping(Mapping):
+    """
+    Read-only id -> object mapping over sorted ids and JSON blobs. If rows
+    is given, the i-th sorted id refers to the blob rows[i].
+    """
+
+    def __init__(self, ids, offsets, blob, rows=None):
+        self._ids = ids
+        self._offsets = offsets
+        self._blob = blob
+        self._rows = rows
+
+    def _find(self, key):
+        pos = np.searchsorted(self._ids, key)
+        if pos < len(self._ids) and self._ids[pos] == key:
+            return int(pos)
+        return -1
+
+    def _loadRow(self, row):
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return json.loads(self._blob[start:end].tobytes())
+
+    def _load(self, pos):
+        return self._loadRow(pos if self._rows is None else int(self._rows[pos]))
+
+    def __getitem__(self, key):
+        pos = self._find(key)
+        if pos < 0:
+            raise KeyError(key)
+        return self._load(pos)
+
+    def __contains__(self, key):
+        return self._find(key) >= 0
+
+    def __iter__(self):
+        return (int(i) for i in self._ids)
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class _ImgToAnns(Mapping):
+    """
+    Read-only image id -> annotations mapping over annotations sorted by image.
+    Images without annotations map to an empty list, as in COCO_PLUS.
+    """
+
+    def __init__(self, index):
+        self._index = index
+
+    def __getitem__(self, img_id):
+        if img_id not in self._index.imgs:
+            raise KeyError(img_id)
+        start, end = self._index._imgAnnRange(img_id)
+        if start == end:
+            return []
+        return [self._index.anns._loadRow(row) for row in range(start, end)]
+
+    def __contains__(self, img_id):
+        return img_id in self._index.imgs
+
+    def __iter__(self):
+        return iter(self._index.imgs)
+
+    def __len__(self):
+        return len(self._index.imgs)
+
+
+class SharedIndex(object):
+    """
+    Read-only view of a dataset index exported with export_shared_index.
+    Provides the lookup API of COCO_PLUS: imgs, anns, cats, imgToAnns,
+    imgToPc, getAnnIds, getImgIds, getCatIds, loadAnns, loadImgs and loadCats.
+    """
+
+    def __init__(self, path):
+        """
+        :param path (str): directory of the exported index
+        """
+
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            meta = json.load(f)
+        assert meta['version'] == INDEX_VERSION, \
+            "Shared index version {} not supported.".format(meta['version'])
+
+        arrays = {}
+        for name in meta['arrays']:
+            arrays[name] = np.load(os.path.join(path, name + '.npy'),
+                                   mmap_mode='r')
+        blobs = {}
+        for name in ['imgs', 'anns', 'cats', 'pcs']:
+            blob_path = os.path.join(path, name + '.blob')
+            if os.path.getsize(blob_path):
+                blobs[name] = np.memmap(blob_path, dtype=np.uint8, mode='r')
+            else:
+                blobs[name] = np.zeros(0, dtype=np.uint8)
+
+        self._arrays = arrays
+        self.imgs = _BlobMapping(arrays['img_ids'], arrays['img_off'],
+                                 blobs['imgs'])
+        self.cats = _BlobMapping(arrays['cat_ids'], arrays['cat_off'],
+                                 blobs['cats'])
+        self.imgToPc = _BlobMapping(arrays['pc_img_ids'], arrays['pc_off'],
+                                    blobs['pcs'])
+        # Annotation rows are sorted by image, ann_id_rows maps ids to rows
+        self.anns = _BlobMapping(arrays['ann_ids_sorted'], arrays['ann_off'],
+                                 blobs['anns'], rows=arrays['ann_id_rows'])
+        self.imgToAnns = _ImgToAnns(self)
+
+    ##-------------------------------------------------------------------------
+    def _imgAnnRange(self, img_id):
+        ann_img = self._arrays['ann_img']
+        return (int(np.searchsorted(ann_img, img_id, 'left')),
+                int(np.searchsorted(ann_img, img_id, 'right')))
+
+    ##-------------------------------------------------------------------------
+    def getAnnIds(self, imgIds=[], catIds=[], areaRng=[], iscrowd=None):
+        """
+        Get ann ids that satisfy given filter conditions. default skips that filter
+        :param imgIds  (int array)     : get anns for given imgs
+        :param catIds  (int array)     : get anns for given cats
+        :param areaRng (float array)   : get anns for given area range (e.g. [0 inf])
+        :param iscrowd (boolean)       : get anns for given crowd label (False or True)
+        :return: ids (int array)       : integer array of ann ids
+        """
+
+        imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+        arr = self._arrays
+
+        if len(imgIds) == 0:
+            rows = np.arange(len(arr['ann_ids']))
+        else:
+            rows = [np.arange(*self._imgAnnRange(i)) for i in imgIds]
+            rows = np.concatenate(rows) if rows else np.zeros(0, np.int64)
+
+        keep = np.ones(len(rows), dtype=bool)
+        if len(catIds) != 0:
+            keep &= np.isin(arr['ann_cat'][rows], catIds)
+        if len(areaRng) != 0:
+            area = arr['ann_area'][rows]
+            keep &= (area > areaRng[0]) & (area < areaRng[1])
+        if iscrowd is not None:
+            keep &= arr['ann_iscrowd'][rows] == int(iscrowd)
+
+        return arr['ann_ids'][rows[keep]].tolist()
+
+    ##-------------------------------------------------------------------------
+    def getImgIds(self, imgIds=[], catIds=[]):
+        """
+        Get img ids that satisfy given filter conditions.
+        :param imgIds (int array) : get imgs for given ids
+        :param catIds (int array) : get imgs with all given cats
+        :return: ids (int array)  : integer array of img ids
+        """
+
+        imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+        arr = self._arrays
+
+        if len(imgIds) == 0 and len(catIds) == 0:
+            return arr['img_ids'].tolist()
+
+        ids = np.unique(imgIds) if len(imgIds) else None
+        for cat_id in catIds:
+            pos = np.searchsorted(arr['cat_ids'], cat_id)
+            if pos < len(arr['cat_ids']) and arr['cat_ids'][pos] == cat_id:
+                start, end = arr['cat_img_start'][pos], arr['cat_img_end'][pos]
+                cat_imgs = arr['cat_img_ids'][start:end]
+            else:
+                cat_imgs = np.zeros(0, dtype=np.int64)
+            ids = cat_imgs if ids is None else \
+                np.intersect1d(ids, cat_imgs, assume_unique=True)
+
+        return ids.tolist()
+
+    ##-------------------------------------------------------------------------
+    def getCatIds(self, catNms=[], supNms=[], catIds=[]):
+        """
+        Get cat ids that satisfy given filter conditions.
+        :param catNms (str array)  : get cats for given cat names
+        :param supNms (str array)  : get cats for given supercategory names
+        :param catIds (int array)  : get cats for given cat ids
+        :return: ids (int array)   : integer array of cat ids
+        """
+
+        catNms = catNms if _isArrayLike(catNms) else [catNms]
+        supNms = supNms if _isArrayLike(supNms) else [supNms]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+
+        cats = self.loadCats(list(self.cats))
+        cats = cats if len(catNms) == 0 else [c for c in cats if c['name'] in catNms]
+        cats = cats if len(supNms) == 0 else [c for c in cats if c['supercategory'] in supNms]
+        cats = cats if len(catIds) == 0 else [c for c in cats if c['id'] in catIds]
+        return [cat['id'] for cat in cats]
+
+    ##-------------------------------------------------------------------------
+    def loadAnns(self, ids=[]):
+        """
+        Load anns with the specified ids.
+        :param ids (int array)       : integer ids specifying anns
+        :return: anns (object array) : loaded ann objects
+        """
+        if _isArrayLike(ids):
+            return [self.anns[i] for i in ids]
+        return [self.anns[ids]]
+
+    ##-------------------------------------------------------------------------
+    def loadImgs(self, ids=[]):
+        """
+        Load imgs with the specified ids.
+        :param ids (int array)       : integer ids specifying img
+        :return: imgs (object array) : loaded img objects
+        """
+        if _isArrayLike(ids):
+            return [self.imgs[i] for i in ids]
+        return [self.imgs[ids]]
+
+    ##-------------------------------------------------------------------------
+    def loadCats(self, ids=[]):
+        """
+        Load cats with the specified ids.
+        :param ids (int array)       : integer ids specifying cats
+        :return: cats (object array) : loaded cat objects
+        """
+        if _isArrayLike(ids):
+            return [self.cats[i] for i in ids]
+        return [self.cats[ids]]
+
+
+def _isArrayLike(obj):
+    return hasattr(obj, '__iter__') and hasattr(obj, '__len__')
+
+
+##------------------------------------------------------------------------------
+def export_shared_index(coco, path):
+    """
+    Export the indexes of a dataset to flat arrays and blobs in a directory.
+
+    :param coco (COCO_PLUS): the dataset
+    :param path (str): output directory, e.g. under /dev/shm
+    :return (SharedIndex): the exported index
+    """
+
+    os.makedirs(path, exist_ok=True)
+    arrays = {}
+
+    def _sortedById(objs, key='id'):
+        objs = sorted(objs, key=lambda o: o[key])
+        ids = np.fromiter((o[key] for o in objs), dtype=np.int64, count=len(objs))
+        return objs, ids
+
+    imgs, arrays['img_ids'] = _sortedById(coco.imgs.values())
+    arrays['img_off'] = _writeBlobs(path, 'imgs', imgs)
+
+    cats, arrays['cat_ids'] = _sortedById(coco.cats.values())
+    arrays['cat_off'] = _writeBlobs(path, 'cats', cats)
+
+    pcs, arrays['pc_img_ids'] = _sortedById(coco.imgToPc.values(), 'img_id')
+    arrays['pc_off'] = _writeBlobs(path, 'pcs', pcs)
+
+    # Annotations sorted by image, so that imgToAnns is a contiguous range
+    anns = sorted(coco.anns.values(), key=lambda a: a['image_id'])
+    num_anns = len(anns)
+    arrays['ann_ids'] = np.fromiter((a['id'] for a in anns), np.int64, num_anns)
+    arrays['ann_img'] = np.fromiter((a['image_id'] for a in anns), np.int64, num_anns)
+    arrays['ann_cat'] = np.fromiter((a['category_id'] for a in anns), np.int64, num_anns)
+    arrays['ann_area'] = np.fromiter((a.get('area', 0) for a in anns), np.float64, num_anns)
+    arrays['ann_iscrowd'] = np.fromiter((a.get('iscrowd', 0) for a in anns), np.int8, num_anns)
+    arrays['ann_off'] = _writeBlobs(path, 'anns', anns)
+    arrays['ann_id_rows'] = np.argsort(arrays['ann_ids'], kind='stable')
+    arrays['ann_ids_sorted'] = arrays['ann_ids'][arrays['ann_id_rows']]
+
+    # Unique images of every category, as ranges of one sorted array
+    cat_img = np.unique(np.stack((arrays['ann_cat'], arrays['ann_img'])), axis=1) \
+        if num_anns else np.zeros((2, 0), dtype=np.int64)
+    arrays['cat_img_ids'] = cat_img[1]
+    arrays['cat_img_start'] = np.searchsorted(cat_img[0], arrays['cat_ids'], 'left')
+    arrays['cat_img_end'] = np.searchsorted(cat_img[0], arrays['cat_ids'], 'right')
+
+    for name, arr in arrays.items():
+        np.save(os.path.join(path, name + '.npy'), arr)
+    with open(os.path.join(path, 'meta.json'), 'w') as f:
+        json.dump({'version': INDEX_VERSION, 'arrays': sorted(arrays)}, f)
+
+    return SharedIndex(path)
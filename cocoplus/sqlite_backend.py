@@ -0,0 +1,642 @@
+"""
+Out-of-core COCO_PLUS dataset stored in a local SQLite database.
+
+"""
+
+import os
+import json
+import time
+import sqlite3
+import threading
+import functools
+from collections import OrderedDict
+from collections.abc import Mapping
+
+import numpy as np
+from pycocotools.coco import _isArrayLike
+
+from cocoplus.coco import COCO_PLUS, _popFields
+from cocoplus.storage import shard_index_path
+from cocoplus.utils import metrics
+from cocoplus.utils.stream import iter_json_items
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, file_name TEXT,
+    data TEXT);
+CREATE TABLE IF NOT EXISTS annotations (id INTEGER PRIMARY KEY,
+    image_id INTEGER, category_id INTEGER, distance REAL, area REAL,
+    iscrowd INTEGER, data TEXT);
+CREATE TABLE IF NOT EXISTS categories (id INTEGER PRIMARY KEY, name TEXT,
+    supercategory TEXT, data TEXT);
+CREATE TABLE IF NOT EXISTS pointclouds (id INTEGER PRIMARY KEY,
+    img_id INTEGER, data TEXT);
+CREATE INDEX IF NOT EXISTS ann_image_id ON annotations (image_id);
+CREATE INDEX IF NOT EXISTS ann_category_id ON annotations (category_id);
+CREATE INDEX IF NOT EXISTS ann_distance ON annotations (distance);
+CREATE INDEX IF NOT EXISTS pc_img_id ON pointclouds (img_id);
+"""
+
+
+def _updated(obj, fields, removed):
+    """
+    Copy of an object with updated fields, and without the removed ones.
+    """
+
+    obj = dict(obj, **fields)
+    _popFields(obj, removed)
+    return obj
+
+
+class SQLiteStore(object):
+    """
+    Thread-safe access to the dataset tables, with an LRU cache of the rows
+    on top of the SQLite page cache. Rows are decoded on every access, so
+    that modifying a returned object does not alter the cache.
+    """
+
+    def __init__(self, db_path, cache_size=100000, page_cache_mb=256):
+        """
+        :param db_path (str): database file, created if it does not exist
+        :param cache_size (int): number of rows kept in memory
+        :param page_cache_mb (int): size of the SQLite page cache in MB
+        """
+
+        self.db_path = db_path
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._lock = threading.RLock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('PRAGMA cache_size={}'.format(-1024 * page_cache_mb))
+        self.conn.executescript(_SCHEMA)
+
+    ##-------------------------------------------------------------------------
+    def query(self, sql, params=()):
+        with self._lock:
+            return self.conn.execute(sql, params).fetchall()
+
+    ##-------------------------------------------------------------------------
+    def get(self, table, key, column='id'):
+        """
+        Return the object of a table row, or None.
+        """
+
+        cache_key = (table, column, key)
+        with self._lock:
+            data = self._cache.get(cache_key)
+            if data is not None:
+                self._cache.move_to_end(cache_key)
+                return json.loads(data)
+
+            row = self.conn.execute(
+                'SELECT data FROM {} WHERE {}=? LIMIT 1'.format(table, column),
+                (key,)).fetchone()
+            if row is None:
+                return None
+            self._cache[cache_key] = row[0]
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            return json.loads(row[0])
+
+    ##-------------------------------------------------------------------------
+    def insert(self, table, rows):
+        """
+        Insert rows of (indexed columns..., object) into a table.
+        """
+
+        rows = [row[:-1] + (json.dumps(row[-1], separators=(',', ':')),)
+                for row in rows]
+        if not rows:
+            return
+        marks = ','.join('?' * len(rows[0]))
+        with self._lock:
+            self.conn.executemany(
+                'INSERT INTO {} VALUES ({})'.format(table, marks), rows)
+
+    ##-------------------------------------------------------------------------
+    def delete(self, table, obj_id, column='id'):
+        """
+        Delete the rows of a table matching a key, and their cached objects.
+        """
+
+        with self._lock:
+            self.conn.execute('DELETE FROM {} WHERE {}=?'.format(table, column),
+                              (obj_id,))
+            self.evict(table, obj_id, column)
+
+    ##-------------------------------------------------------------------------
+    def clear(self, table):
+        """
+        Delete all the rows of a table.
+        """
+
+        with self._lock:
+            self.conn.execute('DELETE FROM {}'.format(table))
+            for cache_key in [k for k in self._cache if k[0] == table]:
+                del self._cache[cache_key]
+
+    ##-------------------------------------------------------------------------
+    def setColumn(self, table, ids, column, value):
+        """
+        Set an indexed column, and the same field of the objects, of rows
+        given by ID.
+        """
+
+        ids = [int(i) for i in ids]
+        with self._lock:
+            self.conn.execute(
+                "UPDATE {0} SET {1}=?, data=json_set(data, '$.{1}', ?) "
+                "WHERE id IN (SELECT value FROM json_each(?))".format(table, column),
+                (value, value, json.dumps(ids)))
+            for obj_id in ids:
+                self.evict(table, obj_id)
+
+    ##-------------------------------------------------------------------------
+    def maxId(self, table):
+        """
+        :return (int): largest ID of a table, -1 if it is empty
+        """
+
+        max_id = self.query('SELECT MAX(id) FROM {}'.format(table))[0][0]
+        return -1 if max_id is None else max_id
+
+    ##-------------------------------------------------------------------------
+    def evict(self, table, key, column='id'):
+        with self._lock:
+            self._cache.pop((table, column, key), None)
+
+    ##-------------------------------------------------------------------------
+    def iterObjects(self, table, batch_size=10000):
+        """
+        Iterate over the objects of a table in id order, in bounded batches.
+        """
+
+        last_id = None
+        while True:
+            if last_id is None:
+                rows = self.query('SELECT id, data FROM {} ORDER BY id LIMIT ?'
+                                  .format(table), (batch_size,))
+            else:
+                rows = self.query('SELECT id, data FROM {} WHERE id>? ORDER BY id '
+                                  'LIMIT ?'.format(table), (last_id, batch_size))
+            if not rows:
+                return
+            for _, data in rows:
+                yield json.loads(data)
+            last_id = rows[-1][0]
+
+    ##-------------------------------------------------------------------------
+    def getMeta(self, key, default=None):
+        rows = self.query('SELECT value FROM meta WHERE key=?', (key,))
+        return json.loads(rows[0][0]) if rows else default
+
+    ##-------------------------------------------------------------------------
+    def setMeta(self, key, value):
+        with self._lock:
+            self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                              (key, json.dumps(value)))
+
+    ##-------------------------------------------------------------------------
+    def commit(self):
+        with self._lock:
+            self.conn.commit()
+
+    ##-------------------------------------------------------------------------
+    def close(self):
+        with self._lock:
+            self.conn.commit()
+            self.conn.close()
+
+
+class _TableView(Mapping):
+    """
+    Read-only id -> object mapping over a table.
+    """
+
+    def __init__(self, store, table, column='id'):
+        self._store = store
+        self._table = table
+        self._column = column
+
+    def __getitem__(self, key):
+        obj = self._store.get(self._table, key, self._column)
+        if obj is None:
+            raise KeyError(key)
+        return obj
+
+    def __contains__(self, key):
+        return bool(self._store.query(
+            'SELECT 1 FROM {} WHERE {}=? LIMIT 1'.format(self._table, self._column),
+            (key,)))
+
+    def __iter__(self):
+        last = None
+        while True:
+            if last is None:
+                rows = self._store.query(
+                    'SELECT {0} FROM {1} ORDER BY {0} LIMIT 10000'.format(
+                        self._column, self._table))
+            else:
+                rows = self._store.query(
+                    'SELECT {0} FROM {1} WHERE {0}>? ORDER BY {0} LIMIT 10000'
+                    .format(self._column, self._table), (last,))
+            if not rows:
+                return
+            for row in rows:
+                yield row[0]
+            last = rows[-1][0]
+
+    def __len__(self):
+        return self._store.query('SELECT COUNT(*) FROM {}'.format(self._table))[0][0]
+
+
+class _GroupView(Mapping):
+    """
+    Read-only key -> list mapping over the rows of a table sharing a column
+    value. Missing keys map to an empty list, like the defaultdict indexes
+    of COCO_PLUS.
+    """
+
+    def __init__(self, store, sql_list, sql_keys, decode=True):
+        self._store = store
+        self._sql_list = sql_list
+        self._sql_keys = sql_keys
+        self._decode = decode
+
+    def __getitem__(self, key):
+        rows = self._store.query(self._sql_list, (key,))
+        if self._decode:
+            return [json.loads(row[0]) for row in rows]
+        return [row[0] for row in rows]
+
+    def __iter__(self):
+        return (row[0] for row in self._store.query(self._sql_keys))
+
+    def __len__(self):
+        return len(self._store.query(self._sql_keys))
+
+
+class COCO_PLUS_SQL(COCO_PLUS):
+    """
+    COCO_PLUS dataset stored in a SQLite database instead of in memory.
+
+    imgs, anns, imgToAnns, catToImgs, pointclouds and imgToPc are read-only
+    mappings that query the database, and addSample, addCategory, getAnnIds,
+    getImgIds and loadAnns work as usual on datasets larger than RAM.
+    Categories are few and kept in memory. Objects returned by the mappings
+    are decoded from the database, modifying them does not update it.
+    """
+
+    def __init__(self,
+                 db_path,
+                 annotation_file=None,
+                 logging_level="INFO",
+                 imgs_dir=None,
+                 img_cache_size=0,
+                 cache_size=100000):
+        """
+        :param db_path (str): database file, created if it does not exist
+        :param annotation_file (str): COCO annotation file, imported if the
+            database is empty. Also the default output of saveAnnsToDisk.
+        :param logging_level (str): set the logging level
+        :param imgs_dir (str): directory of the dataset images
+        :param img_cache_size (int): size in bytes of the decoded image cache
+        :param cache_size (int): number of rows kept in memory
+        """
+
+        super(COCO_PLUS_SQL, self).__init__(logging_level=logging_level,
+                                            imgs_dir=imgs_dir,
+                                            img_cache_size=img_cache_size)
+        self.store = SQLiteStore(db_path, cache_size=cache_size)
+        self.annotation_file = annotation_file
+        self._bindViews()
+
+        if annotation_file is not None and len(self.imgs) == 0 and \
+                os.path.exists(annotation_file):
+            self.importJson(annotation_file)
+
+    ##-------------------------------------------------------------------------
+    def _bindViews(self):
+        store = self.store
+        self.imgs = _TableView(store, 'images')
+        self.anns = _TableView(store, 'annotations')
+        self.pointclouds = _TableView(store, 'pointclouds')
+        self.imgToPc = _TableView(store, 'pointclouds', 'img_id')
+        self.imgToAnns = _GroupView(
+            store, 'SELECT data FROM annotations WHERE image_id=? ORDER BY id',
+            'SELECT DISTINCT image_id FROM annotations')
+        self.catToImgs = _GroupView(
+            store, 'SELECT DISTINCT image_id FROM annotations WHERE category_id=?',
+            'SELECT DISTINCT category_id FROM annotations', decode=False)
+        self.createIndex()
+
+    ##-------------------------------------------------------------------------
+    def createIndex(self):
+        """
+        The database is the index, only the categories are loaded.
+        """
+
+        categories = list(self.store.iterObjects('categories'))
+        self.dataset = {'info': self.store.getMeta('info', {}),
+                        'licenses': self.store.getMeta('licenses', []),
+                        'categories': categories}
+        self.cats = {cat['id']: cat for cat in categories}
+        self.catNameToId = {cat['name']: cat['id'] for cat in categories}
+        self.catIndex.reset()
+
+        # New IDs continue after the stored ones, also in a new process
+        for name, table in [('IMG_ID', 'images'), ('ANN_ID', 'annotations'),
+                            ('PCL_ID', 'pointclouds'), ('CAT_ID', 'categories')]:
+            setattr(COCO_PLUS, name, max(getattr(COCO_PLUS, name),
+                                         self.store.maxId(table) + 1))
+
+    ##-------------------------------------------------------------------------
+    def create_new_dataset(self, dataset_dir, split, **kwargs):
+        """
+        Create a new COCO-style dataset, see COCO_PLUS.create_new_dataset.
+        The database keeps the annotations, the annotation file is written by
+        saveAnnsToDisk.
+        """
+
+        annotation_file = self.annotation_file
+        super(COCO_PLUS_SQL, self).create_new_dataset(dataset_dir, split, **kwargs)
+        # saveAnnsToDisk writes to the annotation file given to __init__, if any
+        self.annotation_file = annotation_file or self.annotation_file
+        self.store.setMeta('info', self.dataset['info'])
+        self.store.setMeta('licenses', self.dataset['licenses'])
+        self._bindViews()
+
+    ##-------------------------------------------------------------------------
+    def _checkNewDataset(self):
+        """
+        A new dataset needs an empty database, the annotation file is only
+        the output of saveAnnsToDisk.
+        """
+
+        assert len(self.imgs) == 0 and not self.cats, \
+            "Database {} already holds a dataset.".format(self.store.db_path)
+
+    ##-------------------------------------------------------------------------
+    def _insertImg(self, img_info):
+        self.store.insert('images', [(img_info['id'], img_info['file_name'],
+                                      img_info)])
+
+    def _insertAnn(self, ann):
+        self.store.insert('annotations', [self._annRow(ann)])
+        self.catIndex.invalidate(ann['category_id'])
+        metrics.count('annotations_indexed')
+
+    def _insertPc(self, pc):
+        self.store.insert('pointclouds', [(pc['id'], pc['img_id'], pc)])
+
+    def _insertCat(self, cat):
+        self.store.insert('categories', [(cat['id'], cat['name'],
+                                          cat.get('supercategory'), cat)])
+        self.dataset['categories'].append(cat)
+        self.catNameToId[cat['name']] = cat['id']
+        self.cats[cat['id']] = cat
+        self.catIndex.invalidateCats()
+
+    def _deleteImg(self, img_info):
+        self.store.delete('images', img_info['id'])
+
+    def _deleteAnn(self, ann):
+        self.store.delete('annotations', ann['id'])
+        self.catIndex.invalidate(ann['category_id'])
+
+    def _deletePc(self, pc):
+        self.store.delete('pointclouds', pc['id'])
+        self.store.evict('pointclouds', pc['img_id'], 'img_id')
+
+    def _deleteCat(self, cat):
+        self.store.delete('categories', cat['id'])
+        self.dataset['categories'].remove(cat)
+        del self.cats[cat['id']]
+        self.catNameToId.pop(cat['name'], None)
+        self.catIndex.invalidate(cat['id'])
+        self.catIndex.invalidateCats()
+
+    def _updateAnn(self, ann, fields, removed=()):
+        self._deleteAnn(ann)
+        self._insertAnn(_updated(ann, fields, removed))
+
+    def _updateImg(self, img_info, fields, removed=()):
+        self._deleteImg(img_info)
+        self._insertImg(_updated(img_info, fields, removed))
+
+    def _updatePc(self, pc, fields):
+        self._deletePc(pc)
+        self._insertPc(dict(pc, **fields))
+
+    def _updateCat(self, cat, fields, removed=()):
+        self.store.delete('categories', cat['id'])
+        self.catNameToId.pop(cat['name'], None)
+        cat.update(fields)
+        _popFields(cat, removed)
+        self.store.insert('categories', [(cat['id'], cat['name'],
+                                          cat.get('supercategory'), cat)])
+        self.catNameToId[cat['name']] = cat['id']
+        self.catIndex.invalidateCats()
+
+    def _iterObjects(self, table):
+        return self.store.iterObjects(table)
+
+    def _sourceSignature(self):
+        # The changes are committed to the database and its write-ahead log,
+        # whose sizes and modification times identify its state
+        self.store.commit()
+        paths = [self.store.db_path, self.store.db_path + '-wal']
+        return [[os.path.abspath(path), os.stat(path).st_size,
+                 os.stat(path).st_mtime_ns]
+                for path in paths if os.path.exists(path)]
+
+    @staticmethod
+    def _annRow(ann):
+        return (ann['id'], ann['image_id'], ann['category_id'],
+                ann.get('distance'), ann.get('area'), ann.get('iscrowd', 0), ann)
+
+    ##-------------------------------------------------------------------------
+    def setCategories(self, categories):
+        """
+        Set all the categories for the dataset.
+        :param categories <dict>: categories dictionary in the coco.dataset['categories']
+         format.
+         """
+        self.store.clear('categories')
+        self.dataset['categories'] = []
+        self.cats, self.catNameToId = dict(), dict()
+        for cat in categories:
+            self._insertCat(cat)
+
+    ##-------------------------------------------------------------------------
+    def relabelAnns(self, ann_ids, cat_id):
+        """
+        Change the category of many annotations, in a single UPDATE statement.
+        :param ann_ids (list): annotation IDs
+        :param cat_id (int): new category ID
+        """
+
+        assert cat_id in self.cats, \
+            "Category '{}' does not exist in dataset.".format(cat_id)
+        self.store.setColumn('annotations', ann_ids, 'category_id', cat_id)
+        self.catIndex.reset()
+
+    ##-------------------------------------------------------------------------
+    def getAnnIds(self, imgIds=[], catIds=[], areaRng=[], iscrowd=None,
+                  distRng=[]):
+        """
+        Get ann ids that satisfy given filter conditions. default skips that filter
+        :param imgIds  (int array)     : get anns for given imgs
+        :param catIds  (int array)     : get anns for given cats
+        :param areaRng (float array)   : get anns for given area range (e.g. [0 inf])
+        :param iscrowd (boolean)       : get anns for given crowd label (False or True)
+        :param distRng (float array)   : get anns for given distance range
+        :return: ids (int array)       : integer array of ann ids
+        """
+
+        imgIds = imgIds if _isArrayLike(imgIds) else [imgIds]
+        catIds = catIds if _isArrayLike(catIds) else [catIds]
+
+        # ID lists are bound as a single JSON array, the number of SQL
+        # variables is limited
+        where, params = [], []
+        if len(imgIds):
+            where.append('image_id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps([int(i) for i in imgIds]))
+        if len(catIds):
+            where.append('category_id IN (SELECT value FROM json_each(?))')
+            params.append(json.dumps([int(i) for i in catIds]))
+        if len(areaRng):
+            where.append('area > ? AND area < ?')
+            params.extend(areaRng[:2])
+        if len(distRng):
+            where.append('distance >= ? AND distance < ?')
+            params.extend(distRng[:2])
+        if iscrowd is not None:
+            where.append('iscrowd = ?')
+            params.append(int(iscrowd))
+
+        sql = 'SELECT id FROM annotations'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return [row[0] for row in self.store.query(sql + ' ORDER BY id', params)]
+
+    ##-------------------------------------------------------------------------
+    def _annArrays(self):
+        """
+        The annotation columns, read without decoding the annotations.
+        """
+
+        rows = self.store.query('SELECT image_id, category_id, distance '
+                                'FROM annotations')
+        cols = np.array(rows, dtype=np.float64).reshape(-1, 3)
+        return (cols[:, 0].astype(np.int64), cols[:, 1].astype(np.int64),
+                cols[:, 2])
+
+    ##-------------------------------------------------------------------------
+    def importJson(self, annotation_file, batch_size=10000):
+        """
+        Import a COCO annotation file into the database. The file is streamed
+        and its objects inserted in batches, it is never loaded whole.
+        """
+
+        self.logger.info('importing %s into %s...', annotation_file,
+                         self.store.db_path)
+        tic = time.time()
+        to_row = {
+            'categories': lambda c: (c['id'], c['name'], c.get('supercategory'), c),
+            'images': lambda i: (i['id'], i.get('file_name'), i),
+            'annotations': self._annRow,
+            'pointclouds': lambda p: (p['id'], p['img_id'], p)}
+        meta = {'info': {}, 'licenses': []}
+        table, batch, num_anns = None, [], 0
+
+        with metrics.span('coco.loadJson'):
+            for key, value in iter_json_items(annotation_file):
+                if key == 'licenses':
+                    meta[key].append(value)
+                elif key == 'info':
+                    meta[key] = value
+                elif key in to_row:
+                    if key != table or len(batch) >= batch_size:
+                        self.store.insert(table, batch)
+                        table, batch = key, []
+                    batch.append(to_row[key](value))
+                    num_anns += key == 'annotations'
+            if batch:
+                self.store.insert(table, batch)
+        metrics.count('annotations_indexed', num_anns)
+
+        self.store.setMeta('info', meta['info'])
+        self.store.setMeta('licenses', meta['licenses'])
+        self.store.commit()
+        self.createIndex()
+        self.logger.info('Done (t=%0.2fs)', time.time() - tic)
+
+    ##-------------------------------------------------------------------------
+    @metrics.timed('coco.saveAnnsToDisk')
+    def saveAnnsToDisk(self, ann_file=None):
+        """
+        Commit the database and export it to a standard COCO annotation file.
+        The export is streamed, the dataset is never fully in memory.
+        """
+
+        if ann_file is None:
+            ann_file = self.annotation_file
+        self.store.commit()
+
+        with open(ann_file, 'w') as fp:
+            fp.write('{"info": ' + json.dumps(self.dataset['info']))
+            fp.write(', "licenses": ' + json.dumps(self.dataset['licenses']))
+            for table in ['categories', 'images', 'annotations', 'pointclouds']:
+                fp.write(', "{}": ['.format(table))
+                for i, obj in enumerate(self.store.iterObjects(table)):
+                    if i:
+                        fp.write(', ')
+                    fp.write(json.dumps(obj))
+                fp.write(']')
+            fp.write('}')
+            metrics.count('bytes_written', fp.tell())
+
+        if self.img_shards is not None:
+            self.img_shards.flush(shard_index_path(ann_file))
+
+    ##-------------------------------------------------------------------------
+    def commit(self):
+        """
+        Commit the pending changes to the database. The public methods
+        modifying the dataset commit when they return.
+        """
+
+        self.store.commit()
+
+    def close(self):
+        """
+        Commit and close the database.
+        """
+
+        self.store.close()
+
+
+def _committing(method):
+    """
+    Commit the database after a call to a public method modifying it.
+    """
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.store.commit()
+    return wrapper
+
+
+for _name in ['create_new_dataset', 'addSample', 'addSamples', 'addImageFiles',
+              'addCategory', 'setCategories', 'addAnns', 'updateAnn', 'addImgs',
+              'relabelAnns', 'removeAnns', 'updateImg', 'removeImgs',
+              'updatePointcloud', 'removePointclouds', 'updateCategory',
+              'removeCategory']:
+    setattr(COCO_PLUS_SQL, _name, _committing(getattr(COCO_PLUS_SQL, _name)))
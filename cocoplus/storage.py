@@ -0,0 +1,278 @@
+"""
+Packed image storage: encoded images are appended to large shard files and
+located through an offset index stored next to the annotation file.
+
+"""
+
+import os
+import json
+import mmap
+import concurrent.futures as futures
+from array import array
+
+import numpy as np
+
+from cocoplus.utils.lazy import lazy_import
+
+cv2 = lazy_import('cv2', 'opencv-python')
+
+SHARD_SIZE = 1 << 30    # Default maximum shard size in bytes
+
+
+def shard_index_path(annotation_file):
+    """
+    Returns the path of the shard index belonging to an annotation file
+    :param annotation_file (str): e.g. annotations/instances_val.json
+    :return (str): e.g. annotations/instances_val.shards.npz
+    """
+
+    return os.path.splitext(annotation_file)[0] + '.shards.npz'
+
+
+class ImageShards(object):
+    """
+    Read and append encoded images in packed shard files.
+
+    The index holds one (image id, shard, offset, length) row per image and
+    is loaded as sorted NumPy arrays, so opening a dataset costs a single
+    file read and lookups are a binary search. Shards are memory-mapped on
+    first access, and get() returns a zero-copy view into the map.
+    """
+
+    def __init__(self, index_path, shards_dir=None, shard_size=SHARD_SIZE,
+                 prefix='shard'):
+        """
+        :param index_path (str): path of the shard index (.npz)
+        :param shards_dir (str): directory of the shard files, defaults to
+            the index directory. Only needed when writing.
+        :param shard_size (int): maximum size of a shard file in bytes
+        :param prefix (str): file name prefix of new shard files
+        """
+
+        self.index_path = os.path.abspath(index_path)
+        self.index_dir = os.path.dirname(self.index_path)
+        self.shards_dir = os.path.abspath(shards_dir or self.index_dir)
+        self.shard_size = shard_size
+        self.prefix = prefix
+
+        self._maps = {}
+        self._fp = None
+        self._pending = {}
+        self._new_rows = [array('q') for _ in range(4)]
+
+        if os.path.exists(self.index_path):
+            with np.load(self.index_path) as index:
+                self._ids = index['img_ids']
+                self._shard = index['shard']
+                self._offset = index['offset']
+                self._length = index['length']
+                self.shard_files = [str(f) for f in index['shard_files']]
+        else:
+            self._ids = np.zeros(0, dtype=np.int64)
+            self._shard = np.zeros(0, dtype=np.int64)
+            self._offset = np.zeros(0, dtype=np.int64)
+            self._length = np.zeros(0, dtype=np.int64)
+            self.shard_files = []
+
+    def __len__(self):
+        return len(self._ids) + len(self._pending)
+
+    def __contains__(self, img_id):
+        return img_id in self._pending or self._find(img_id) >= 0
+
+    ##-------------------------------------------------------------------------
+    def ids(self):
+        """
+        :return (nparray): IDs of all the stored images
+        """
+
+        if not self._pending:
+            return self._ids
+        return np.concatenate((self._ids, np.fromiter(self._pending, np.int64)))
+
+    ##-------------------------------------------------------------------------
+    def _find(self, img_id):
+        pos = np.searchsorted(self._ids, img_id)
+        if pos < len(self._ids) and self._ids[pos] == img_id:
+            return pos
+        return -1
+
+    ##-------------------------------------------------------------------------
+    def _shardPath(self, shard):
+        return os.path.join(self.index_dir, self.shard_files[shard])
+
+    ##-------------------------------------------------------------------------
+    def _map(self, shard, end):
+        """
+        Return a memory map of a shard covering at least `end` bytes.
+        """
+
+        mm = self._maps.get(shard)
+        if mm is None or len(mm) < end:
+            if self._fp is not None and shard == len(self.shard_files) - 1:
+                self._fp.flush()
+            with open(self._shardPath(shard), 'rb') as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[shard] = mm
+        return mm
+
+    ##-------------------------------------------------------------------------
+    def get(self, img_id):
+        """
+        Return the encoded bytes of an image without copying them.
+        :param img_id (int): image ID
+        :return (memoryview)
+        """
+
+        if img_id in self._pending:
+            shard, offset, length = self._pending[img_id]
+        else:
+            pos = self._find(img_id)
+            if pos < 0:
+                raise KeyError("Image ID {} not in shards.".format(img_id))
+            shard = int(self._shard[pos])
+            offset = int(self._offset[pos])
+            length = int(self._length[pos])
+
+        mm = self._map(shard, offset + length)
+        return memoryview(mm)[offset:offset + length]
+
+    ##-------------------------------------------------------------------------
+    def read(self, img_id, flags=None):
+        """
+        Decode an image from the shards.
+        :param img_id (int): image ID
+        :param flags (int): OpenCV imread flags, cv2.IMREAD_COLOR if None
+        :return (nparray): the decoded image
+        """
+
+        if flags is None:
+            flags = cv2.IMREAD_COLOR
+        buf = np.frombuffer(self.get(img_id), dtype=np.uint8)
+        return cv2.imdecode(buf, flags)
+
+    ##-------------------------------------------------------------------------
+    def write(self, img_id, data):
+        """
+        Append an encoded image to the current shard, starting a new shard
+        when the current one is full.
+        :param img_id (int): image ID
+        :param data (bytes): encoded image
+        """
+
+        assert img_id not in self, \
+            "Image ID {} already exists in shards.".format(img_id)
+
+        if self._fp is None or \
+                (self._fp.tell() > 0 and
+                 self._fp.tell() + len(data) > self.shard_size):
+            self._openShard()
+
+        shard = len(self.shard_files) - 1
+        offset = self._fp.tell()
+        self._fp.write(data)
+
+        self._pending[img_id] = (shard, offset, len(data))
+        for col, val in zip(self._new_rows, (img_id, shard, offset, len(data))):
+            col.append(val)
+
+    ##-------------------------------------------------------------------------
+    def _openShard(self):
+        if self._fp is not None:
+            self._fp.close()
+
+        os.makedirs(self.shards_dir, exist_ok=True)
+        name = '{}-{:05d}.bin'.format(self.prefix, len(self.shard_files))
+        path = os.path.join(self.shards_dir, name)
+        self._fp = open(path, 'wb')
+        self.shard_files.append(os.path.relpath(path, self.index_dir))
+
+    ##-------------------------------------------------------------------------
+    def flush(self, index_path=None):
+        """
+        Flush the current shard and write the index to disk.
+        :param index_path (str): write the index to a different location
+        """
+
+        if self._fp is not None:
+            self._fp.flush()
+
+        if self._pending:
+            ids, shard, offset, length = [np.frombuffer(col, dtype=np.int64)
+                                          for col in self._new_rows]
+            ids = np.concatenate((self._ids, ids))
+            order = np.argsort(ids, kind='stable')
+            self._ids = ids[order]
+            self._shard = np.concatenate((self._shard, shard))[order]
+            self._offset = np.concatenate((self._offset, offset))[order]
+            self._length = np.concatenate((self._length, length))[order]
+            self._pending = {}
+            self._new_rows = [array('q') for _ in range(4)]
+
+        if index_path is None:
+            index_path = self.index_path
+        index_dir = os.path.dirname(os.path.abspath(index_path))
+        shard_files = [os.path.relpath(self._shardPath(i), index_dir)
+                       for i in range(len(self.shard_files))]
+
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f,
+                     img_ids=self._ids,
+                     shard=self._shard,
+                     offset=self._offset,
+                     length=self._length,
+                     shard_files=np.array(shard_files, dtype=str))
+        os.replace(tmp_path, index_path)
+
+    ##-------------------------------------------------------------------------
+    def close(self):
+        """
+        Flush pending writes and release the open files and memory maps.
+        """
+
+        if self._fp is not None:
+            self.flush()
+            self._fp.close()
+            self._fp = None
+        # Maps still referenced by views returned from get() are closed when
+        # the last view is released
+        self._maps = {}
+
+
+##------------------------------------------------------------------------------
+def convert_to_shards(annotation_file, imgs_dir, shard_size=SHARD_SIZE,
+                      num_threads=8):
+    """
+    Pack the images of an existing per-file dataset into shard files. The
+    encoded files are copied as-is, without decoding. The shards are written
+    to imgs_dir and the index next to the annotation file.
+
+    :param annotation_file (str): dataset annotation file
+    :param imgs_dir (str): directory of the image files
+    :param shard_size (int): maximum size of a shard file in bytes
+    :param num_threads (int): number of threads reading the image files
+    :return (ImageShards): the packed images
+    """
+
+    with open(annotation_file, 'r') as f:
+        images = json.load(f)['images']
+
+    def _readFile(img_info):
+        with open(os.path.join(imgs_dir, img_info['file_name']), 'rb') as f:
+            return img_info['id'], f.read()
+
+    shards = ImageShards(shard_index_path(annotation_file),
+                         shards_dir=imgs_dir,
+                         shard_size=shard_size)
+
+    # Reads run ahead on the pool while the shards are written sequentially,
+    # one bounded chunk at a time
+    chunk = 16 * num_threads
+    with futures.ThreadPoolExecutor(max_workers=num_threads) as pool:
+        for start in range(0, len(images), chunk):
+            for img_id, data in pool.map(_readFile, images[start:start+chunk]):
+                shards.write(img_id, data)
+
+    shards.flush()
+    return shards
@@ -1,9 +1,17 @@
 import numpy as np
-import copy
-import cv2
-from shapely.geometry import LineString
-from matplotlib.patches import BoxStyle
+import struct
+from cocoplus.utils.lazy import lazy_import
 
+## Image I/O and drawing dependencies are imported on first use
+cv2 = lazy_import('cv2', 'opencv-python')
+patches = lazy_import('matplotlib.patches', 'matplotlib')
+
+_GRAY = (218, 227, 218)
+_GREEN = (18, 127, 15)
+
+## Default edges of the object distance bins, used by the samplers and the
+## error analysis
+DISTANCE_BINS = (0, 10, 20, 30, 40, 50, np.inf)
 
 def xywh_to_xyxy(xywh):
     """
@@ -54,6 +62,127 @@ def clip_boxes_to_image(boxes, height, width):
     boxes[:, [1, 3]] = np.minimum(height - 1., np.maximum(0., boxes[:, [1, 3]]))
     return boxes
 
+##------------------------------------------------------------------------------
+def xywh_to_yolo(xywh, height, width):
+    """
+    Convert an array of [x1 y1 w h] boxes to the YOLO [xc yc w h] format,
+    normalized by the image size.
+    :param height, width: image size, scalars or one value per box
+    """
+
+    xywh = np.asarray(xywh, dtype=np.float64).reshape(-1, 4)
+    size = np.stack(np.broadcast_arrays(np.asarray(width, dtype=np.float64),
+                                        np.asarray(height, dtype=np.float64)),
+                    axis=-1).reshape(-1, 2)
+    return np.hstack(((xywh[:, 0:2] + xywh[:, 2:4] / 2.) / size,
+                      xywh[:, 2:4] / size))
+
+##------------------------------------------------------------------------------
+def yolo_to_xywh(yolo, height, width):
+    """
+    Convert an array of normalized YOLO [xc yc w h] boxes to [x1 y1 w h].
+    :param height, width: image size, scalars or one value per box
+    """
+
+    yolo = np.asarray(yolo, dtype=np.float64).reshape(-1, 4)
+    size = np.stack(np.broadcast_arrays(np.asarray(width, dtype=np.float64),
+                                        np.asarray(height, dtype=np.float64)),
+                    axis=-1).reshape(-1, 2)
+    wh = yolo[:, 2:4] * size
+    return np.hstack((yolo[:, 0:2] * size - wh / 2., wh))
+
+##------------------------------------------------------------------------------
+def _exif_orientation(data):
+    """
+    Read the Orientation tag of the EXIF data of a JPEG APP1 segment.
+    :return (int): orientation (1 to 8), 1 if missing
+    """
+
+    if data[:6] != b'Exif\x00\x00':
+        return 1
+    tiff = data[6:]
+    endian = '<' if tiff[:2] == b'II' else '>'
+    ifd = struct.unpack(endian + 'I', tiff[4:8])[0]
+    num_entries = struct.unpack(endian + 'H', tiff[ifd:ifd + 2])[0]
+    for i in range(num_entries):
+        entry = tiff[ifd + 2 + 12 * i:ifd + 14 + 12 * i]
+        if struct.unpack(endian + 'H', entry[:2])[0] == 0x0112:
+            return struct.unpack(endian + 'H', entry[8:10])[0]
+    return 1
+
+
+def _jpeg_size(f):
+    """
+    Walk the JPEG segments up to the start-of-frame marker.
+    :return (tuple): (height, width) as decoded by OpenCV, i.e. with the EXIF
+        orientation applied, None if the header could not be parsed
+    """
+
+    f.seek(2)
+    orientation = 1
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return None
+        while marker[1] == 0xFF:
+            # Fill bytes before the marker
+            marker = marker[1:] + f.read(1)
+            if len(marker) < 2:
+                return None
+        code = marker[1]
+        if code in (0xD8, 0x01) or 0xD0 <= code <= 0xD7:
+            # Standalone markers without a length field
+            continue
+        seg_len = struct.unpack('>H', f.read(2))[0]
+        if 0xC0 <= code <= 0xCF and code not in (0xC4, 0xC8, 0xCC):
+            height, width = struct.unpack('>xHH', f.read(5))
+            # Orientations 5 to 8 rotate the image by 90 degrees
+            return (width, height) if orientation >= 5 else (height, width)
+        if code == 0xE1 and orientation == 1:
+            orientation = _exif_orientation(f.read(seg_len - 2))
+        else:
+            f.seek(seg_len - 2, 1)
+
+
+def get_image_size(img_path):
+    """
+    Get the size of an image by parsing only its file header, without
+    decoding it. Supports JPEG, PNG, GIF and BMP and falls back to decoding
+    with OpenCV for other formats and unparsable headers. The size of JPEG
+    images honours their EXIF orientation, like cv2.imread.
+    :return (tuple): (height, width)
+    """
+
+    with open(img_path, 'rb') as f:
+        head = f.read(26)
+
+        if head[:8] == b'\x89PNG\r\n\x1a\n' and head[12:16] == b'IHDR' and \
+                len(head) >= 24:
+            width, height = struct.unpack('>II', head[16:24])
+            return height, width
+
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            width, height = struct.unpack('<HH', head[6:10])
+            return height, width
+
+        if head[:2] == b'BM' and len(head) == 26:
+            width, height = struct.unpack('<ii', head[18:26])
+            return abs(height), width
+
+        if head[:2] == b'\xff\xd8':
+            try:
+                size = _jpeg_size(f)
+            except struct.error:
+                # Truncated header
+                size = None
+            if size is not None:
+                return size
+
+    img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)
+    if img is None:
+        raise IOError("Could not read image {}".format(img_path))
+    return img.shape[:2]
+
 ## -----------------------------------------------------------------------------
 def show_class_name(img, pos, class_str, font_scale=0.35):
     """
@@ -88,7 +217,7 @@ def show_class_name_plt(pos, class_str, ax, bg_color='red', font_size=8):
     # y_lim = ax.get_ylim()[0]
     # x_lim = ax.get_xlim()[1]
 
-    boxstyle = BoxStyle("Round")
+    boxstyle = patches.BoxStyle("Round")
     props = {'boxstyle': boxstyle,
             'facecolor': bg_color,
             'alpha': 0.5}
@@ -0,0 +1,139 @@
+"""
+In-memory cache of decoded images, shared by the loaders and display paths
+of a dataset and bounded by the total size of the images in bytes.
+
+"""
+
+import threading
+from collections import OrderedDict
+
+from cocoplus.utils.lazy import lazy_import
+
+cv2 = lazy_import('cv2', 'opencv-python')
+
+
+class ImageCache(object):
+    """
+    Thread-safe LRU cache of decoded images with a cap on the total size
+    in bytes. Cached images are marked read-only, copy them before drawing
+    on them.
+
+    Downscaled previews are cached under their own keys, so that only the
+    display paths asking for them get images that do not match the pixel
+    coordinates of the annotations. Without max_dim previews are the full
+    resolution images and share their entries.
+    """
+
+    def __init__(self, max_bytes=512 * 2**20, max_dim=None):
+        """
+        :param max_bytes (int): maximum total size of the cached images
+        :param max_dim (int): if set, previews are stored downscaled so that
+            their longest side is at most max_dim pixels, otherwise previews
+            are the full resolution images
+        """
+
+        assert max_bytes > 0, "max_bytes must be positive."
+        self.max_bytes = max_bytes
+        self.max_dim = max_dim
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._imgs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._imgs)
+
+    def __contains__(self, key):
+        return key in self._imgs
+
+    ##-------------------------------------------------------------------------
+    def _key(self, key, preview):
+        return key + ('preview',) if preview and self.max_dim is not None else key
+
+    ##-------------------------------------------------------------------------
+    def get(self, key, preview=False):
+        """
+        Return the cached image for key, or None on a miss.
+        :param preview (bool): look up the downscaled preview of the image
+        """
+
+        key = self._key(key, preview)
+        with self._lock:
+            img = self._imgs.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self._imgs.move_to_end(key)
+            self.hits += 1
+            return img
+
+    ##-------------------------------------------------------------------------
+    def put(self, key, img, preview=False):
+        """
+        Add an image to the cache, evicting the least recently used images
+        if needed.
+        :param preview (bool): store the image as a preview, downscaled to
+            max_dim if set
+        :return (nparray): the cached (read-only) image
+        """
+
+        key = self._key(key, preview)
+        if preview and self.max_dim is not None and \
+                max(img.shape[:2]) > self.max_dim:
+            scale = self.max_dim / float(max(img.shape[:2]))
+            img = cv2.resize(img, None, fx=scale, fy=scale,
+                             interpolation=cv2.INTER_AREA)
+        img.setflags(write=False)
+
+        if img.nbytes > self.max_bytes:
+            # Would evict everything else and still not fit
+            return img
+
+        with self._lock:
+            old = self._imgs.pop(key, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._imgs[key] = img
+            self.nbytes += img.nbytes
+
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._imgs.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return img
+
+    ##-------------------------------------------------------------------------
+    def discard(self, img_id):
+        """
+        Remove all the cached versions of an image.
+        """
+
+        with self._lock:
+            for key in [k for k in self._imgs if k[0] == img_id]:
+                self.nbytes -= self._imgs.pop(key).nbytes
+
+    ##-------------------------------------------------------------------------
+    def clear(self):
+        """
+        Remove all the cached images. Counters are kept.
+        """
+
+        with self._lock:
+            self._imgs.clear()
+            self.nbytes = 0
+
+    ##-------------------------------------------------------------------------
+    def stats(self):
+        """
+        :return (dict): cache counters and current size
+        """
+
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'images': len(self._imgs),
+                    'bytes': self.nbytes,
+                    'max_bytes': self.max_bytes}
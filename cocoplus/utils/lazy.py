@@ -0,0 +1,58 @@
+"""
+Deferred imports of the heavy optional dependencies (OpenCV, matplotlib),
+so that importing cocoplus only loads what indexing and evaluation need.
+
+"""
+
+import importlib
+
+
+class LazyModule(object):
+    """
+    Stand-in for a module, imported on first attribute access. Attributes are
+    cached on the stand-in, so later accesses cost a plain attribute lookup.
+    A missing module raises ImportError when first used, not when imported.
+    """
+
+    def __init__(self, name, hint=None):
+        """
+        :param name (str): full module name, e.g. 'matplotlib.pyplot'
+        :param hint (str): what to install, added to the ImportError message
+        """
+
+        self.__dict__['_name'] = name
+        self.__dict__['_hint'] = hint
+        self.__dict__['_module'] = None
+
+    def _load(self):
+        module = self._module
+        if module is None:
+            try:
+                module = importlib.import_module(self._name)
+            except ImportError as e:
+                msg = "{} is required for this feature".format(self._name)
+                if self._hint:
+                    msg += ", install it with: pip install {}".format(self._hint)
+                raise ImportError(msg) from e
+            self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, attr):
+        if attr.startswith('__') and attr.endswith('__'):
+            # Introspection (pickle, copy, inspect) must not trigger the import
+            raise AttributeError(attr)
+        value = getattr(self._load(), attr)
+        self.__dict__[attr] = value
+        return value
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return "<lazy module '{}' ({})>".format(self._name, state)
+
+
+def lazy_import(name, hint=None):
+    """
+    :return (LazyModule): stand-in importing module `name` on first use
+    """
+
+    return LazyModule(name, hint)
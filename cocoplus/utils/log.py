@@ -1,37 +1,219 @@
+import atexit
 import logging
+import logging.handlers
+import os
+import queue
+import threading
 import time
 
-def getLogger(name, console_level='INFO', file_level=None):
+LOG_FILE = 'file.log'   # Default log file, used if file_level is provided
+
+## Queue listeners writing the records of each logger, by logger name
+_listeners = {}
+_lock = threading.Lock()
+_stopped = False
+
+def getLogger(name, console_level='INFO', file_level=None, log_file=LOG_FILE,
+              rate_limit=20):
     """
     Generate logger with custom formatting. Console and file levels and formatting
     if different. Log is saved to a file only if file_level is provided.
+
+    Records are handed to a background thread through a queue, so formatting
+    and I/O never block the logging thread. The thread is started by the first
+    record logged. Calling getLogger again with the same name reuses the
+    existing handlers and only updates their levels.
+
+    :param log_file (str): path of the log file
+    :param rate_limit (float): maximum number of records per second from a
+        single line of code, excess records are dropped. None to disable.
     """
-    ## Create a custom logger
-    logger = logging.getLogger(name)
-    logger.setLevel('DEBUG')
-
-    ## Create console handler and formatter
-    ch = logging.StreamHandler()
-    ch.setLevel(console_level)
-    c_formatter = ConsoleFormatter()
-    ch.setFormatter(c_formatter)
-    
-    ## Create file handler and formatter if file_level provided
-    if file_level:
-        fmt = '%(filename)s:%(lineno)d - %(levelname)s - %(message)s'
-        fh = logging.FileHandler('file.log')
-        fh.setLevel(file_level)
-        f_formatter = logging.Formatter(fmt=fmt)
-        fh.setFormatter(f_formatter)
-
-    ## Add handlers to the logger
-    logger.addHandler(ch)
-    if file_level:
-        logger.addHandler(fh)
+    with _lock:
+        ## Create a custom logger
+        logger = logging.getLogger(name)
+        listener = _listeners.get(name)
+
+        if listener is None:
+            ## Create console handler and formatter
+            ch = logging.StreamHandler()
+            ch.setFormatter(ConsoleFormatter())
+
+            ## The logger only enqueues, the listener thread formats and writes
+            q = queue.Queue(-1)
+            listener = logging.handlers.QueueListener(q, ch,
+                                                      respect_handler_level=True)
+            qh = _QueueHandler(q, listener)
+            qh.addFilter(RateLimitFilter(rate_limit))
+            logger.addHandler(qh)
+            _listeners[name] = listener
+
+        ch = listener.handlers[0]
+        ch.setLevel(console_level)
+
+        ## Create file handler and formatter if file_level provided
+        if file_level:
+            fh = _fileHandler(listener, log_file)
+            fh.setLevel(file_level)
+
+        ## Records below all the handler levels are dropped before formatting
+        levels = [h.level for h in listener.handlers]
+        logger.setLevel(min(levels))
+        for h in logger.handlers:
+            for f in h.filters:
+                if isinstance(f, RateLimitFilter):
+                    f.rate = rate_limit
 
     return logger
 
 
+def _fileHandler(listener, log_file):
+    """
+    Return the file handler of a listener for log_file, adding it if needed.
+    """
+    path = os.path.abspath(log_file)
+    for h in listener.handlers[1:]:
+        if h.baseFilename == path:
+            return h
+
+    fmt = '%(filename)s:%(lineno)d - %(levelname)s - %(message)s'
+    fh = logging.FileHandler(path, delay=True)
+    fh.setFormatter(logging.Formatter(fmt=fmt))
+    listener.handlers = listener.handlers + (fh,)
+    return fh
+
+
+def flush():
+    """
+    Wait until all the queued records are written.
+    """
+    for listener in list(_listeners.values()):
+        listener.queue.join()
+        for h in listener.handlers:
+            h.flush()
+
+
+def shutdown():
+    """
+    Write the queued records and stop the background threads.
+    """
+    global _stopped
+    with _lock:
+        _stopped = True
+        for listener in _listeners.values():
+            if listener._thread is not None:
+                listener.stop()
+            for h in listener.handlers:
+                h.close()
+
+atexit.register(shutdown)
+
+
+def _restartListeners():
+    ## Threads do not survive a fork, the child needs its own listeners. The
+    ## inherited queues may hold records of the parent or a lock taken by one
+    ## of its threads, so the child also gets new queues. The listeners are
+    ## only started if the child logs, e.g. most pool workers never do
+    global _lock
+    _lock = threading.Lock()
+    for name, listener in list(_listeners.items()):
+        logger = logging.getLogger(name)
+        q = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(q, *listener.handlers,
+                                                  respect_handler_level=True)
+        for h in list(logger.handlers):
+            if isinstance(h, _QueueHandler):
+                qh = _QueueHandler(q, listener)
+                for f in h.filters:
+                    if isinstance(f, RateLimitFilter):
+                        f._lock = threading.Lock()
+                qh.filters = list(h.filters)
+                logger.removeHandler(h)
+                logger.addHandler(qh)
+        _listeners[name] = listener
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restartListeners)
+
+
+class LevelAdapter(logging.LoggerAdapter):
+    """
+    Logger with its own level on top of a shared logger, e.g. one per dataset
+    instance. Records below the level are dropped before being enqueued, the
+    shared logger and its handlers are left unchanged.
+    """
+
+    def __init__(self, logger, level='INFO'):
+        logging.LoggerAdapter.__init__(self, logger, {})
+        self.setLevel(level)
+
+    def setLevel(self, level):
+        self.level = level if isinstance(level, int) else logging.getLevelName(level)
+
+    def isEnabledFor(self, level):
+        return level >= self.level and self.logger.isEnabledFor(level)
+
+
+class _QueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that only merges the message arguments before enqueueing,
+    all the other formatting is done by the listener thread. The listener is
+    started by the first record emitted.
+    """
+
+    def __init__(self, queue, listener):
+        logging.handlers.QueueHandler.__init__(self, queue)
+        self.listener = listener
+
+    def emit(self, record):
+        if self.listener._thread is None:
+            with _lock:
+                if self.listener._thread is None and not _stopped:
+                    self.listener.start()
+        logging.handlers.QueueHandler.emit(self, record)
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop the records of a line of code logging more than `rate` records per
+    second, e.g. per-sample messages in a loop. Errors are never dropped. The
+    number of dropped records is appended to the next record let through.
+    """
+
+    def __init__(self, rate=20):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if self.rate is None or record.levelno >= logging.ERROR:
+            return True
+
+        ## Token bucket per call site, holding up to `rate` tokens
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            tokens, last, dropped = self._buckets.get(key, (self.rate, record.created, 0))
+            tokens = min(self.rate, tokens + (record.created - last) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, record.created, dropped + 1)
+                return False
+            self._buckets[key] = (tokens - 1, record.created, 0)
+
+        if dropped:
+            record.msg = '{} ({} similar messages suppressed)'.format(
+                record.getMessage(), dropped)
+            record.args = None
+        return True
+
+
 class ConsoleFormatter(logging.Formatter):
     """
     Create colorful log messages for the console. Not to be used for file handlers.
@@ -45,34 +227,29 @@ class ConsoleFormatter(logging.Formatter):
 
     def __init__(self, fmt='%(filename)s:%(lineno)d %(levelname)s:: %(message)s'):
         logging.Formatter.__init__(self, fmt=fmt, datefmt=None, style='%')
-    
+        self._prefixes = {logging.DEBUG: self.DEBUG,
+                          logging.INFO: self.INFO,
+                          logging.WARN: self.WARN,
+                          logging.ERROR: self.ERROR,
+                          logging.CRITICAL: self.CRITICAL}
+        self._sec, self._time = None, ''
+
     def format(self, record):
-        curTime = time.localtime()
-        curTime = time.strftime("%m/%d/%Y %X", curTime)
-
-        long_prefix = '[{time} {fileName}:{line}] '.format(
-            time=curTime,
-            fileName=record.filename,
-            line=record.lineno
-        )
-        short_prefix = ''
-
-        if record.levelno == logging.DEBUG:
-            ret_s =  self.DEBUG + long_prefix + record.msg + self.RESET
-        
-        elif record.levelno == logging.INFO:
-            ret_s = self.INFO + short_prefix +  record.msg + self.RESET
-        
-        elif record.levelno == logging.WARN:
-            ret_s = self.WARN + long_prefix + record.msg + self.RESET
-        
-        elif record.levelno == logging.ERROR:
-            ret_s = self.ERROR + long_prefix + record.msg + self.RESET
-        
-        elif record.levelno == logging.CRITICAL:
-            ret_s = self.CRITICAL + long_prefix + record.msg + self.RESET
-        
-        return ret_s
+        ## The time string only changes once per second
+        sec = int(record.created)
+        if sec != self._sec:
+            self._sec = sec
+            self._time = time.strftime("%m/%d/%Y %X", time.localtime(sec))
+
+        prefix = self._prefixes.get(record.levelno, self.INFO)
+        msg = record.getMessage()
+        if record.exc_text:
+            msg = msg + '\n' + record.exc_text
+
+        if record.levelno == logging.INFO:
+            return prefix + msg + self.RESET
+        return '{}[{} {}:{}] {}{}'.format(prefix, self._time, record.filename,
+                                          record.lineno, msg, self.RESET)
 
 
 def test_logger():
@@ -84,4 +261,4 @@ def test_logger():
     logger.critical('This is critical')
 
 if __name__ == '__main__':
-    test_logger()
\ No newline at end of file
+    test_logger()
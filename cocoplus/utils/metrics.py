@@ -0,0 +1,275 @@
+"""
+Lightweight instrumentation: named timing spans, counters and memory use.
+
+Instrumentation is off by default, spans and counters then cost a single
+flag check. Turn it on with enable(), read the results with snapshot() and
+export them with export_chrome_trace() or export_prometheus().
+
+    from cocoplus.utils import metrics
+    metrics.enable()
+    coco = COCO_PLUS('instances_val.json')
+    print(metrics.snapshot()['spans']['coco.createIndex'])
+
+"""
+
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+_enabled = False
+_lock = threading.Lock()
+_spans = {}         # name -> [calls, total, min, max, max rss delta]
+_counters = {}      # name -> value
+_events = []        # Chrome trace events
+_max_events = 0
+_dropped_events = 0
+_t0 = time.perf_counter()
+
+## ru_maxrss is in kilobytes on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+_PAGE_SIZE = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 0
+
+
+def enable(trace_events=100000):
+    """
+    Turn instrumentation on.
+    :param trace_events (int): maximum number of span events kept for the
+        Chrome trace, 0 to only keep the aggregates
+    """
+
+    global _enabled, _max_events
+    _max_events = trace_events
+    _enabled = True
+
+
+def disable():
+    """
+    Turn instrumentation off. Collected metrics are kept.
+    """
+
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """
+    Clear all the collected metrics.
+    """
+
+    global _dropped_events, _t0
+    with _lock:
+        _spans.clear()
+        _counters.clear()
+        del _events[:]
+        _dropped_events = 0
+        _t0 = time.perf_counter()
+
+
+def peak_rss():
+    """
+    :return (int): peak resident memory of the process in bytes, 0 if unknown
+    """
+
+    if resource is None:
+        return 0
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+def current_rss():
+    """
+    :return (int): current resident memory of the process in bytes, 0 if
+        unknown (no /proc filesystem)
+    """
+
+    try:
+        with open('/proc/self/statm', 'rb') as f:
+            return int(f.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+##------------------------------------------------------------------------------
+def count(name, value=1):
+    """
+    Increment a counter.
+    """
+
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+##------------------------------------------------------------------------------
+class _Span(object):
+    __slots__ = ('name', 'start', 'rss')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.rss = current_rss()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, self.start, time.perf_counter(), self.rss)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def span(name):
+    """
+    Context manager timing a block of code.
+
+        with metrics.span('coco.loadJson'):
+            ...
+    """
+
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def timed(name):
+    """
+    Decorator timing every call of a function as the span `name`.
+    """
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return fn(*args, **kwargs)
+            rss = current_rss()
+            start = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _record(name, start, time.perf_counter(), rss)
+        return wrapper
+    return decorator
+
+
+def _record(name, start, end, start_rss):
+    global _dropped_events
+    duration = end - start
+    rss_delta = current_rss() - start_rss
+    with _lock:
+        stats = _spans.get(name)
+        if stats is None:
+            _spans[name] = [1, duration, duration, duration, rss_delta]
+        else:
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = min(stats[2], duration)
+            stats[3] = max(stats[3], duration)
+            stats[4] = max(stats[4], rss_delta)
+
+        if len(_events) < _max_events:
+            _events.append((name, start, duration, threading.get_ident()))
+        else:
+            _dropped_events += 1
+
+
+##------------------------------------------------------------------------------
+def snapshot():
+    """
+    :return (dict): span statistics (calls, total, min, max and mean seconds,
+        largest growth of the resident memory over a call in bytes, negative
+        if memory was released), counters and peak resident memory of the
+        process
+    """
+
+    with _lock:
+        spans = {name: {'calls': s[0],
+                        'total': s[1],
+                        'min': s[2],
+                        'max': s[3],
+                        'mean': s[1] / s[0],
+                        'rss_delta': s[4]}
+                 for name, s in _spans.items()}
+        return {'spans': spans,
+                'counters': dict(_counters),
+                'peak_rss': peak_rss(),
+                'dropped_events': _dropped_events}
+
+
+def export_chrome_trace(path):
+    """
+    Write the span events in the Chrome trace event format, to open in
+    chrome://tracing or Perfetto.
+    """
+
+    pid = os.getpid()
+    with _lock:
+        events = [{'name': name,
+                   'ph': 'X',
+                   'ts': (start - _t0) * 1e6,
+                   'dur': duration * 1e6,
+                   'pid': pid,
+                   'tid': tid}
+                  for name, start, duration, tid in _events]
+        ts = (time.perf_counter() - _t0) * 1e6
+        events.extend({'name': name, 'ph': 'C', 'ts': ts, 'pid': pid,
+                       'args': {name: value}}
+                      for name, value in _counters.items())
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+def export_prometheus(path, prefix='cocoplus'):
+    """
+    Write the metrics in the Prometheus text exposition format, e.g. for the
+    node exporter textfile collector.
+    """
+
+    snap = snapshot()
+    lines = []
+
+    def _metric(name, kind, doc, samples):
+        lines.append('# HELP {}_{} {}'.format(prefix, name, doc))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for labels, value in samples:
+            lines.append('{}_{}{} {}'.format(prefix, name, labels, repr(float(value))))
+
+    spans = sorted(snap['spans'].items())
+    _metric('span_calls_total', 'counter', 'Number of calls of the span.',
+            [('{{span="{}"}}'.format(n), s['calls']) for n, s in spans])
+    _metric('span_seconds_total', 'counter', 'Total time spent in the span.',
+            [('{{span="{}"}}'.format(n), s['total']) for n, s in spans])
+    _metric('span_seconds_max', 'gauge', 'Longest call of the span.',
+            [('{{span="{}"}}'.format(n), s['max']) for n, s in spans])
+    for name, value in sorted(snap['counters'].items()):
+        _metric(name + '_total', 'counter', 'Counter ' + name + '.', [('', value)])
+    _metric('peak_rss_bytes', 'gauge', 'Peak resident memory of the process.',
+            [('', snap['peak_rss'])])
+
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    os.replace(tmp_path, path)
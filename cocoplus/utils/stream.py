@@ -0,0 +1,144 @@
+"""
+Streaming access to the tables of COCO annotation files and datasets.
+
+Annotation files are parsed incrementally: the elements of the top-level
+arrays are decoded one at a time from a bounded buffer, so that a table can
+be scanned without loading the whole file in memory.
+
+"""
+
+import json
+
+TABLES = ['categories', 'images', 'annotations', 'pointclouds']
+_WHITESPACE = ' \t\n\r'
+
+
+class _Reader(object):
+    """
+    Buffered reader decoding JSON values at the current position.
+    """
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self):
+        if self.pos > self.chunk_size:
+            self.buf, self.pos = self.buf[self.pos:], 0
+        chunk = self.f.read(self.chunk_size)
+        self.eof = not chunk
+        self.buf += chunk
+        return bool(chunk)
+
+    def peek(self):
+        """
+        Skip whitespace and return the next character, '' at the end.
+        """
+
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in _WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buf) or not self._fill():
+                return self.buf[self.pos:self.pos + 1]
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("Expected one of '{}' at offset {} of the buffer, "
+                             "got '{}'".format(chars, self.pos, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        """
+        Decode the value at the current position, reading more data until it
+        is complete.
+        """
+
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                if self._fill():
+                    continue
+                raise
+            # A number may continue in the next chunk
+            if end == len(self.buf) and not self.eof and self._fill():
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json_items(path, chunk_size=2**20):
+    """
+    Iterate over the top-level values of a JSON object file. The elements of
+    top-level arrays are yielded one by one, other values whole.
+
+    :param path (str): annotation file
+    :param chunk_size (int): number of characters read at once
+    :return (generator): (key, value) pairs, e.g. ('info', {...}) then
+        ('images', image) for every image
+    """
+
+    with open(path, 'r') as f:
+        reader = _Reader(f, chunk_size)
+        reader.expect('{')
+        if reader.peek() == '}':
+            return
+        while True:
+            key = reader.value()
+            reader.expect(':')
+            if reader.peek() == '[':
+                reader.pos += 1
+                if reader.peek() == ']':
+                    reader.pos += 1
+                else:
+                    while True:
+                        yield key, reader.value()
+                        if reader.expect(',]') == ']':
+                            break
+            else:
+                yield key, reader.value()
+            if reader.expect(',}') == '}':
+                return
+
+
+def iter_tables(dataset, tables=TABLES):
+    """
+    Iterate over the objects of the tables of a dataset. Annotation files are
+    streamed in a single pass, in file order.
+
+    :param dataset: COCO_PLUS instance (in memory or SQLite), dataset dict
+        or annotation file
+    :param tables (list): names of the tables, e.g. ['images', 'annotations']
+    :return (generator): (table, object) pairs
+    """
+
+    if isinstance(dataset, str):
+        tables = set(tables)
+        for key, value in iter_json_items(dataset):
+            if key in tables:
+                yield key, value
+        return
+
+    for table in tables:
+        objs = dataset.get(table, []) if isinstance(dataset, dict) \
+            else dataset._iterObjects(table)
+        for obj in objs:
+            yield table, obj
+
+
+def load_tables(dataset, tables=TABLES):
+    """
+    :return (dict): table name -> list of objects, see iter_tables
+    """
+
+    out = {table: [] for table in tables}
+    for table, obj in iter_tables(dataset, tables):
+        out[table].append(obj)
+    return out
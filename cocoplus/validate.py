@@ -0,0 +1,191 @@
+"""
+Vectorized integrity checks of COCO_PLUS datasets.
+
+"""
+
+import concurrent.futures as futures
+
+import numpy as np
+
+from cocoplus.utils.coco_utils import xywh_to_xyxy, xyxy_to_xywh, \
+    clip_boxes_to_image
+from cocoplus.utils.stream import TABLES, iter_tables
+
+CHECKS = ['duplicate_image_ids',
+          'duplicate_annotation_ids',
+          'duplicate_category_ids',
+          'duplicate_pointcloud_ids',
+          'missing_image',
+          'unknown_category',
+          'invalid_box',
+          'zero_area_box',
+          'box_out_of_image',
+          'orphan_pointcloud']
+
+
+def _duplicates(ids):
+    uniq, counts = np.unique(ids, return_counts=True)
+    return uniq[counts > 1]
+
+
+##------------------------------------------------------------------------------
+def _checkAnns(ann_ids, ann_imgs, ann_cats, boxes, img_ids, img_hw, cat_ids):
+    """
+    Check a shard of annotations against the images and categories.
+    :param img_ids (nparray): sorted image IDs
+    :param img_hw (nparray): (height, width) of the images in img_ids order
+    :param cat_ids (nparray): sorted category IDs
+    :return (dict): IDs of the failing annotations for each check
+    """
+
+    pos = np.searchsorted(img_ids, ann_imgs)
+    pos_c = np.minimum(pos, max(len(img_ids) - 1, 0))
+    has_img = (pos < len(img_ids)) & (img_ids[pos_c] == ann_imgs) \
+        if len(img_ids) else np.zeros(len(ann_ids), dtype=bool)
+
+    cpos = np.minimum(np.searchsorted(cat_ids, ann_cats), max(len(cat_ids) - 1, 0))
+    has_cat = (cat_ids[cpos] == ann_cats) if len(cat_ids) \
+        else np.zeros(len(ann_ids), dtype=bool)
+
+    finite = np.all(np.isfinite(boxes), axis=1)
+    zero_area = finite & ((boxes[:, 2] <= 0) | (boxes[:, 3] <= 0))
+
+    # Images sizes of the annotations with a valid image
+    hw = img_hw[pos_c] if len(img_ids) else np.zeros((len(ann_ids), 2))
+    outside = finite & has_img & ((boxes[:, 0] < 0) | (boxes[:, 1] < 0) |
+                                  (boxes[:, 0] + boxes[:, 2] > hw[:, 1]) |
+                                  (boxes[:, 1] + boxes[:, 3] > hw[:, 0]))
+
+    return {'missing_image': ann_ids[~has_img],
+            'unknown_category': ann_ids[~has_cat],
+            'invalid_box': ann_ids[~finite],
+            'zero_area_box': ann_ids[zero_area],
+            'box_out_of_image': ann_ids[outside]}
+
+
+##------------------------------------------------------------------------------
+def validate_dataset(dataset, num_workers=1, shard_size=500000, fix=False,
+                     max_ids=None):
+    """
+    Check the integrity of a dataset: duplicate IDs, annotations of missing
+    images or unknown categories, non-finite, empty or out-of-image boxes and
+    pointclouds of missing images.
+
+    :param dataset: COCO_PLUS instance, dataset dict or annotation file
+    :param num_workers (int): number of processes checking annotation shards
+    :param shard_size (int): number of annotations per shard
+    :param fix (bool): fix the dataset, only for COCO_PLUS instances. Boxes
+        are clipped to their image, then the annotations of missing images or
+        unknown categories, with invalid or empty boxes are removed, and so
+        are the orphan pointclouds. Duplicate IDs are only reported.
+    :param max_ids (int): maximum number of offending IDs listed per check
+    :return (dict): report with the count and offending IDs of every check
+    """
+
+    coco = None if isinstance(dataset, (str, dict)) else dataset
+    assert not fix or coco is not None, "fix requires a COCO_PLUS instance."
+
+    # Only the checked columns are kept, the objects are streamed from the
+    # annotation file or the database
+    cols = {table: [] for table in TABLES}
+    img_hw, boxes = [], []
+    for table, obj in iter_tables(dataset):
+        if table == 'images':
+            cols[table].append(obj['id'])
+            img_hw.append((obj['height'], obj['width']))
+        elif table == 'annotations':
+            cols[table].append((obj['id'], obj['image_id'], obj['category_id']))
+            boxes.append(obj['bbox'])
+        elif table == 'categories':
+            cols[table].append(obj['id'])
+        else:
+            cols[table].append((obj['id'], obj['img_id']))
+
+    img_ids = np.array(cols['images'], dtype=np.int64)
+    order = np.argsort(img_ids, kind='stable')
+    img_hw = np.array(img_hw, dtype=np.float64).reshape(-1, 2)[order]
+    img_ids = img_ids[order]
+    cat_ids = np.sort(np.array(cols['categories'], dtype=np.int64))
+
+    anns = np.array(cols['annotations'], dtype=np.int64).reshape(-1, 3)
+    ann_ids, ann_imgs, ann_cats = anns.T
+    boxes = np.array(boxes, dtype=np.float64).reshape(-1, 4)
+    pcs = np.array(cols['pointclouds'], dtype=np.int64).reshape(-1, 2)
+    del cols
+
+    failing = {key: [] for key in CHECKS}
+    shards = [slice(start, start + shard_size)
+              for start in range(0, len(anns), shard_size)]
+    args = [(ann_ids[s], ann_imgs[s], ann_cats[s], boxes[s], img_ids, img_hw,
+             cat_ids) for s in shards]
+    if num_workers > 1 and len(shards) > 1:
+        with futures.ProcessPoolExecutor(max_workers=num_workers) as pool:
+            results = list(pool.map(_checkAnns, *zip(*args)))
+    else:
+        results = [_checkAnns(*a) for a in args]
+    for result in results:
+        for key, ids in result.items():
+            failing[key].append(ids)
+
+    failing['duplicate_image_ids'].append(_duplicates(img_ids))
+    failing['duplicate_annotation_ids'].append(_duplicates(ann_ids))
+    failing['duplicate_category_ids'].append(_duplicates(cat_ids))
+    failing['duplicate_pointcloud_ids'].append(_duplicates(pcs[:, 0]))
+    pc_imgs = pcs[:, 1]
+    failing['orphan_pointcloud'].append(pc_imgs[~np.isin(pc_imgs, img_ids)])
+
+    failing = {key: np.concatenate(ids) if ids else np.zeros(0, np.int64)
+               for key, ids in failing.items()}
+    report = {'num_images': len(img_ids),
+              'num_annotations': len(anns),
+              'num_categories': len(cat_ids),
+              'num_pointclouds': len(pcs),
+              'checks': {key: {'count': int(len(failing[key])),
+                               'ids': failing[key][:max_ids].tolist()}
+                         for key in CHECKS}}
+    report['valid'] = all(c['count'] == 0 for c in report['checks'].values())
+
+    if fix:
+        report['fixed'] = _fix(coco, failing, ann_ids, ann_imgs, boxes,
+                               img_ids, img_hw)
+    return report
+
+
+##------------------------------------------------------------------------------
+def _fix(coco, failing, ann_ids, ann_imgs, boxes, img_ids, img_hw):
+    """
+    Fix the problems found by validate_dataset in a COCO_PLUS instance.
+    :param failing (dict): IDs failing each check
+    :return (dict): number of clipped boxes and removed objects
+    """
+
+    remove = set()
+    for key in ['missing_image', 'unknown_category', 'invalid_box',
+                'zero_area_box']:
+        remove.update(failing[key].tolist())
+
+    # Clip the boxes outside their image, grouped by image size
+    outside = np.isin(ann_ids, failing['box_out_of_image'])
+    idx = np.flatnonzero(outside)
+    hw = img_hw[np.searchsorted(img_ids, ann_imgs[idx])]
+    num_clipped = 0
+    for size in np.unique(hw, axis=0):
+        group = idx[np.all(hw == size, axis=1)]
+        clipped = xyxy_to_xywh(clip_boxes_to_image(
+            xywh_to_xyxy(boxes[group]), size[0], size[1]))
+        for ann_id, box in zip(ann_ids[group].tolist(), clipped.tolist()):
+            if ann_id in remove:
+                continue
+            if box[2] <= 0 or box[3] <= 0:
+                remove.add(ann_id)
+                continue
+            coco.updateAnn(ann_id, bbox=[round(v, 2) for v in box])
+            num_clipped += 1
+
+    coco.removeAnns(sorted(remove))
+    orphans = failing['orphan_pointcloud'].tolist()
+    coco.removePointclouds(orphans)
+
+    return {'clipped_boxes': num_clipped,
+            'removed_annotations': len(remove),
+            'removed_pointclouds': len(orphans)}
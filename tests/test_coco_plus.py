@@ -1,12 +1,743 @@
+import json
+import logging
 import os
 import cv2
+import numpy as np
+import pytest
 
 from _context import cocoplus
+import cocoplus.diff
+import cocoplus.validate
+import cocoplus.export
+import cocoplus.sampler
+import cocoplus.utils.coco_utils
+
+
+def _make_dataset(root, num_imgs=6, shape=(48, 64, 3), **kwargs):
+    dataset = cocoplus.coco.COCO_PLUS(logging_level='WARN')
+    dataset.create_new_dataset(str(root), 'val', **kwargs)
+    cat_id = dataset.addCategory('car', 'vehicle')
+    for i in range(num_imgs):
+        img = np.full(shape, i * 10, dtype=np.uint8)
+        ann = dataset.createAnn([2, 3, 10 + i, 12], cat_id, distance=i)
+        dataset.addSample(img, [ann], pointcloud=[[i, i, i]])
+    return dataset
 
 
 def test_empty_dataset():
     empty_dataset = cocoplus.coco.COCO_PLUS()
-    
+
+
+def test_iter_samples(tmp_path):
+    dataset = _make_dataset(tmp_path)
+    img_ids = list(dataset.imgs.keys())
+
+    samples = list(dataset.iterSamples(num_threads=2, prefetch=2))
+    assert len(samples) == len(img_ids)
+    for img_id, (img, anns, pc) in zip(img_ids, samples):
+        assert img.shape == (48, 64, 3)
+        assert anns[0]['image_id'] == img_id
+        assert pc['img_id'] == img_id
+
+    unordered = dataset.iterSamples(ordered=False, resize=0.5, shard_id=1,
+                                    num_shards=2)
+    samples = list(unordered)
+    assert len(samples) == len(img_ids[1::2])
+    assert all(img.shape == (24, 32, 3) for img, _, _ in samples)
+    assert sorted(a[0]['image_id'] for _, a, _ in samples) == img_ids[1::2]
+
+
+def test_image_cache(tmp_path):
+    dataset = _make_dataset(tmp_path)
+    img_size = 48 * 64 * 3
+    dataset.img_cache = cocoplus.utils.image_cache.ImageCache(3 * img_size)
+    img_ids = list(dataset.imgs.keys())
+
+    list(dataset.iterSamples(num_threads=1))
+    img = dataset.loadImg(img_ids[-1])
+    assert not img.flags.writeable
+    stats = dataset.img_cache.stats()
+    assert stats['misses'] == 6 and stats['hits'] == 1
+    assert stats['evictions'] == 3 and stats['bytes'] == 3 * img_size
+
+    rendered = dataset.renderImg(img_ids[-1])
+    assert rendered.flags.writeable and rendered.shape == img.shape
+    assert dataset.img_cache.stats()['hits'] == 2
+
+    # Without max_dim previews share the full resolution entries
+    assert dataset.loadImg(img_ids[-1], preview=True) is img
+    assert dataset.img_cache.stats()['images'] == 3
+
+    # Downscaled previews never replace the full resolution images
+    dataset.img_cache = cocoplus.utils.image_cache.ImageCache(10 * img_size,
+                                                              max_dim=32)
+    assert dataset.loadImg(img_ids[0], preview=True).shape == (24, 32, 3)
+    assert dataset.loadImg(img_ids[0]).shape == (48, 64, 3)
+    assert dataset.loadImg(img_ids[0], preview=True).shape == (24, 32, 3)
+
+    # Changing the file of an image drops its cached versions
+    dataset.updateImg(img_ids[0], file_name=dataset.imgs[img_ids[1]]['file_name'])
+    assert abs(dataset.loadImg(img_ids[0]).mean() - 10) <= 1
+
+
+def test_image_shards(tmp_path):
+    dataset = _make_dataset(tmp_path / 'packed', storage='shards',
+                            shard_size=1000)
+    dataset.saveAnnsToDisk()
+    assert not any(f.endswith('.jpg') for f in os.listdir(dataset.imgs_dir))
+    assert len(dataset.img_shards.shard_files) > 1
+
+    loaded = cocoplus.coco.COCO_PLUS(dataset.annotation_file,
+                                     logging_level='WARN')
+    assert len(loaded.img_shards) == len(loaded.imgs)
+    for img, anns, _ in loaded.iterSamples():
+        assert img.shape == (48, 64, 3)
+        assert abs(int(img.mean()) - 10 * (anns[0]['distance'])) <= 1
+
+    files = _make_dataset(tmp_path / 'files')
+    files.saveAnnsToDisk()
+    shards = cocoplus.storage.convert_to_shards(files.annotation_file,
+                                                files.imgs_dir)
+    for img_id, img_info in files.imgs.items():
+        path = os.path.join(files.imgs_dir, img_info['file_name'])
+        with open(path, 'rb') as f:
+            assert bytes(shards.get(img_id)) == f.read()
+
+
+def test_image_size_from_header(tmp_path):
+    img = np.zeros((37, 53, 3), dtype=np.uint8)
+    for ext in ['.jpg', '.png', '.bmp']:
+        path = str(tmp_path / ('img' + ext))
+        cv2.imwrite(path, img)
+        assert cocoplus.utils.coco_utils.get_image_size(path) == (37, 53)
+
+    # EXIF orientation 6 (rotated 90 degrees), applied by cv2.imread
+    exif = b'Exif\x00\x00MM\x00\x2a\x00\x00\x00\x08\x00\x01' + \
+        b'\x01\x12\x00\x03\x00\x00\x00\x01\x00\x06\x00\x00\x00\x00\x00\x00'
+    jpeg = cv2.imencode('.jpg', img)[1].tobytes()
+    rotated = str(tmp_path / 'rotated.jpg')
+    with open(rotated, 'wb') as f:
+        f.write(jpeg[:2] + b'\xff\xe1' + (len(exif) + 2).to_bytes(2, 'big') +
+                exif + jpeg[2:])
+    assert cocoplus.utils.coco_utils.get_image_size(rotated) == \
+        cv2.imread(rotated).shape[:2] == (53, 37)
+
+    truncated = str(tmp_path / 'truncated.jpg')
+    with open(truncated, 'wb') as f:
+        f.write(jpeg[:2] + b'\xff' * 3)
+    with pytest.raises(IOError):
+        cocoplus.utils.coco_utils.get_image_size(truncated)
+
+
+def test_add_image_files(tmp_path):
+    src_dir = tmp_path / 'src'
+    src_dir.mkdir()
+    paths = []
+    for i in range(5):
+        paths.append(str(src_dir / '{}.png'.format(i)))
+        cv2.imwrite(paths[-1], np.zeros((20 + i, 30, 3), dtype=np.uint8))
+
+    dataset = _make_dataset(tmp_path / 'ds', num_imgs=0)
+    img_ids = dataset.addImageFiles(paths, num_threads=2)
+    for i, img_id in enumerate(img_ids):
+        img_info = dataset.imgs[img_id]
+        assert (img_info['height'], img_info['width']) == (20 + i, 30)
+        assert img_info['file_name'].endswith('.png')
+        assert dataset.loadImg(img_id).shape == (20 + i, 30, 3)
+        assert not os.path.isabs(img_info['file_name'])
+        assert not img_info['file_name'].startswith(os.pardir)
+
+    # Files outside the image directory must be copied in
+    with pytest.raises(AssertionError):
+        dataset.addImageFiles(paths[:1], write_img=False)
+    inside = os.path.join(dataset.imgs_dir, 'inside.png')
+    cv2.imwrite(inside, np.zeros((8, 8, 3), dtype=np.uint8))
+    img_id = dataset.addImageFiles([inside], write_img=False)[0]
+    assert dataset.imgs[img_id]['file_name'] == 'inside.png'
+
+
+def test_add_samples_encoding(tmp_path):
+    dataset = _make_dataset(tmp_path, num_imgs=0)
+    cat_id = dataset.catNameToId['car']
+    noise = np.random.RandomState(0).randint(0, 255, (64, 80, 3), np.uint8)
+    samples = [{'img': noise, 'anns': [dataset.createAnn([8, 8, 40, 20], cat_id)]}
+               for _ in range(2)]
+
+    low, high = dataset.addSamples(samples[:1], jpeg_quality=10) + \
+        dataset.addSamples(samples[1:], jpeg_quality=95, num_threads=2)
+    assert os.path.getsize(low) < os.path.getsize(high)
+
+    path = dataset.addSample(noise, [dataset.createAnn([8, 8, 40, 20], cat_id)],
+                             img_ext='.png', max_size=40)
+    img_info = dataset.imgs[max(dataset.imgs)]
+    assert path.endswith('.png') and cv2.imread(path).shape == (32, 40, 3)
+    assert (img_info['height'], img_info['width']) == (32, 40)
+    assert dataset.imgToAnns[img_info['id']][0]['bbox'] == [4, 4, 20, 10]
+    with pytest.raises(IOError):
+        dataset.addSample(str(tmp_path / 'missing.jpg'), [], max_size=40)
+
+
+def test_duplicate_index(tmp_path):
+    rng = np.random.RandomState(1)
+    imgs = [cv2.resize(rng.randint(0, 255, (8, 8, 3), np.uint8), (64, 48))
+            for _ in range(4)]
+    dataset = _make_dataset(tmp_path, num_imgs=0)
+    for img in imgs:
+        dataset.addSample(img, [])
+    assert dataset.enableDuplicateIndex(num_workers=2) == []
+
+    near_dup = cv2.add(imgs[2], 3)
+    assert dataset.addSample(near_dup, []) is not None
+    new_id, dup_id, _ = dataset.duplicates[0]
+    assert new_id == max(dataset.imgs) and dup_id == sorted(dataset.imgs)[2]
+
+    dataset.enableDuplicateIndex(policy='skip', num_workers=2)
+    assert len(dataset.duplicates) == 1
+    num_imgs = len(dataset.imgs)
+    assert dataset.addSample(cv2.add(imgs[0], 2), []) is None
+    assert len(dataset.imgs) == num_imgs
+
+
+def test_shared_index(tmp_path):
+    dataset = _make_dataset(tmp_path)
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    img_id = max(dataset.imgs)
+    ann = dataset.createAnn([0, 0, 5, 5], bike_id, img_id=img_id, id=1000)
+    dataset.dataset['annotations'].append(ann)
+    dataset.createIndex()
+
+    index = dataset.exportSharedIndex(str(tmp_path / 'index'))
+    index = cocoplus.shared_index.SharedIndex(str(tmp_path / 'index'))
+    assert index.imgs[img_id] == dataset.imgs[img_id]
+    assert index.imgToPc[img_id] == dataset.imgToPc[img_id]
+    assert index.imgToAnns[img_id] == dataset.imgToAnns[img_id]
+    assert index.loadAnns([1000]) == dataset.loadAnns([1000])
+    for kwargs in [{}, {'imgIds': [img_id]}, {'catIds': [bike_id]},
+                   {'areaRng': [130, 200]}, {'iscrowd': False}]:
+        assert sorted(index.getAnnIds(**kwargs)) == \
+            sorted(dataset.getAnnIds(**kwargs))
+    assert index.getImgIds(catIds=[bike_id]) == [img_id]
+    assert index.getCatIds(catNms=['bike']) == [bike_id]
+
+    # Images without annotations map to an empty list
+    dataset.removeAnns(dataset.getAnnIds(imgIds=[img_id]))
+    index = dataset.exportSharedIndex(str(tmp_path / 'index'))
+    assert index.imgToAnns[img_id] == dataset.imgToAnns[img_id] == []
+    assert index.getAnnIds(imgIds=[img_id]) == []
+
+
+def test_sqlite_backend(tmp_path, monkeypatch):
+    source = _make_dataset(tmp_path / 'json')
+    source.saveAnnsToDisk()
+
+    dataset = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'),
+                                     source.annotation_file,
+                                     logging_level='WARN',
+                                     imgs_dir=source.imgs_dir)
+    assert len(dataset.imgs) == len(source.imgs)
+    assert len(dataset.anns) == len(source.anns)
+    img_id = max(source.imgs)
+    assert dataset.imgs[img_id] == source.imgs[img_id]
+    assert dataset.imgToAnns[img_id] == source.imgToAnns[img_id]
+    assert dataset.imgToPc[img_id] == source.imgToPc[img_id]
+    assert dataset.getAnnIds(imgIds=[img_id]) == source.getAnnIds(imgIds=[img_id])
+    assert len(dataset.getAnnIds(distRng=[2, 4])) == 2
+    assert sorted(dataset.getImgIds(catIds=[source.catNameToId['car']])) == \
+        sorted(source.imgs)
+
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    dataset.addSample(np.zeros((48, 64, 3), np.uint8),
+                      [dataset.createAnn([1, 1, 4, 4], bike_id)])
+    assert dataset.getImgIds(catIds=[bike_id]) == [max(dataset.imgs)]
+    assert dataset.loadImg(max(dataset.imgs)).shape == (48, 64, 3)
+    assert len(dataset.getAnnIds(imgIds=list(range(40000)))) == len(source.anns) + 1
+
+    # Public methods commit, another connection sees the new sample
+    reopened = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'), logging_level='WARN')
+    assert len(reopened.imgs) == len(dataset.imgs)
+    assert reopened.catNameToId['bike'] == bike_id
+
+    # Objects read from the database are copies
+    reopened.imgs[img_id]['file_name'] = 'changed.jpg'
+    assert reopened.imgs[img_id] == source.imgs[img_id]
+    with pytest.raises(AssertionError):
+        reopened.create_new_dataset(str(tmp_path / 'other'), 'val')
+    reopened.close()
+
+    out_file = str(tmp_path / 'export.json')
+    dataset.saveAnnsToDisk(out_file)
+    exported = cocoplus.coco.COCO_PLUS(out_file, logging_level='WARN')
+    assert len(exported.imgs) == len(source.imgs) + 1
+    assert exported.catNameToId['bike'] == bike_id
+
+    # A new process appends after the stored IDs
+    for name in ['IMG_ID', 'ANN_ID', 'PCL_ID', 'CAT_ID']:
+        monkeypatch.setattr(cocoplus.coco.COCO_PLUS, name, 0)
+    reopened = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'), logging_level='WARN',
+                                      imgs_dir=source.imgs_dir)
+    num_imgs = len(reopened.imgs)
+    reopened.addCategory('truck', 'vehicle')
+    reopened.addSample(np.zeros((8, 8, 3), np.uint8),
+                       [reopened.createAnn([1, 1, 4, 4], bike_id)], pointcloud=[[0, 0, 0]])
+    assert len(reopened.imgs) == num_imgs + 1
+    reopened.close()
+
+
+def _check_index(dataset):
+    assert sorted(a['id'] for a in dataset.dataset['annotations']) == \
+        sorted(dataset.anns)
+    assert sorted(i['id'] for i in dataset.dataset['images']) == \
+        sorted(dataset.imgs)
+    for cat_id in dataset.cats:
+        expected = sorted(a['image_id'] for a in dataset.anns.values()
+                          if a['category_id'] == cat_id)
+        assert sorted(dataset.catToImgs[cat_id]) == expected
+    for img_id, anns in dataset.imgToAnns.items():
+        assert all(a['image_id'] == img_id for a in anns)
+        assert all(dataset.anns[a['id']] is a for a in anns)
+
+
+def test_update_remove(tmp_path):
+    dataset = _make_dataset(tmp_path)
+    car_id = dataset.catNameToId['car']
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    img_ids = sorted(dataset.imgs)
+    ann_ids = sorted(dataset.anns)
+
+    dataset.relabelAnns(ann_ids[:3], bike_id)
+    assert [a['id'] for a in dataset.dataset['annotations']] == ann_ids
+    dataset.updateAnn(ann_ids[3], bbox=[0, 0, 1, 1], image_id=img_ids[0])
+    dataset.removeAnns([ann_ids[4], ann_ids[4]])
+    _check_index(dataset)
+    assert sorted(dataset.getImgIds(catIds=[bike_id])) == img_ids[:3]
+    assert len(dataset.imgToAnns[img_ids[0]]) == 2
+
+    dataset.removeImgs([img_ids[1]])
+    dataset.updatePointcloud(img_ids[2], [[0, 0, 0]])
+    dataset.removePointclouds([img_ids[5], img_ids[5]])
+    _check_index(dataset)
+    assert img_ids[1] not in dataset.imgToPc and img_ids[5] not in dataset.imgToPc
+    assert dataset.imgToPc[img_ids[2]]['points'] == [[0, 0, 0]]
+
+    dataset.updateCategory(bike_id, name='bicycle')
+    assert dataset.catNameToId['bicycle'] == bike_id
+    dataset.removeCategory(bike_id, new_cat_id=car_id)
+    _check_index(dataset)
+    assert bike_id not in dataset.cats
+    assert len(dataset.getAnnIds(catIds=[car_id])) == len(dataset.anns)
+
+    dataset.removeCategory(car_id)
+    _check_index(dataset)
+    assert len(dataset.anns) == 0 and len(dataset.dataset['annotations']) == 0
+
+
+def test_sqlite_update_remove(tmp_path):
+    dataset = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'),
+                                     logging_level='WARN')
+    dataset.create_new_dataset(str(tmp_path), 'val')
+    car_id = dataset.addCategory('car', 'vehicle')
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    for i in range(3):
+        dataset.addSample(np.zeros((8, 8, 3), np.uint8),
+                          [dataset.createAnn([0, 0, 2, 2], car_id)],
+                          pointcloud=[[i, i, i]], write_img=False)
+    img_ids = sorted(dataset.imgs)
+    ann_ids = sorted(dataset.anns)
+
+    dataset.relabelAnns(ann_ids[:2], bike_id)
+    assert dataset.anns[ann_ids[0]]['category_id'] == bike_id
+    assert sorted(dataset.getImgIds(catIds=[bike_id])) == img_ids[:2]
+    dataset.updateAnn(ann_ids[2], bbox=[1, 1, 1, 1])
+    assert dataset.anns[ann_ids[2]]['bbox'] == [1, 1, 1, 1]
+    dataset.removeImgs([img_ids[0]])
+    assert img_ids[0] not in dataset.imgs and img_ids[0] not in dataset.imgToPc
+    assert len(dataset.anns) == 2
+    dataset.removeCategory(bike_id)
+    assert list(dataset.anns) == [ann_ids[2]]
+
+
+def test_category_index(tmp_path):
+    dataset = _make_dataset(tmp_path, num_imgs=4)
+    index = dataset.catIndex
+    car_id = dataset.catNameToId['car']
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    person_id = dataset.addCategory('person', 'human')
+    img_ids = sorted(dataset.imgs)
+
+    # Several annotations of a category in one image give one image ID
+    dataset.addAnns([dataset.createAnn([0, 0, 2, 2], bike_id, img_id=img_ids[0]),
+                     dataset.createAnn([1, 1, 2, 2], bike_id, img_id=img_ids[0]),
+                     dataset.createAnn([0, 0, 2, 2], bike_id, img_id=img_ids[1])])
+    assert index.imgIds(bike_id).tolist() == img_ids[:2]
+    assert index.numImgs(car_id) == 4 and index.numImgs(person_id) == 0
+    both = index.intersect([car_id, bike_id])
+    assert both.tolist() == img_ids[:2]
+    assert index.intersect([bike_id, car_id]) is both
+    assert dataset.getImgIds(imgIds=img_ids[1:], catIds=[car_id, bike_id]) == \
+        img_ids[1:2]
+
+    assert index.catIdsByName(['bike', 'truck']) == [bike_id]
+    assert index.catIdsBySupercategory(['vehicle']) == sorted([car_id, bike_id])
+    assert index.imgIdsBySupercategory('human').tolist() == []
+
+    # Updates invalidate the cached arrays and queries
+    dataset.removeAnns(dataset.getAnnIds(imgIds=[img_ids[1]], catIds=[bike_id]))
+    assert index.intersect([car_id, bike_id]).tolist() == img_ids[:1]
+    dataset.updateCategory(person_id, supercategory='vehicle')
+    assert index.union(index.catIdsBySupercategory(['vehicle'])).tolist() == img_ids
+    dataset.removeCategory(bike_id)
+    assert index.imgIds(bike_id).tolist() == []
+    assert 'human' not in index.supercategories()
+
+    # Only the most recently used query results are kept
+    index.max_queries = 2
+    index.intersect([car_id])
+    index.union([car_id, person_id])
+    index.intersect([car_id])
+    index.union([person_id])
+    assert list(index._queries) == [('and', (car_id,)), ('or', (person_id,))]
+
+
+def test_sampler(tmp_path):
+    dataset = _make_dataset(tmp_path, num_imgs=8)
+    bike_id = dataset.addCategory('bike', 'vehicle')
+    img_ids = sorted(dataset.imgs)
+    dataset.addAnns([dataset.createAnn([0, 0, 2, 2], bike_id, img_id=img_ids[0],
+                                       distance=45)])
+    dataset.saveAnnsToDisk()
+
+    cache_file = cocoplus.sampler.sampler_cache_path(dataset.annotation_file)
+    sampler = dataset.createSampler('class_balanced', num_samples=1000, seed=3,
+                                    cache_file=cache_file)
+    assert os.path.exists(cache_file)
+    assert sampler.dist_hist.sum(axis=0).tolist() == [8, 0, 0, 0, 1, 0]
+    ids = sampler.epochIds(0)
+    assert 450 < np.sum(ids == img_ids[0]) < 680
+    assert np.array_equal(ids, sampler.epochIds(0))
+    assert not np.array_equal(ids, sampler.epochIds(1))
+
+    # Shards split the same epoch, cached histograms give the same epochs
+    shards = [dataset.createSampler('class_balanced', num_samples=1000, seed=3,
+                                    shard_id=i, num_shards=3, cache_file=cache_file)
+              for i in range(3)]
+    assert [len(s) for s in shards] == [334] * 3
+    assert np.array_equal(shards[1].epochIds(0), np.resize(ids, 1002)[1::3])
+
+    repeat = dataset.createSampler('repeat_factor', repeat_thresh=0.5)
+    assert repeat.repeatFactors()[0] == 2.
+    assert sorted(set(repeat)) == img_ids
+    distance = dataset.createSampler('distance', num_samples=100)
+    assert 30 < np.sum(distance.epochIds(0) == img_ids[0]) < 70
+    assert sorted(dataset.createSampler('uniform')) == img_ids
+
+    # A relabel keeps the counts but invalidates the cache, until it is saved
+    dataset.relabelAnns(dataset.getAnnIds(imgIds=[img_ids[1]]), bike_id)
+    relabeled = dataset.createSampler('class_balanced', cache_file=cache_file)
+    assert (relabeled.catFrequencies() * 8).tolist() == [7, 2]
+    dataset.saveAnnsToDisk()
+    reloaded = cocoplus.coco.COCO_PLUS(dataset.annotation_file, logging_level='WARN')
+    relabeled = reloaded.createSampler('class_balanced', cache_file=cache_file)
+    assert (relabeled.catFrequencies() * 8).tolist() == [7, 2]
+    mtime = os.stat(cache_file).st_mtime_ns
+    reloaded.createSampler('class_balanced', cache_file=cache_file)
+    assert os.stat(cache_file).st_mtime_ns == mtime
+
+
+def test_diff_patch(tmp_path):
+    old = _make_dataset(tmp_path / 'old')
+    old.saveAnnsToDisk()
+    new = cocoplus.coco.COCO_PLUS(old.annotation_file, logging_level='WARN',
+                                  imgs_dir=old.imgs_dir)
+    img_ids, ann_ids = sorted(new.imgs), sorted(new.anns)
+    bike_id = new.addCategory('bike', 'vehicle')
+    new.updateAnn(ann_ids[0], bbox=[1, 1, 5, 5])
+    new.relabelAnns([ann_ids[1]], bike_id)
+    new.addAnns([new.createAnn([0, 0, 3, 3], bike_id, img_id=img_ids[2])])
+    new.removeImgs([img_ids[3]])
+    new.updatePointcloud(img_ids[4], [[9, 9, 9]])
+    new.updateAnn(ann_ids[2], remove_fields=['distance'])
+    old_truck = old.addCategory('truck', 'vehicle')
+    old.saveAnnsToDisk()
+    new.addCategory('truck', 'vehicle', new_cat_id=old_truck)
+    # Swapped names
+    new.updateCategory(old_truck, name='tmp')
+    new.updateCategory(new.catNameToId['car'], name='truck')
+    new.updateCategory(old_truck, name='car')
+
+    patch = cocoplus.diff.diff_datasets(old.annotation_file, new)
+    assert cocoplus.diff.patch_summary(patch) == {
+        'categories': {'added': 1, 'removed': 0, 'modified': 2},
+        'images': {'added': 0, 'removed': 1, 'modified': 0},
+        'annotations': {'added': 1, 'removed': 1, 'modified': 3},
+        'pointclouds': {'added': 0, 'removed': 1, 'modified': 1}}
+
+    cocoplus.diff.apply_patch(old, patch)
+    summary = cocoplus.diff.patch_summary(cocoplus.diff.diff_datasets(old, new))
+    assert all(sum(ops.values()) == 0 for ops in summary.values())
+    assert 'distance' not in old.anns[ann_ids[2]]
+    _check_index(old)
+
+    # Same content with new ids, aligned by file name and box IoU
+    renumbered = {
+        'categories': new.dataset['categories'],
+        'images': [dict(img, id=img['id'] + 100) for img in new.dataset['images']],
+        'annotations': [dict(ann, id=ann['id'] + 100, image_id=ann['image_id'] + 100)
+                        for ann in new.dataset['annotations']],
+        'pointclouds': [dict(pc, img_id=pc['img_id'] + 100)
+                        for pc in new.dataset['pointclouds']]}
+    summary = cocoplus.diff.patch_summary(
+        cocoplus.diff.diff_datasets(new, renumbered, match='iou'))
+    assert all(sum(ops.values()) == 0 for ops in summary.values())
+
+    # SQLite revisions are read through the database
+    original = cocoplus.coco.COCO_PLUS(old.annotation_file, logging_level='WARN')
+    new.saveAnnsToDisk(str(tmp_path / 'new.json'))
+    sql_old = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'old.db'), old.annotation_file,
+                                     logging_level='WARN')
+    summary = cocoplus.diff.patch_summary(
+        cocoplus.diff.diff_datasets(sql_old, original))
+    assert all(sum(ops.values()) == 0 for ops in summary.values())
+    sql_new = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'new.db'), str(tmp_path / 'new.json'),
+                                     logging_level='WARN')
+    patch = cocoplus.diff.diff_datasets(sql_old, sql_new)
+    cocoplus.diff.apply_patch(sql_old, patch)
+    summary = cocoplus.diff.patch_summary(cocoplus.diff.diff_datasets(sql_old, new))
+    assert all(sum(ops.values()) == 0 for ops in summary.values())
+
+
+def test_validate(tmp_path):
+    dataset = _make_dataset(tmp_path)
+    assert dataset.validate()['valid']
+
+    img_ids, ann_ids = sorted(dataset.imgs), sorted(dataset.anns)
+    dataset.updateAnn(ann_ids[0], bbox=[60, 40, 10, 10])
+    dataset.updateAnn(ann_ids[1], bbox=[5, 5, 0, 3])
+    dataset.dataset['annotations'][2]['category_id'] = 99
+    dataset.dataset['annotations'][3]['image_id'] = 99
+    dataset.dataset['pointclouds'][4]['img_id'] = 99
+
+    report = cocoplus.validate.validate_dataset(dataset.dataset, num_workers=2,
+                                                shard_size=2)
+    counts = {k: c['count'] for k, c in report['checks'].items() if c['count']}
+    assert counts == {'box_out_of_image': 1, 'zero_area_box': 1,
+                      'unknown_category': 1, 'missing_image': 1,
+                      'orphan_pointcloud': 1}
+    assert report['checks']['box_out_of_image']['ids'] == [ann_ids[0]]
+
+    dataset.createIndex()
+    report = dataset.validate(fix=True)
+    assert report['fixed'] == {'clipped_boxes': 1, 'removed_annotations': 3,
+                               'removed_pointclouds': 1}
+    assert dataset.anns[ann_ids[0]]['bbox'] == [60, 40, 4, 8]
+    assert dataset.validate()['valid']
+
+    # SQLite datasets are checked through the database
+    dataset.saveAnnsToDisk()
+    sql = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'), dataset.annotation_file,
+                                 logging_level='WARN')
+    sql.updateAnn(min(sql.anns), bbox=[5, 5, 0, 3])
+    report = cocoplus.validate.validate_dataset(sql)
+    assert report['num_annotations'] == len(dataset.anns)
+    assert report['checks']['zero_area_box']['ids'] == [min(sql.anns)]
+    assert cocoplus.validate.validate_dataset(sql, fix=True)['fixed'] == \
+        {'clipped_boxes': 0, 'removed_annotations': 1, 'removed_pointclouds': 0}
+    assert cocoplus.validate.validate_dataset(sql)['valid']
+
+
+def test_export(tmp_path):
+    dataset = _make_dataset(tmp_path / 'data')
+    img_ids = sorted(dataset.imgs)
+    img = dataset.imgs[img_ids[1]]
+    stem = os.path.splitext(img['file_name'])[0]
+
+    stats = dataset.export(str(tmp_path / 'yolo'), fmt='yolo', num_workers=2,
+                           shard_size=4)
+    assert stats == {'images': 6, 'annotations': 6, 'shards': 2}
+    with open(tmp_path / 'yolo' / 'labels' / (stem + '.txt')) as f:
+        cls, *box = f.read().split()
+    assert cls == '0'
+    box = cocoplus.utils.coco_utils.yolo_to_xywh([float(v) for v in box],
+                                                 img['height'], img['width'])
+    assert np.allclose(box, [[2, 3, 11, 12]], atol=1e-3)
+
+    cocoplus.export.export_dataset(dataset.dataset, str(tmp_path / 'voc'),
+                                   fmt='voc', num_workers=1)
+    with open(tmp_path / 'voc' / 'Annotations' / (stem + '.xml')) as f:
+        xml = f.read()
+    assert '<name>car</name>' in xml and '<xmax>13</xmax>' in xml
+
+    ann_file = str(tmp_path / 'anns.json')
+    with open(ann_file, 'w') as f:
+        json.dump(dataset.dataset, f)
+    stats = cocoplus.export.export_dataset(ann_file, str(tmp_path / 'jsonl'),
+                                           fmt='jsonl', img_ids=img_ids[:3],
+                                           shard_size=2)
+    assert stats == {'images': 3, 'annotations': 3, 'shards': 2}
+    with open(tmp_path / 'jsonl' / 'part-00000.jsonl') as f:
+        rows = [json.loads(line) for line in f]
+    assert [r['image']['id'] for r in rows] == img_ids[:2]
+    assert rows[0]['pointcloud']['num_points'] == 1
+
+    # Labels stay in the output directory whatever the file names
+    outside = dict(dataset.dataset,
+                   images=[dict(img, file_name=str(tmp_path / 'src' / 'a.jpg'))
+                           for img in dataset.dataset['images'][:1]] +
+                          [dict(img, file_name='../../b.jpg')
+                           for img in dataset.dataset['images'][1:2]])
+    for fmt, ext in [('yolo', '.txt'), ('voc', '.xml')]:
+        out_dir = tmp_path / ('outside_' + fmt)
+        cocoplus.export.export_dataset(outside, str(out_dir), fmt=fmt, num_workers=1)
+        assert not os.path.exists(tmp_path / 'src')
+        assert not os.path.exists(tmp_path / ('b' + ext))
+        labels = [os.path.relpath(os.path.join(root, name), out_dir)
+                  for root, _, names in os.walk(out_dir) for name in names
+                  if name.endswith(ext) and name != 'classes.txt']
+        assert sorted(os.path.basename(l) for l in labels) == ['a' + ext, 'b' + ext]
+
+    # SQLite datasets are exported from the database
+    sql = cocoplus.COCO_PLUS_SQL(str(tmp_path / 'ds.db'), ann_file,
+                                 logging_level='WARN')
+    stats = sql.export(str(tmp_path / 'sql'), fmt='jsonl', num_workers=1,
+                       shard_size=4)
+    assert stats == {'images': 6, 'annotations': 6, 'shards': 2}
+    with open(tmp_path / 'sql' / 'part-00001.jsonl') as f:
+        rows = [json.loads(line) for line in f]
+    assert rows[-1]['annotations'] == sql.imgToAnns[img_ids[-1]]
+
+
+def test_logger(tmp_path):
+    from cocoplus.utils import log
+    log_file = str(tmp_path / 'coco.log')
+    logger = log.getLogger('cocoplus.test', console_level='ERROR',
+                           file_level='DEBUG', log_file=log_file, rate_limit=5)
+    assert log.getLogger('cocoplus.test', console_level='ERROR',
+                         rate_limit=5) is logger
+    assert len(logger.handlers) == 1
+
+    for i in range(100):
+        logger.debug('sample %d', i)
+    logger.error('done')
+    log.flush()
+
+    with open(log_file) as f:
+        lines = f.read().splitlines()
+    assert len(lines) == 6
+    assert lines[0].endswith('sample 0') and lines[-1].endswith('done')
+
+    # Dataset instances keep their own level
+    verbose = cocoplus.coco.COCO_PLUS(logging_level='DEBUG')
+    quiet = cocoplus.coco.COCO_PLUS(logging_level='ERROR')
+    assert verbose.logger.isEnabledFor(logging.DEBUG)
+    assert not quiet.logger.isEnabledFor(logging.WARNING)
+
+    # New instances leave the shared console level unchanged
+    console = log._listeners['cocoplus.coco'].handlers[0]
+    console.setLevel('WARN')
+    cocoplus.coco.COCO_PLUS(logging_level='DEBUG')
+    assert console.level == logging.WARN
+    console.setLevel('DEBUG')
+
+    # A forked child logs through new queues and listeners, started lazily
+    if hasattr(os, 'fork'):
+        pid = os.fork()
+        if pid == 0:
+            lazy = log._listeners['cocoplus.test']._thread is None
+            logger.error('child')
+            log.flush()
+            os._exit(0 if lazy else 1)
+        _, status = os.waitpid(pid, 0)
+        assert status == 0
+        with open(log_file) as f:
+            assert f.read().splitlines()[-1].endswith('child')
+
+
+def test_metrics(tmp_path):
+    from cocoplus.utils import metrics
+    from cocoplus.coco_eval import COCOeval_plus
+
+    metrics.reset()
+    metrics.enable()
+    try:
+        dataset = _make_dataset(tmp_path / 'data', num_imgs=3)
+        dataset.saveAnnsToDisk()
+        dets = dataset.loadRes([dict(ann, score=0.9)
+                                for ann in dataset.loadAnns(dataset.getAnnIds())])
+        coco_eval = COCOeval_plus(dataset, dets, 'bbox')
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+        coco_eval.summarize()
+    finally:
+        metrics.disable()
+
+    snap = metrics.snapshot()
+    assert snap['spans']['coco.addSample']['calls'] == 3
+    assert snap['counters']['samples_added'] == 3
+    assert snap['counters']['images_encoded'] == 3
+    assert snap['counters']['bytes_written'] > 0
+    assert {'coco.saveAnnsToDisk', 'eval.evaluate', 'eval.accumulate',
+            'eval.summarize'} <= set(snap['spans'])
+    assert coco_eval.stats[0] == 1.0
+
+    # Memory is measured over the span, not as the process lifetime peak
+    if os.path.exists('/proc/self/statm'):
+        metrics.enable()
+        with metrics.span('alloc'):
+            block = np.ones(64 * 2**20, np.uint8)
+        metrics.disable()
+        assert metrics.snapshot()['spans']['alloc']['rss_delta'] >= block.nbytes // 2
+
+    # Nothing is collected once disabled
+    _make_dataset(tmp_path / 'data2', num_imgs=1)
+    assert metrics.snapshot()['counters'] == snap['counters']
+
+    metrics.export_chrome_trace(str(tmp_path / 'trace.json'))
+    with open(tmp_path / 'trace.json') as f:
+        events = json.load(f)['traceEvents']
+    assert sum(e['name'] == 'coco.addSample' for e in events) == 3
+    metrics.export_prometheus(str(tmp_path / 'metrics.prom'))
+    with open(tmp_path / 'metrics.prom') as f:
+        assert 'cocoplus_samples_added_total 3.0' in f.read()
+
+
+def test_lazy_imports():
+    import subprocess
+    import sys
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    code = ("import sys; sys.path.insert(0, {!r}); import cocoplus, "
+            "cocoplus.coco_eval; print(sorted({{m.split('.')[0] for m in "
+            "sys.modules}} & {{'cv2', 'matplotlib', 'shapely', 'tqdm'}}))")
+    out = subprocess.check_output([sys.executable, '-c', code.format(root)])
+    assert out.decode().strip() == '[]'
+
+
+def test_error_analysis(tmp_path):
+    from cocoplus.coco_eval import COCOeval_plus
+    dataset = _make_dataset(tmp_path)
+    car = dataset.catNameToId['car']
+    person = dataset.addCategory('person', 'human')
+    img_ids = sorted(dataset.imgs)
+    boxes = {ann['image_id']: ann['bbox'] for ann in dataset.dataset['annotations']}
+
+    x, y, w, h = boxes[img_ids[1]]
+    dets = [(0, car, boxes[img_ids[0]], 0.9),        # true positive
+            (0, car, boxes[img_ids[0]], 0.8),        # duplicate
+            (1, car, [x + 6, y, w, h], 0.7),         # localization
+            (2, person, boxes[img_ids[2]], 0.6),     # classification
+            (3, car, [40, 30, 5, 5], 0.5)]           # background
+    dets = [{'image_id': img_ids[i], 'category_id': c, 'bbox': b, 'score': s}
+            for i, c, b, s in dets]
+    coco_eval = COCOeval_plus(dataset, dataset.loadRes(dets), 'bbox')
+    coco_eval.evaluate()
+    report = coco_eval.analyzeErrors(iouThr=0.5)
+
+    assert report['summary'] == {'tp': 1, 'duplicate': 1, 'classification': 1,
+                                 'localization': 1, 'background': 1,
+                                 'num_gt': 6, 'missed': 5, 'recall': 1 / 6.}
+    assert report['by_category']['person']['classification'] == 1
+    assert report['by_distance']['0-10']['tp'] == 1
+    assert report['worst_images'][0] == {'image_id': img_ids[1], 'tp': 0,
+                                         'fp': 1, 'fn': 1}
+
 
 def main():
     ann_file = '../../../data/datasets/nucoco/v1.0-mini/annotations/instances_val.json'
@@ -26,4 +757,4 @@ def main():
 
 ##------------------------------------------------------------------------------
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()